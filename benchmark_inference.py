@@ -0,0 +1,354 @@
+import argparse
+import itertools
+import json
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import torch
+import numpy as np
+from modules.python.TextColor import TextColor
+from modules.python.FileManager import FileManager
+from modules.python.ImageIndex import ImageIndex
+from modules.python.Options import ImageSizeOptions, TrainOptions, InferenceOptions
+from modules.python.SyntheticImages import SyntheticImages
+from modules.python.StageTimer import StageTimer
+from modules.python.models.ModelHander import ModelHandler
+from modules.python.models.predict import predict
+"""
+The benchmark inference script measures the throughput of the predict method that call_consensus.py runs. It runs
+predict on a set of images for every combination of the given batch sizes, thread counts, dataloader worker counts
+and inference processes and reports for each run:
+    - images per second and columns per second
+    - peak resident memory of the run (including the dataloader workers and inference processes)
+    - time spent in each stage of prediction (index, model_load, data_load, inference, write, ...)
+Each run is done in a new process so the runs don't share memory or caches. The report is saved as a JSON file that
+can be compared between commits.
+
+If no image directory is given, synthetic images are generated. If no model is given, a randomly initialized model
+is used, the speed of the model doesn't depend on its weights.
+"""
+
+
+def get_git_commit():
+    """
+    Returns the git commit of the source code or None if it is not in a git repository.
+    :return:
+    """
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident memory of this process and of the largest of its finished child processes in MB.
+    :return:
+    """
+    # ru_maxrss is in kilobytes on linux and in bytes on mac
+    scale = 1024.0 * 1024.0 if platform.system() == 'Darwin' else 1024.0
+    self_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale
+    children_rss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale
+    return self_rss, children_rss
+
+
+def save_random_model(model_path):
+    """
+    Save a randomly initialized model with the default model size.
+    :param model_path: Path where the model is saved
+    :return:
+    """
+    transducer_model = ModelHandler.get_new_gru_model(input_channels=ImageSizeOptions.IMAGE_CHANNELS,
+                                                      image_features=ImageSizeOptions.IMAGE_HEIGHT,
+                                                      gru_layers=TrainOptions.GRU_LAYERS,
+                                                      hidden_size=TrainOptions.HIDDEN_SIZE,
+                                                      num_base_classes=ImageSizeOptions.TOTAL_BASE_LABELS,
+                                                      num_rle_classes=ImageSizeOptions.TOTAL_RLE_LABELS)
+    model_optimizer = torch.optim.Adam(transducer_model.parameters())
+    ModelHandler.save_model(transducer_model, model_optimizer, TrainOptions.HIDDEN_SIZE, TrainOptions.GRU_LAYERS, 0,
+                            model_path)
+
+
+def benchmark_run(image_directory, model_path, output_filename, run_options, result_queue):
+    """
+    Run predict once and send the time, memory and stage times of the run to the result queue. This runs in its own
+    process.
+    :param image_directory: Path to a directory containing images
+    :param model_path: Path to a model
+    :param output_filename: Path to the prediction file of the run
+    :param run_options: Dictionary of the options of the run
+    :param result_queue: Queue where the result is sent
+    :return:
+    """
+    stage_timer = StageTimer()
+    start_time = time.time()
+    predict(image_directory, output_filename, model_path,
+            batch_size=run_options['batch_size'],
+            num_workers=run_options['num_workers'],
+            threads=run_options['threads'],
+            gpu_mode=run_options['gpu_mode'],
+            inference_mode=run_options['inference_mode'],
+            inference_processes=run_options['inference_processes'],
+            precision=run_options['precision'],
+            stage_timer=stage_timer)
+    total_time = time.time() - start_time
+
+    self_rss, children_rss = get_peak_rss_mb()
+    result_queue.put({'seconds': total_time,
+                      'peak_rss_mb': self_rss,
+                      'peak_child_rss_mb': children_rss,
+                      'stages': stage_timer.get_stage_times()})
+
+
+def benchmark_inference(image_directory, model_path, output_dir, batch_sizes, threads_list, num_workers_list,
+                        inference_processes_list, inference_mode, precision, gpu_mode, repeats):
+    """
+    Run predict with all the combinations of the given options and save a report.
+    :param image_directory: Path to a directory containing images
+    :param model_path: Path to a model
+    :param output_dir: Path to the output directory
+    :param batch_sizes: List of batch sizes
+    :param threads_list: List of PyTorch thread counts
+    :param num_workers_list: List of dataloader worker counts
+    :param inference_processes_list: List of inference process counts
+    :param inference_mode: Inference mode of all the runs
+    :param precision: Model precision of all the runs
+    :param gpu_mode: If true, the runs use the GPU
+    :param repeats: Number of times each combination is run
+    :return: The report dictionary
+    """
+    # build the index once so the runs measure prediction only
+    image_index = ImageIndex.load(image_directory)
+    total_images = len(image_index)
+    total_columns = int(np.sum(np.minimum(image_index.length, ImageSizeOptions.SEQ_LENGTH)))
+
+    report = {'commit': get_git_commit(),
+              'date': time.strftime('%Y-%m-%d %H:%M:%S'),
+              'host': platform.node(),
+              'cpu_count': os.cpu_count(),
+              'torch_version': torch.__version__,
+              'image_directory': image_directory,
+              'model_path': model_path,
+              'total_images': total_images,
+              'total_columns': total_columns,
+              'runs': []}
+
+    context = torch.multiprocessing.get_context('spawn')
+    configurations = list(itertools.product(batch_sizes, threads_list, num_workers_list, inference_processes_list))
+    for run_id, (batch_size, threads, num_workers, inference_processes) in \
+            enumerate(itertools.chain.from_iterable(itertools.repeat(configuration, repeats)
+                                                    for configuration in configurations)):
+        run_options = {'batch_size': batch_size,
+                       'threads': threads,
+                       'num_workers': num_workers,
+                       'inference_processes': inference_processes,
+                       'inference_mode': inference_mode,
+                       'precision': precision,
+                       'gpu_mode': gpu_mode}
+        sys.stderr.write(TextColor.GREEN + "INFO: BENCHMARK RUN " + str(run_id + 1) + "/"
+                         + str(len(configurations) * repeats) + ": " + json.dumps(run_options) + "\n" + TextColor.END)
+
+        # predict writes the predictions, the stage times and the loader buffer next to its output file, so each
+        # run writes to its own directory that is deleted after the run
+        run_directory = tempfile.mkdtemp(prefix='helen_benchmark_', dir=output_dir)
+        output_filename = os.path.join(run_directory, "benchmark_predictions.hdf")
+        try:
+            result_queue = context.Queue()
+            process = context.Process(target=benchmark_run,
+                                      args=(image_directory, model_path, output_filename, run_options, result_queue))
+            process.start()
+            while True:
+                try:
+                    result = result_queue.get(timeout=10)
+                    break
+                except queue.Empty:
+                    if not process.is_alive():
+                        raise RuntimeError("BENCHMARK RUN " + str(run_id + 1) + " EXITED WITH CODE "
+                                           + str(process.exitcode))
+            process.join()
+        finally:
+            shutil.rmtree(run_directory, ignore_errors=True)
+
+        run_report = dict(run_options)
+        run_report.update({
+            'seconds': result['seconds'],
+            'images_per_second': total_images / max(1e-9, result['seconds']),
+            'columns_per_second': total_columns / max(1e-9, result['seconds']),
+            'peak_rss_mb': result['peak_rss_mb'],
+            'peak_child_rss_mb': result['peak_child_rss_mb'],
+            'stages': result['stages'],
+        })
+        report['runs'].append(run_report)
+
+    # print a summary of the report
+    sys.stderr.write(TextColor.BLUE + "{:>6} {:>7} {:>7} {:>9} {:>10} {:>12} {:>10} {:>10} {:>10}\n".format(
+        "BATCH", "THREADS", "WORKERS", "PROCESSES", "IMAGES/SEC", "COLUMNS/SEC", "RSS_MB", "DATA_SEC", "INFER_SEC")
+        + TextColor.END)
+    for run_report in report['runs']:
+        stages = run_report['stages']
+        sys.stderr.write("{:>6} {:>7} {:>7} {:>9} {:>10.2f} {:>12.1f} {:>10.1f} {:>10.2f} {:>10.2f}\n".format(
+            run_report['batch_size'], run_report['threads'], run_report['num_workers'],
+            run_report['inference_processes'], run_report['images_per_second'], run_report['columns_per_second'],
+            max(run_report['peak_rss_mb'], run_report['peak_child_rss_mb']),
+            stages.get('data_load', {}).get('seconds', 0.0), stages.get('inference', {}).get('seconds', 0.0)))
+
+    report_filename = os.path.join(output_dir, "inference_benchmark.json")
+    with open(report_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    sys.stderr.write(TextColor.GREEN + "INFO: REPORT SAVED TO: " + report_filename + "\n" + TextColor.END)
+
+    return report
+
+
+if __name__ == '__main__':
+    '''
+    Processes arguments and performs tasks.
+    '''
+    parser = argparse.ArgumentParser(description="benchmark_inference.py measures the throughput of call_consensus.py "
+                                                 "over batch sizes, thread counts and worker counts.")
+    parser.add_argument(
+        "-i",
+        "--image_file",
+        type=str,
+        required=False,
+        default=None,
+        help="Path to a directory of MarginPolish images. If not set, synthetic images are generated in the output "
+             "directory."
+    )
+    parser.add_argument(
+        "-m",
+        "--model_path",
+        type=str,
+        required=False,
+        default=None,
+        help="Path to a trained model. If not set, a randomly initialized model is used."
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        type=str,
+        required=False,
+        default='./benchmark_output/',
+        help="Path to the output directory."
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_sizes",
+        type=int,
+        nargs='+',
+        required=False,
+        default=[256],
+        help="Batch sizes to benchmark, default is 256."
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        nargs='+',
+        required=False,
+        default=[1],
+        help="PyTorch thread counts to benchmark, default is 1."
+    )
+    parser.add_argument(
+        "-w",
+        "--num_workers",
+        type=int,
+        nargs='+',
+        required=False,
+        default=[0],
+        help="Dataloader worker counts to benchmark, default is 0."
+    )
+    parser.add_argument(
+        "--inference_processes",
+        type=int,
+        nargs='+',
+        required=False,
+        default=[1],
+        help="Inference process counts to benchmark, default is 1."
+    )
+    parser.add_argument(
+        "--inference_mode",
+        type=str,
+        required=False,
+        default=InferenceOptions.DEFAULT_INFERENCE_MODE,
+        choices=sorted(InferenceOptions.INFERENCE_MODES.keys()),
+        help="Inference mode of all the runs, default is sliding."
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        required=False,
+        default=InferenceOptions.DEFAULT_PRECISION,
+        choices=InferenceOptions.PRECISIONS,
+        help="Model precision of all the runs, default is fp32."
+    )
+    parser.add_argument(
+        "-r",
+        "--repeats",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of times each combination is run, default is 1."
+    )
+    parser.add_argument(
+        "--synthetic_contigs",
+        type=int,
+        required=False,
+        default=2,
+        help="Number of contigs of the synthetic images, default is 2."
+    )
+    parser.add_argument(
+        "--synthetic_contig_length",
+        type=int,
+        required=False,
+        default=100000,
+        help="Length of the contigs of the synthetic images, default is 100000."
+    )
+    parser.add_argument(
+        "--synthetic_files",
+        type=int,
+        required=False,
+        default=4,
+        help="Number of synthetic image files, default is 4."
+    )
+    parser.add_argument(
+        "-g",
+        "--gpu_mode",
+        default=False,
+        action='store_true',
+        help="If set then PyTorch will use GPUs for inference."
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.output_dir = FileManager.handle_output_directory(FLAGS.output_dir)
+
+    if FLAGS.image_file is None:
+        FLAGS.image_file = FileManager.handle_output_directory(os.path.join(FLAGS.output_dir, 'synthetic_images'))
+        if not FileManager.get_file_paths_from_directory(FLAGS.image_file):
+            synthetic_images = SyntheticImages(total_contigs=FLAGS.synthetic_contigs,
+                                               contig_length=FLAGS.synthetic_contig_length)
+            total_images, total_columns = synthetic_images.generate(FLAGS.image_file, FLAGS.synthetic_files)
+            sys.stderr.write(TextColor.GREEN + "INFO: GENERATED " + str(total_images) + " SYNTHETIC IMAGES IN: "
+                             + FLAGS.image_file + "\n" + TextColor.END)
+
+    if FLAGS.model_path is None:
+        FLAGS.model_path = os.path.join(FLAGS.output_dir, 'random_model.pkl')
+        save_random_model(FLAGS.model_path)
+
+    benchmark_inference(FLAGS.image_file,
+                        FLAGS.model_path,
+                        FLAGS.output_dir,
+                        FLAGS.batch_sizes,
+                        FLAGS.threads,
+                        FLAGS.num_workers,
+                        FLAGS.inference_processes,
+                        FLAGS.inference_mode,
+                        FLAGS.precision,
+                        FLAGS.gpu_mode,
+                        FLAGS.repeats)
@@ -4,6 +4,8 @@ import os
 from modules.python.TextColor import TextColor
 from modules.python.models.predict import predict
 from modules.python.FileManager import FileManager
+from modules.python.Options import InferenceOptions
+from modules.python.ImageIndex import ImageIndex
 import time
 """
 The Call Consensus method generates base predictions for images generated through MarginPolish. This script reads
@@ -31,7 +33,9 @@ The algorithm is described here:
 """
 
 
-def polish_genome(image_filepath, model_path, batch_size, num_workers, threads, output_dir, output_prefix, gpu_mode):
+def polish_genome(image_filepath, model_path, batch_size, num_workers, threads, output_dir, output_prefix, gpu_mode,
+                  inference_mode, inference_processes, precision, resume, contigs, regions, mask_bed,
+                  profile_batches, loader, output_format):
     """
     This method provides an interface too call the predict method that generates the prediction hdf5 file
     :param image_filepath: Path to directory where all MarginPolish images are saved
@@ -42,16 +46,32 @@ def polish_genome(image_filepath, model_path, batch_size, num_workers, threads,
     :param output_dir: Path to the output directory
     :param output_prefix: Prefix of the output HDF5 file
     :param gpu_mode: If true, predict method will use GPU.
+    :param inference_mode: Window scheme used to run the model.
+    :param inference_processes: Number of processes for CPU inference.
+    :param precision: Precision of the model during inference.
+    :param resume: If true, keep the predictions of an existing output file and only predict the missing images.
+    :param contigs: List of contig names to predict, None to predict all the contigs.
+    :param regions: List of regions in contig:start-end format to predict, None to predict all the contigs.
+    :param mask_bed: Path to a BED file of masked regions, images in these regions are not predicted.
+    :param profile_batches: Number of minibatches to record with the torch profiler, 0 to not profile.
+    :param loader: How the dataloader workers pass the minibatches.
+    :param output_format: Backend of the prediction file, hdf5 or binary.
     :return:
     """
     # create a filename for the output file
-    output_filename = os.path.join(output_dir, output_prefix + '.hdf')
+    output_filename = os.path.join(output_dir, output_prefix + InferenceOptions.OUTPUT_FORMATS[output_format])
 
     # inform the output directory
     sys.stderr.write(TextColor.GREEN + "INFO: " + TextColor.END + "OUTPUT FILE: " + output_filename + "\n")
 
+    # parse the regions before we start so we fail early on a typo
+    if regions is not None:
+        regions = [ImageIndex.parse_region(region) for region in regions]
+
     # call the predict method to generate the prediction hdf5 file
-    predict(image_filepath, output_filename, model_path, batch_size, num_workers, threads, gpu_mode)
+    predict(image_filepath, output_filename, model_path, batch_size, num_workers, threads, gpu_mode, inference_mode,
+            inference_processes, precision, resume, contigs, regions, mask_bed,
+            profile_batches=profile_batches, loader=loader)
 
     # notify the user that process has completed successfully
     sys.stderr.write(TextColor.GREEN + "INFO: " + TextColor.END + "PREDICTION GENERATED SUCCESSFULLY.\n")
@@ -80,7 +100,9 @@ if __name__ == '__main__':
         "--model_path",
         type=str,
         required=True,
-        help="[REQUIRED] Path to a trained model (pkl file). Please see our github page to see options."
+        help="[REQUIRED] Path to a trained model (pkl file), or a model exported with export_model.py (pt or onnx "
+             "file). onnx models have to be exported with the --inference_mode used here. Please see our github "
+             "page to see options."
     )
     parser.add_argument(
         "-b",
@@ -96,7 +118,8 @@ if __name__ == '__main__':
         type=int,
         required=False,
         default=0,
-        help="Number of workers to assign to the dataloader. Shouldg be 0 if using Docker."
+        help="Number of workers to assign to the dataloader. Should be 0 if using Docker with the default "
+             "--loader, use --loader mmap to load with workers in Docker."
     )
     parser.add_argument(
         "-t",
@@ -129,6 +152,98 @@ if __name__ == '__main__':
         action='store_true',
         help="If set then PyTorch will use GPUs for inference."
     )
+    parser.add_argument(
+        "--inference_mode",
+        type=str,
+        required=False,
+        default=InferenceOptions.DEFAULT_INFERENCE_MODE,
+        choices=sorted(InferenceOptions.INFERENCE_MODES.keys()),
+        help="Window scheme used to run the model. sliding (default) runs overlapping windows like training, "
+             "single_pass runs non-overlapping windows and full runs the whole image at once. Please check the "
+             "accuracy of a model with compare_inference.py before using single_pass or full."
+    )
+    parser.add_argument(
+        "--inference_processes",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of processes for CPU-only inference, default is 1. The processes share the model and each "
+             "gets threads/inference_processes PyTorch threads. Useful on CPU nodes with many cores."
+    )
+    parser.add_argument(
+        "--precision",
+        type=str,
+        required=False,
+        default=InferenceOptions.DEFAULT_PRECISION,
+        choices=InferenceOptions.PRECISIONS,
+        help="Precision of the model during inference. fp32 (default), bf16 or int8 (dynamic quantization, CPU "
+             "only). Please check the accuracy of a model with compare_inference.py before using bf16 or int8."
+    )
+    parser.add_argument(
+        "--resume",
+        default=False,
+        action='store_true',
+        help="If set and the output file exists, the predictions in the file are kept and only the images that are "
+             "missing from it are predicted. Use this to continue a run that was stopped. Only --output_format "
+             "binary is crash-consistent: an hdf5 file of a run that was killed may not open, then it is moved "
+             "to <file>.corrupt and all the images are predicted again."
+    )
+    parser.add_argument(
+        "--contigs",
+        type=str,
+        nargs='+',
+        required=False,
+        default=None,
+        help="Only predict the images of these contigs, i.e. --contigs contig1 contig2. Default is all contigs."
+    )
+    parser.add_argument(
+        "--region",
+        type=str,
+        nargs='+',
+        required=False,
+        default=None,
+        help="Only predict the images that overlap these regions, in contig:start-end format with 1-based "
+             "inclusive positions, i.e. --region contig1:10000-20000. Can be combined with --contigs."
+    )
+    parser.add_argument(
+        "--mask_bed",
+        type=str,
+        required=False,
+        default=None,
+        help="Path to a BED file of regions that will not be polished, i.e. "
+             "masked_regions/GRCh38_masked_regions.bed for reference guided runs. Images of MarginPolish chunks "
+             "that are fully inside these regions are not predicted, stitch.py fills them with the draft sequence "
+             "or Ns."
+    )
+    parser.add_argument(
+        "--profile_batches",
+        type=int,
+        required=False,
+        default=0,
+        help="Record this many minibatches with the torch profiler and save a Chrome trace next to the output "
+             "file, default is 0 (no profiling). The time spent in each stage is always saved next to the output."
+    )
+    parser.add_argument(
+        "--loader",
+        type=str,
+        required=False,
+        choices=InferenceOptions.LOADERS,
+        default=InferenceOptions.DEFAULT_LOADER,
+        help="How the dataloader workers pass the minibatches. torch: the pytorch DataLoader workers, they pass "
+             "the images through shared memory (/dev/shm), which is too small in a default Docker container. "
+             "mmap: workers pass the images through a memory mapped file in the output directory, use it to load "
+             "with --num_workers in Docker. The file takes about 100KB per image for 2 minibatches per worker "
+             "(0.8GB at -b 512 -w 8) of disk and page cache. Default is torch."
+    )
+    parser.add_argument(
+        "--output_format",
+        type=str,
+        required=False,
+        choices=sorted(InferenceOptions.OUTPUT_FORMATS.keys()),
+        default=InferenceOptions.DEFAULT_OUTPUT_FORMAT,
+        help="Format of the prediction file. hdf5 (default) writes a single .hdf file, binary writes a .bin "
+             "directory of flat column files that stitch.py reads through memory maps."
+    )
     FLAGS, unparsed = parser.parse_known_args()
     FLAGS.output_dir = FileManager.handle_output_directory(FLAGS.output_dir)
 
@@ -140,5 +255,15 @@ if __name__ == '__main__':
                   FLAGS.threads,
                   FLAGS.output_dir,
                   FLAGS.output_prefix,
-                  FLAGS.gpu_mode)
+                  FLAGS.gpu_mode,
+                  FLAGS.inference_mode,
+                  FLAGS.inference_processes,
+                  FLAGS.precision,
+                  FLAGS.resume,
+                  FLAGS.contigs,
+                  FLAGS.region,
+                  FLAGS.mask_bed,
+                  FLAGS.profile_batches,
+                  FLAGS.loader,
+                  FLAGS.output_format)
 
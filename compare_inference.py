@@ -0,0 +1,229 @@
+import argparse
+import json
+import os
+import sys
+import time
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+from modules.python.TextColor import TextColor
+from modules.python.FileManager import FileManager
+from modules.python.Options import ImageSizeOptions, InferenceOptions
+from modules.python.models.dataloader import SequenceDataset
+from modules.python.models.ModelHander import ModelHandler
+from modules.python.models.predict import predict_images
+from modules.python.models.test import TestMetrics
+"""
+The compare inference script measures how the inference modes and model precisions of call_consensus.py compare to
+the sliding window mode and float32 model the models are trained with. It runs a model on a set of labeled images
+generated by MarginPolish and reports for each mode and precision:
+    - base and RLE accuracy against the labels, calculated with the confusion matrices of test.py
+    - how many base and RLE predictions are the same as the sliding window float32 predictions
+    - images per second
+The report is printed and saved as a JSON file in the output directory.
+"""
+
+
+def compare_inference_modes(image_directory, model_path, inference_modes, precisions, batch_size, num_workers,
+                            threads, gpu_mode, output_dir):
+    """
+    Run a model on labeled images with the sliding window mode in float32 and all the given inference modes and
+    precisions and report the accuracy, agreement with the sliding window float32 predictions and throughput of each.
+    :param image_directory: Path to a directory containing labeled images
+    :param model_path: Path to a trained model
+    :param inference_modes: List of inference modes to compare with the sliding window mode
+    :param precisions: List of model precisions to compare with float32
+    :param batch_size: Batch size for minibatch prediction
+    :param num_workers: Number of workers for the dataloader
+    :param threads: Number of threads for pytorch
+    :param gpu_mode: If true, the model will run on GPU
+    :param output_dir: Path to the output directory where the report is saved
+    :return: The report dictionary
+    """
+    torch.set_num_threads(threads)
+    baseline_mode = InferenceOptions.DEFAULT_INFERENCE_MODE
+    baseline_precision = InferenceOptions.DEFAULT_PRECISION
+    inference_modes = [baseline_mode] + [mode for mode in inference_modes if mode != baseline_mode]
+    precisions = [baseline_precision] + [precision for precision in precisions if precision != baseline_precision]
+    # each configuration is a (mode, precision) pair, the first one is the baseline
+    configurations = [(mode, precision) for precision in precisions for mode in inference_modes]
+    configuration_names = [mode + "/" + precision for mode, precision in configurations]
+
+    test_data = SequenceDataset(image_directory)
+    test_loader = DataLoader(test_data, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+
+    # load the model once for each precision
+    transducer_models = {}
+    for precision in precisions:
+        transducer_model, hidden_size, gru_layers, prev_ite = \
+            ModelHandler.load_simple_model(model_path,
+                                           input_channels=ImageSizeOptions.IMAGE_CHANNELS,
+                                           image_features=ImageSizeOptions.IMAGE_HEIGHT,
+                                           seq_len=ImageSizeOptions.SEQ_LENGTH,
+                                           num_base_classes=ImageSizeOptions.TOTAL_BASE_LABELS,
+                                           num_rle_classes=ImageSizeOptions.TOTAL_RLE_LABELS,
+                                           precision=precision)
+        transducer_model.eval()
+        if gpu_mode:
+            transducer_model = torch.nn.DataParallel(transducer_model).cuda()
+        transducer_models[precision] = transducer_model
+
+    # statistics we collect for each of the configurations
+    stats = {name: {'metrics': TestMetrics(ImageSizeOptions.TOTAL_BASE_LABELS, ImageSizeOptions.TOTAL_RLE_LABELS),
+                    'base_agreement': 0,
+                    'rle_agreement': 0,
+                    'time': 0.0}
+             for name in configuration_names}
+    total_images = 0
+    total_columns = 0
+
+    sys.stderr.write(TextColor.GREEN + "INFO: COMPARING INFERENCE MODES: " + ", ".join(configuration_names) + "\n"
+                     + TextColor.END)
+    with torch.no_grad():
+        for images, label_base, label_rle in test_loader:
+            total_images += images.size(0)
+            total_columns += label_base.numel()
+
+            baseline_base_labels, baseline_rle_labels = None, None
+            for (mode, precision), name in zip(configurations, configuration_names):
+                start_time = time.time()
+                base_labels, rle_labels = predict_images(transducer_models[precision], images, mode, gpu_mode)
+                stats[name]['time'] += time.time() - start_time
+
+                stats[name]['metrics'].add(torch.from_numpy(base_labels), label_base, torch.from_numpy(rle_labels),
+                                           label_rle)
+
+                if baseline_base_labels is None:
+                    baseline_base_labels, baseline_rle_labels = base_labels, rle_labels
+                stats[name]['base_agreement'] += int(np.sum(base_labels == baseline_base_labels))
+                stats[name]['rle_agreement'] += int(np.sum(rle_labels == baseline_rle_labels))
+
+    report = {'image_directory': image_directory,
+              'model_path': model_path,
+              'baseline': configuration_names[0],
+              'total_images': total_images,
+              'modes': {}}
+    for (mode, precision), name in zip(configurations, configuration_names):
+        test_metrics = stats[name]['metrics']
+        base_accuracy, rle_accuracy = test_metrics.get_accuracy()
+        report['modes'][name] = {
+            'inference_mode': mode,
+            'precision': precision,
+            'base_accuracy': base_accuracy,
+            'rle_accuracy': rle_accuracy,
+            'base_agreement_with_baseline': 100.0 * stats[name]['base_agreement'] / max(1, total_columns),
+            'rle_agreement_with_baseline': 100.0 * stats[name]['rle_agreement'] / max(1, total_columns),
+            'images_per_second': total_images / max(1e-9, stats[name]['time']),
+            'base_confusion_matrix': test_metrics.base_confusion_matrix.value().tolist(),
+            'rle_confusion_matrix': test_metrics.rle_confusion_matrix.value().tolist(),
+        }
+
+    # print a summary of the report
+    sys.stderr.write(TextColor.BLUE + "{:<17} {:>10} {:>10} {:>12} {:>12} {:>12}\n".format(
+        "MODE", "BASE_ACC", "RLE_ACC", "BASE_AGREE", "RLE_AGREE", "IMAGES/SEC") + TextColor.END)
+    for name in configuration_names:
+        mode_report = report['modes'][name]
+        sys.stderr.write("{:<17} {:>10.4f} {:>10.4f} {:>12.4f} {:>12.4f} {:>12.2f}\n".format(
+            name, mode_report['base_accuracy'], mode_report['rle_accuracy'],
+            mode_report['base_agreement_with_baseline'], mode_report['rle_agreement_with_baseline'],
+            mode_report['images_per_second']))
+
+    report_filename = os.path.join(output_dir, "inference_comparison.json")
+    with open(report_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    sys.stderr.write(TextColor.GREEN + "INFO: REPORT SAVED TO: " + report_filename + "\n" + TextColor.END)
+
+    return report
+
+
+if __name__ == '__main__':
+    '''
+    Processes arguments and performs tasks.
+    '''
+    parser = argparse.ArgumentParser(description="compare_inference.py compares the accuracy and speed of the "
+                                                 "inference modes and model precisions of call_consensus.py with the "
+                                                 "sliding window mode and float32 model on a set of labeled images.")
+    parser.add_argument(
+        "-i",
+        "--image_file",
+        type=str,
+        required=True,
+        help="[REQUIRED] Path to a directory where all the labeled MarginPolish images are."
+    )
+    parser.add_argument(
+        "-m",
+        "--model_path",
+        type=str,
+        required=True,
+        help="[REQUIRED] Path to a trained model (pkl file)."
+    )
+    parser.add_argument(
+        "--inference_modes",
+        type=str,
+        nargs='+',
+        required=False,
+        default=[mode for mode in sorted(InferenceOptions.INFERENCE_MODES.keys())
+                 if mode != InferenceOptions.DEFAULT_INFERENCE_MODE],
+        choices=sorted(InferenceOptions.INFERENCE_MODES.keys()),
+        help="Inference modes to compare with the sliding window mode. Default is all of them."
+    )
+    parser.add_argument(
+        "--precisions",
+        type=str,
+        nargs='+',
+        required=False,
+        default=[InferenceOptions.DEFAULT_PRECISION],
+        choices=InferenceOptions.PRECISIONS,
+        help="Model precisions to compare with float32, i.e. --precisions bf16 int8. Default is only fp32."
+    )
+    parser.add_argument(
+        "-b",
+        "--batch_size",
+        type=int,
+        required=False,
+        default=512,
+        help="Batch size for testing, default is 512."
+    )
+    parser.add_argument(
+        "-w",
+        "--num_workers",
+        type=int,
+        required=False,
+        default=0,
+        help="Number of workers to assign to the dataloader."
+    )
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        required=False,
+        default=1,
+        help="Number of PyTorch threads to use, default is 1."
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        type=str,
+        required=False,
+        default='./output/',
+        help="Path to the output directory."
+    )
+    parser.add_argument(
+        "-g",
+        "--gpu_mode",
+        default=False,
+        action='store_true',
+        help="If set then PyTorch will use GPUs for inference."
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.output_dir = FileManager.handle_output_directory(FLAGS.output_dir)
+
+    compare_inference_modes(FLAGS.image_file,
+                            FLAGS.model_path,
+                            FLAGS.inference_modes,
+                            FLAGS.precisions,
+                            FLAGS.batch_size,
+                            FLAGS.num_workers,
+                            FLAGS.threads,
+                            FLAGS.gpu_mode,
+                            FLAGS.output_dir)
@@ -0,0 +1,121 @@
+import argparse
+import os
+import sys
+from modules.python.TextColor import TextColor
+from modules.python.FileManager import FileManager
+from modules.python.Options import ImageSizeOptions, InferenceOptions
+from modules.python.models.ModelHander import ModelHandler
+"""
+The export model script converts a trained HELEN model (pkl file) to formats that can be used for inference without
+the python model code:
+    - torchscript: A TorchScript module (.pt) that runs with the TorchScript interpreter.
+    - onnx: An ONNX graph (.onnx) that runs with onnxruntime and numpy, without pytorch.
+    - slim: A pytorch checkpoint (_inference.pkl) with only the weights and the architecture of the model, optionally
+            in float16. It loads faster than the training checkpoint and runs like it.
+The torchscript module keeps the hidden input and output of the model, so it is run one window at a time like the
+pytorch model. The onnx graph runs all the windows of the images with the hidden state carried between them and
+returns the label of each column, so a minibatch is predicted with one call. The window scheme of the onnx graph is
+fixed when it is exported, predict it with the same --inference_mode. call_consensus.py picks the backend from the
+extension of the model file.
+"""
+
+
+def export_model(model_path, output_dir, output_prefix, export_formats, half=False,
+                 inference_mode=InferenceOptions.DEFAULT_INFERENCE_MODE):
+    """
+    Load a trained model and export it to the given formats.
+    :param model_path: Path to a trained model (pkl file)
+    :param output_dir: Path to the output directory
+    :param output_prefix: Prefix of the exported model files
+    :param export_formats: List of formats to export, torchscript, onnx and/or slim
+    :param half: If true, the weights of the slim checkpoint are stored in float16
+    :param inference_mode: Window scheme of the onnx graph, one of InferenceOptions.INFERENCE_MODES
+    :return:
+    """
+    transducer_model, hidden_size, gru_layers, prev_ite = \
+        ModelHandler.load_simple_model(model_path,
+                                       input_channels=ImageSizeOptions.IMAGE_CHANNELS,
+                                       image_features=ImageSizeOptions.IMAGE_HEIGHT,
+                                       seq_len=ImageSizeOptions.SEQ_LENGTH,
+                                       num_base_classes=ImageSizeOptions.TOTAL_BASE_LABELS,
+                                       num_rle_classes=ImageSizeOptions.TOTAL_RLE_LABELS)
+    transducer_model.eval()
+
+    for export_format in export_formats:
+        if export_format == 'torchscript':
+            output_filename = os.path.join(output_dir, output_prefix + '.pt')
+            ModelHandler.export_torchscript(transducer_model, output_filename)
+        elif export_format == 'slim':
+            output_filename = os.path.join(output_dir, output_prefix + '_inference.pkl')
+            ModelHandler.save_inference_checkpoint(transducer_model, hidden_size, gru_layers, prev_ite,
+                                                   output_filename, half)
+        else:
+            output_filename = os.path.join(output_dir, output_prefix + '.onnx')
+            ModelHandler.export_onnx(transducer_model, output_filename, inference_mode)
+
+        sys.stderr.write(TextColor.GREEN + "INFO: " + export_format.upper() + " MODEL SAVED TO: " + output_filename
+                         + "\n" + TextColor.END)
+
+
+if __name__ == '__main__':
+    '''
+    Processes arguments and performs tasks.
+    '''
+    parser = argparse.ArgumentParser(description="export_model.py converts a trained HELEN model to a TorchScript "
+                                                 "module and/or an ONNX graph that call_consensus.py can run on CPU, "
+                                                 "or to a slim inference checkpoint.")
+    parser.add_argument(
+        "-m",
+        "--model_path",
+        type=str,
+        required=True,
+        help="[REQUIRED] Path to a trained model (pkl file)."
+    )
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        type=str,
+        required=False,
+        default='./output/',
+        help="Path to the output directory."
+    )
+    parser.add_argument(
+        "-p",
+        "--output_prefix",
+        type=str,
+        required=False,
+        default="HELEN_model",
+        help="Prefix for the exported model files. Default is: HELEN_model"
+    )
+    parser.add_argument(
+        "-f",
+        "--formats",
+        type=str,
+        nargs='+',
+        required=False,
+        default=['torchscript', 'onnx'],
+        choices=['torchscript', 'onnx', 'slim'],
+        help="Formats to export the model to. Default is both torchscript and onnx. slim saves a checkpoint with "
+             "only the weights needed for inference."
+    )
+    parser.add_argument(
+        "--half",
+        default=False,
+        action='store_true',
+        help="If set then the weights of the slim checkpoint are stored in float16, which halves its size. The "
+             "weights are cast back to float32 when the model is loaded."
+    )
+    parser.add_argument(
+        "--inference_mode",
+        type=str,
+        required=False,
+        default=InferenceOptions.DEFAULT_INFERENCE_MODE,
+        choices=sorted(InferenceOptions.INFERENCE_MODES.keys()),
+        help="Window scheme of the onnx graph, the windows are part of the graph so the model has to be predicted "
+             "with the same --inference_mode. Default is: " + InferenceOptions.DEFAULT_INFERENCE_MODE
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.output_dir = FileManager.handle_output_directory(FLAGS.output_dir)
+
+    export_model(FLAGS.model_path, FLAGS.output_dir, FLAGS.output_prefix, FLAGS.formats, FLAGS.half,
+                 FLAGS.inference_mode)
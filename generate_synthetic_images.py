@@ -0,0 +1,92 @@
+import argparse
+import sys
+from modules.python.TextColor import TextColor
+from modules.python.FileManager import FileManager
+from modules.python.SyntheticImages import SyntheticImages
+"""
+The generate synthetic images script writes hdf5 files with random images in the same layout as MarginPolish. The
+images can be used to measure the speed of call_consensus.py and stitch.py without running MarginPolish. The
+predictions made on these images are meaningless.
+"""
+
+
+if __name__ == '__main__':
+    '''
+    Processes arguments and performs tasks.
+    '''
+    parser = argparse.ArgumentParser(description="generate_synthetic_images.py writes random images in the "
+                                                 "MarginPolish layout for benchmarking HELEN.")
+    parser.add_argument(
+        "-o",
+        "--output_dir",
+        type=str,
+        required=True,
+        help="[REQUIRED] Path to the output directory."
+    )
+    parser.add_argument(
+        "-f",
+        "--total_files",
+        type=int,
+        required=False,
+        default=4,
+        help="Number of hdf5 files to write, default is 4."
+    )
+    parser.add_argument(
+        "-c",
+        "--total_contigs",
+        type=int,
+        required=False,
+        default=2,
+        help="Number of contigs, default is 2."
+    )
+    parser.add_argument(
+        "-l",
+        "--contig_length",
+        type=int,
+        required=False,
+        default=100000,
+        help="Length of each contig in bases, default is 100000."
+    )
+    parser.add_argument(
+        "--chunk_size",
+        type=int,
+        required=False,
+        default=1000,
+        help="Size of the MarginPolish chunks in bases, default is 1000. Together with --insert_fraction this sets "
+             "the number and length of the images of a chunk."
+    )
+    parser.add_argument(
+        "--chunk_overlap",
+        type=int,
+        required=False,
+        default=200,
+        help="Number of bases adjacent chunks overlap, default is 200."
+    )
+    parser.add_argument(
+        "--insert_fraction",
+        type=float,
+        required=False,
+        default=0.2,
+        help="Fraction of the columns that are inserts, default is 0.2."
+    )
+    parser.add_argument(
+        "--with_labels",
+        default=False,
+        action='store_true',
+        help="If set then random labels are saved with the images so they can be used with train.py and test.py."
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        required=False,
+        default=0,
+        help="Seed of the random number generator, default is 0."
+    )
+    FLAGS, unparsed = parser.parse_known_args()
+    FLAGS.output_dir = FileManager.handle_output_directory(FLAGS.output_dir)
+
+    synthetic_images = SyntheticImages(FLAGS.total_contigs, FLAGS.contig_length, FLAGS.chunk_size,
+                                       FLAGS.chunk_overlap, FLAGS.insert_fraction, FLAGS.seed)
+    total_images, total_columns = synthetic_images.generate(FLAGS.output_dir, FLAGS.total_files, FLAGS.with_labels)
+    sys.stderr.write(TextColor.GREEN + "INFO: WROTE " + str(total_images) + " IMAGES WITH " + str(total_columns)
+                     + " COLUMNS TO: " + FLAGS.output_dir + "\n" + TextColor.END)
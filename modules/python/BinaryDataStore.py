@@ -0,0 +1,353 @@
+import os
+import json
+import shutil
+import numpy as np
+from modules.python.DataStore import DataStore
+
+
+class BinaryDataStore(DataStore):
+    """
+    Saves the predictions in a directory of flat binary files, one file per array of each contig:
+        layout.json                  layout of the store and the names of the contigs
+        <contig_id>.inserts          (columns,) uint8 insert index of each column
+        <contig_id>.segments         the segment table of the contig, with inserts it encodes the positions
+        <contig_id>.bases            (columns,) uint8 predicted base of each column
+        <contig_id>.rles             (columns,) uint8 predicted run-length of each column
+        <contig_id>.images           the image table of the contig as little-endian int64 rows
+        <contig_id>.masked           the masked table of the contig as little-endian int64 rows
+        <contig_id>.regions          the region table of the contig, written when the store is closed
+    The contig id is the index of the contig in the contig list of layout.json, so contig names don't have to be
+    valid file names. The files have no header, the predictions are appended to their ends, and the image table is
+    the index of the column files.
+
+    When the store is read, the column files are memory mapped, so reading a chunk copies nothing more than the
+    columns of the chunk and the stitch processes can read the same store in parallel without locks.
+    """
+    # layout of the store, stores with another layout were written by another version
+    _layout_ = 'flat_binary'
+    _layout_version_ = 2
+    _layout_filename_ = 'layout.json'
+    # dtype of the values in each file of a contig, the shape of a column is the shape of one row in the file
+    _file_dtypes_ = {'inserts': (np.dtype('u1'), ()),
+                     'bases': (np.dtype('u1'), ()),
+                     'rles': (np.dtype('u1'), ()),
+                     'images': (DataStore._image_dtype_.newbyteorder('<'), ()),
+                     'masked': (DataStore._masked_dtype_.newbyteorder('<'), ()),
+                     'segments': (DataStore._segment_dtype_.newbyteorder('<'), ()),
+                     'regions': (DataStore._region_dtype_.newbyteorder('<'), ())}
+    _column_keys_ = ('inserts', 'bases', 'rles')
+    # files that are appended to, the region file is replaced when the store is closed
+    _append_keys_ = _column_keys_ + ('segments', 'images', 'masked')
+
+    def __init__(self, filename, mode='r'):
+        """
+        Object initialization function
+        :param filename: Path to the directory of the store, it should end with .bin
+        :param mode: 'w' for write, 'r' for read and 'a' to add predictions to an existing store.
+        """
+        super(BinaryDataStore, self).__init__(filename, mode)
+        self.layout_filename = os.path.join(self.filename, self._layout_filename_)
+
+        # contig name -> contig id
+        self._contig_ids = {}
+        # contig -> key -> file opened for appending, only when we write
+        self._append_files = {}
+        # contig -> number of columns in the column files, only when we write
+        self._column_counts = {}
+        # contig -> key -> memory mapped column file, only when we read
+        self._column_maps = {}
+
+        if self.mode == 'w':
+            if os.path.exists(self.filename):
+                if not os.path.isfile(self.layout_filename):
+                    raise ValueError("CAN NOT OVERWRITE, PATH EXISTS AND IS NOT A PREDICTION STORE: " + self.filename)
+                shutil.rmtree(self.filename)
+            os.makedirs(self.filename)
+            self._write_layout()
+        elif self.mode == 'a' and not os.path.exists(self.filename):
+            os.makedirs(self.filename)
+            self._write_layout()
+        else:
+            self._read_layout()
+
+        # when we add to an existing store, find out which predictions are already in it
+        if self.mode == 'a':
+            self.load_stored_predictions()
+
+    def _write_layout(self):
+        """
+        Write the layout and the contig names of the store. The file is replaced in one step, so a crash leaves the
+        old or the new contig list.
+        :return:
+        """
+        contigs = sorted(self._contig_ids, key=self._contig_ids.get)
+        temporary_filename = self.layout_filename + '.tmp'
+        with open(temporary_filename, 'w') as layout_file:
+            json.dump({'layout': self._layout_, 'layout_version': self._layout_version_, 'contigs': contigs},
+                      layout_file)
+            layout_file.flush()
+            os.fsync(layout_file.fileno())
+        os.replace(temporary_filename, self.layout_filename)
+
+    def _read_layout(self):
+        """
+        Read the contig names of the store and check that the store is saved in the layout we read. A path without a
+        layout raises an OSError, like h5py does for a file that is not an hdf5 file.
+        :return:
+        """
+        if not os.path.isfile(self.layout_filename):
+            raise OSError("NOT A PREDICTION STORE: " + self.filename)
+        with open(self.layout_filename) as layout_file:
+            layout = json.load(layout_file)
+        if layout.get('layout') != self._layout_ or layout.get('layout_version') != self._layout_version_:
+            raise ValueError("UNSUPPORTED PREDICTION FILE LAYOUT, THE FILE WAS WRITTEN BY ANOTHER VERSION OF HELEN. "
+                             "PLEASE RUN call_consensus.py AGAIN: " + self.filename)
+        self._contig_ids = {contig: contig_id for contig_id, contig in enumerate(layout['contigs'])}
+
+    def _get_path(self, contig, key):
+        """
+        Returns the path to a file of a contig.
+        :param contig: Name of the contig
+        :param key: inserts, bases, rles, segments, images, masked or regions
+        :return: Path to the file
+        """
+        return os.path.join(self.filename, str(self._contig_ids[contig]) + '.' + key)
+
+    def _get_file_rows(self, contig, key):
+        """
+        Returns the number of complete rows in a file of a contig.
+        :param contig: Name of the contig
+        :param key: inserts, bases, rles, segments, images, masked or regions
+        :return: Number of rows
+        """
+        dtype, shape = self._file_dtypes_[key]
+        path = self._get_path(contig, key)
+        return os.path.getsize(path) // (dtype.itemsize * int(np.prod(shape))) if os.path.exists(path) else 0
+
+    def _read_file(self, contig, key):
+        """
+        Read a whole file of a contig.
+        :param contig: Name of the contig
+        :param key: inserts, bases, rles, segments, images, masked or regions
+        :return: Array of the rows of the file
+        """
+        dtype, shape = self._file_dtypes_[key]
+        total_rows = self._get_file_rows(contig, key)
+        with open(self._get_path(contig, key), 'rb') as binary_file:
+            values = np.fromfile(binary_file, dtype=dtype, count=total_rows * int(np.prod(shape)))
+        return values.reshape((total_rows,) + shape)
+
+    def _get_append_file(self, contig, key):
+        """
+        Returns the file of a contig opened for appending, adding the contig to the store if it is new.
+        :param contig: Name of the contig
+        :param key: inserts, bases, rles, segments, images or masked
+        :return: A binary file object
+        """
+        if contig not in self._contig_ids:
+            self._contig_ids[contig] = len(self._contig_ids)
+            self._column_counts[contig] = 0
+            # create all the files of the contig, so every contig in the layout can be read
+            for file_key in self._append_keys_:
+                open(self._get_path(contig, file_key), 'ab').close()
+            self._write_layout()
+
+        contig_files = self._append_files.setdefault(contig, {})
+        if key not in contig_files:
+            contig_files[key] = open(self._get_path(contig, key), 'ab')
+        return contig_files[key]
+
+    def _append_columns(self, contig, inserts, bases, rles):
+        """
+        Append columns to the column files of a contig.
+        :param contig: Name of the contig
+        :param inserts: (columns,) uint8 array
+        :param bases: (columns,) uint8 array
+        :param rles: (columns,) uint8 array
+        :return: Offset of the first appended column
+        """
+        for key, values in zip(self._column_keys_, (inserts, bases, rles)):
+            append_file = self._get_append_file(contig, key)
+            append_file.write(np.ascontiguousarray(values, dtype=self._file_dtypes_[key][0]).tobytes())
+
+        offset = self._column_counts[contig]
+        self._column_counts[contig] += len(bases)
+        return offset
+
+    def _append_segments(self, contig, segment_rows):
+        """
+        Append rows to the segment file of a contig.
+        :param contig: Name of the contig
+        :param segment_rows: Structured array of _segment_dtype_
+        :return:
+        """
+        self._get_append_file(contig, 'segments').write(
+            segment_rows.astype(self._file_dtypes_['segments'][0]).tobytes())
+
+    def _append_images(self, contig, image_rows):
+        """
+        Append rows to the image file of a contig. The column and segment files are flushed first, so a row in the
+        image file always points to columns that are in the column files.
+        :param contig: Name of the contig
+        :param image_rows: Structured array of _image_dtype_
+        :return:
+        """
+        for key in self._column_keys_ + ('segments',):
+            self._get_append_file(contig, key).flush()
+        self._get_append_file(contig, 'images').write(image_rows.astype(self._file_dtypes_['images'][0]).tobytes())
+
+    def _append_masked(self, contig, masked_rows):
+        """
+        Append rows to the masked file of a contig.
+        :param contig: Name of the contig
+        :param masked_rows: Structured array of _masked_dtype_
+        :return:
+        """
+        self._get_append_file(contig, 'masked').write(masked_rows.astype(self._file_dtypes_['masked'][0]).tobytes())
+
+    def _remove_incomplete_predictions(self):
+        """
+        Truncate the files of each contig to their complete rows, the column files to the end of the last image in
+        the image file and the segment file to the segments that start before it.
+        :return: Largest number of columns removed from a contig
+        """
+        removed_columns = 0
+        for contig in self._contig_ids:
+            for key in ('segments', 'images', 'masked'):
+                dtype, _ = self._file_dtypes_[key]
+                self._truncate(contig, key, self._get_file_rows(contig, key) * dtype.itemsize)
+
+            image_table = self._read_image_table(contig)
+            total_columns = int(np.max(image_table['offset'] + image_table['length'])) if len(image_table) else 0
+            for key in self._column_keys_:
+                dtype, shape = self._file_dtypes_[key]
+                column_bytes = dtype.itemsize * int(np.prod(shape))
+                if os.path.getsize(self._get_path(contig, key)) > total_columns * column_bytes:
+                    removed_columns = max(removed_columns, self._get_file_rows(contig, key) - total_columns)
+                    self._truncate(contig, key, total_columns * column_bytes)
+            total_segments = int(np.searchsorted(self._read_file(contig, 'segments')['offset'], total_columns))
+            self._truncate(contig, 'segments', total_segments * self._file_dtypes_['segments'][0].itemsize)
+            self._column_counts[contig] = total_columns
+        return removed_columns
+
+    def _truncate(self, contig, key, size):
+        """
+        Truncate a file of a contig if it is larger than the given size.
+        :param contig: Name of the contig
+        :param key: inserts, bases, rles, segments, images or masked
+        :param size: Size of the file in bytes
+        :return:
+        """
+        path = self._get_path(contig, key)
+        if os.path.getsize(path) > size:
+            os.truncate(path, size)
+
+    def flush(self):
+        """
+        Write everything that is buffered to the files, so a crash after this point does not lose the predictions
+        written so far.
+        :return:
+        """
+        for contig_files in self._append_files.values():
+            for append_file in contig_files.values():
+                append_file.flush()
+
+    def close(self):
+        """
+        Write the region tables if we wrote to the store and close the files of the store.
+        :return:
+        """
+        if self.mode != 'r':
+            self.flush()
+            self.write_region_tables()
+        for contig_files in self._append_files.values():
+            for append_file in contig_files.values():
+                append_file.close()
+        self._append_files = {}
+        self._column_maps = {}
+
+    def get_contigs(self):
+        """
+        Returns the names of the contigs that have predictions or masked chunks in the store.
+        :return: Sorted list of contig names
+        """
+        return sorted(self._contig_ids)
+
+    def _read_image_table(self, contig):
+        """
+        Read the image table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _image_dtype_
+        """
+        return self._read_file(contig, 'images').astype(self._image_dtype_)
+
+    def _read_masked_table(self, contig):
+        """
+        Read the masked table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _masked_dtype_
+        """
+        return self._read_file(contig, 'masked').astype(self._masked_dtype_)
+
+    def _read_region_table(self, contig):
+        """
+        Read the region table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _region_dtype_, None if the contig has no region table
+        """
+        if not os.path.exists(self._get_path(contig, 'regions')):
+            return None
+        return self._read_file(contig, 'regions').astype(self._region_dtype_)
+
+    def _write_region_table(self, contig, region_table):
+        """
+        Write the region table of a contig. The file is replaced in one step, so a crash leaves the old or the new
+        table.
+        :param contig: Name of the contig
+        :param region_table: Structured array of _region_dtype_
+        :return:
+        """
+        path = self._get_path(contig, 'regions')
+        with open(path + '.tmp', 'wb') as region_file:
+            region_file.write(region_table.astype(self._file_dtypes_['regions'][0]).tobytes())
+        os.replace(path + '.tmp', path)
+
+    def _get_column_maps(self, contig):
+        """
+        Returns the memory mapped column files of a contig, the files are mapped once.
+        :param contig: Name of the contig
+        :return: Dictionary of key -> memory mapped array of the columns
+        """
+        if contig not in self._column_maps:
+            self.flush()
+            column_maps = {}
+            for key in self._column_keys_:
+                dtype, shape = self._file_dtypes_[key]
+                total_rows = self._get_file_rows(contig, key)
+                if total_rows == 0:
+                    # an empty file can not be mapped
+                    column_maps[key] = np.zeros((0,) + shape, dtype=dtype)
+                else:
+                    column_maps[key] = np.memmap(self._get_path(contig, key), dtype=dtype, mode='r',
+                                                 shape=(total_rows,) + shape)
+            self._column_maps[contig] = column_maps
+        return self._column_maps[contig]
+
+    def _read_segment_table(self, contig):
+        """
+        Read the segment table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _segment_dtype_
+        """
+        return self._read_file(contig, 'segments').astype(self._segment_dtype_)
+
+    def _read_encoded_columns(self, contig, column_start, column_end):
+        """
+        Read a range of the columns of a contig from the memory mapped column files.
+        :param contig: Name of the contig
+        :param column_start: First column of the range
+        :param column_end: End of the range, exclusive
+        :return: Inserts, bases and rles of the columns
+        """
+        column_maps = self._get_column_maps(contig)
+        return tuple(np.asarray(column_maps[key][column_start:column_end]) for key in self._column_keys_)
@@ -1,41 +1,116 @@
-import h5py
-import yaml
+import os
+import sys
+import abc
 import numpy as np
+from collections import defaultdict
+from modules.python.TextColor import TextColor
 
 
-class DataStore(object):
+class DataStore(abc.ABC):
     """
     This DataStore handles how we write an intermediate prediction file which we can use in stitch so we can
     do the stitching in parallel. The intended use of this object is to open under "with" statement.
+
+    DataStore is the interface of the prediction stores, DataStore.open opens a store with the backend that matches
+    its path:
+        HDF5DataStore      an hdf5 file, the default
+        BinaryDataStore    a directory ending with .bin of flat binary files that are memory mapped when read
+
+    Every backend saves the predictions of all the images of a contig together:
+        inserts    (columns,) uint8 insert index of each column, the positions are encoded with the segment table
+        segments   one row per segment of columns: offset of the first column of the segment and its genomic
+                   position, insert index and split index
+        bases      (columns,) uint8 predicted base of each column
+        rles       (columns,) uint8 predicted run-length of each column
+        images     one row per image: contig_start, contig_end, chunk_id and the offset and length of the columns
+                   of the image in the column arrays
+        masked     one row per masked MarginPolish chunk: contig_start, contig_end
+        regions    one row per MarginPolish chunk (region) with predictions, sorted by contig_start and contig_end:
+                   contig_start, contig_end, the number of images of the region and the offset and length of the
+                   columns of the region when the columns are read region by region, see read_contig
+    The predictions are appended to these arrays and only the real columns of an image are saved, the padding at the
+    end of short images is dropped. The columns of an image are written before its row in the image table, so a row
+    always points to complete columns.
+
+    The positions (genomic position, insert index, split index) of the columns are not saved, they take 12 bytes per
+    column and almost always follow each other: a column is either the next insert of the position before it or the
+    first column of the next genomic position. A segment is a run of columns that follow each other like this, its
+    first position is saved in the segment table and only the insert index of the other columns is saved. The
+    genomic position of a column is the position of its segment plus the number of columns with insert index 0 since
+    the start of the segment. A column starts a new segment when it does not follow the column before it, when its
+    insert index does not fit in a byte, when the segment is _max_segment_columns_ long, and at the start of every
+    write. See encode_positions and decode_positions.
+
+    The image and masked tables are the index of the store, they are appended with every batch. When we write, the
+    keys of the stored images are also kept in hashed sets, so we can check if an image is already stored without
+    reading the store. The region table is written when the store is closed, a store that was not closed (or was
+    written by an older version) has its region table built from the image table when it is read.
     """
-    # path to all the predictions in the HDF file.
-    _prediction_path_ = 'predictions'
-    # values that we save in the file
-    _groups_ = ('position', 'index', 'bases', 'rles')
+    # extension of the stores of each backend, every other path is an hdf5 file
+    _backend_extensions_ = {'.bin': 'binary'}
+    # rows of the image and masked tables
+    _image_dtype_ = np.dtype([('contig_start', np.int64), ('contig_end', np.int64), ('chunk_id', np.int64),
+                              ('offset', np.int64), ('length', np.int64)])
+    _masked_dtype_ = np.dtype([('contig_start', np.int64), ('contig_end', np.int64)])
+    _region_dtype_ = np.dtype([('contig_start', np.int64), ('contig_end', np.int64), ('total_images', np.int64),
+                               ('offset', np.int64), ('length', np.int64)])
+    _segment_dtype_ = np.dtype([('offset', np.int64), ('position', np.int64), ('index', np.int64),
+                                ('split', np.int64)])
+    # largest insert index saved in the inserts array and the largest number of columns in a segment, a read that
+    # starts in the middle of a segment reads the segment from its start
+    _max_insert_index_ = 255
+    _max_segment_columns_ = 65536
 
     def __init__(self, filename, mode='r'):
         """
-        Object initialization function
+        Object initialization function, the backends open the store after this.
         :param filename: Name of the function where to save the data
-        :param mode: 'w' for write and 'r' for read.
+        :param mode: 'w' for write, 'r' for read and 'a' to add predictions to an existing store.
         """
         # set the filename and mode
         self.filename = filename
         self.mode = mode
 
-        self._sample_keys = set()
-        # set the file handler
-        self.file_handler = h5py.File(self.filename, self.mode)
+        # contig -> image table, region table and segment table, loaded once when the predictions are read
+        self._image_tables = {}
+        self._region_tables = {}
+        self._segment_tables = {}
+        # contig -> set of (contig_start, contig_end, chunk_id) of the stored images and set of
+        # (contig_start, contig_end) of the stored masked chunks, only kept when we write
+        self._stored_images = defaultdict(set)
+        self._masked_chunks = defaultdict(set)
+
+    @staticmethod
+    def get_backend(filename):
+        """
+        Returns the backend of a prediction store from its path.
+        :param filename: Path to the prediction store
+        :return: 'binary' or 'hdf5'
+        """
+        extension = os.path.splitext(os.path.normpath(filename))[1].lower()
+        return DataStore._backend_extensions_.get(extension, 'hdf5')
+
+    @staticmethod
+    def open(filename, mode='r'):
+        """
+        Open a prediction store with the backend that matches its path.
+        :param filename: Path to the prediction store
+        :param mode: 'w' for write, 'r' for read and 'a' to add predictions to an existing store.
+        :return: A DataStore object
+        """
+        # the backends import this module, so they are imported here
+        if DataStore.get_backend(filename) == 'binary':
+            from modules.python.BinaryDataStore import BinaryDataStore
+            return BinaryDataStore(filename, mode)
 
-        self._meta = None
+        from modules.python.HDF5DataStore import HDF5DataStore
+        return HDF5DataStore(filename, mode)
 
     def __enter__(self):
         """
         This method is invoked when we open an object under "with" statement.
         :return:
         """
-        self.file_handler = h5py.File(self.filename, self.mode)
-
         return self
 
     def __exit__(self, *args):
@@ -44,47 +119,304 @@ class DataStore(object):
         :param args:
         :return:
         """
-        # we are not actively using the metadata now, we can remove this from the initial version
-        if self.mode != 'r' and self._meta is not None:
-            self.write_metadata(self.meta)
-        self.file_handler.close()
+        self.close()
+
+    @abc.abstractmethod
+    def close(self):
+        """
+        Close the store.
+        :return:
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def flush(self):
+        """
+        Write everything that is buffered to the disk, so a crash after this point does not lose the predictions
+        written so far.
+        :return:
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def get_contigs(self):
+        """
+        Returns the names of the contigs that have predictions or masked chunks in the store.
+        :return: Sorted list of contig names
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _read_image_table(self, contig):
+        """
+        Read the image table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _image_dtype_
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _read_masked_table(self, contig):
+        """
+        Read the masked table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _masked_dtype_
+        """
+        raise NotImplementedError
 
-    def write_metadata(self, data):
+    @abc.abstractmethod
+    def _read_region_table(self, contig):
         """
-        Save a data structure to file within a yml str.
-        :param data: a dictionary containing metadata values
+        Read the region table of a contig that was written when the store was closed.
+        :param contig: Name of the contig
+        :return: Structured array of _region_dtype_, None if the store has no region table for the contig
         """
-        for group, d in data.items():
-            if group in self.file_handler:
-                del self.file_handler[group]
-            self.file_handler[group] = yaml.dump(d)
+        raise NotImplementedError
 
-    def load_metadata(self, groups=None):
+    @abc.abstractmethod
+    def _write_region_table(self, contig, region_table):
         """
-        Load meta data
+        Write the region table of a contig, replacing the one in the store.
+        :param contig: Name of the contig
+        :param region_table: Structured array of _region_dtype_
+        :return:
         """
-        if groups is None:
-            groups = self._groups_
-        return {g: yaml.load(self.file_handler[g][()]) for g in groups if g in self.file_handler}
+        raise NotImplementedError
 
-    @property
-    def meta(self):
-        if self._meta is None:
-            self._meta = self.load_metadata()
-        return self._meta
+    @abc.abstractmethod
+    def _read_segment_table(self, contig):
+        """
+        Read the segment table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _segment_dtype_
+        """
+        raise NotImplementedError
 
-    def update_meta(self, meta):
+    @abc.abstractmethod
+    def _read_encoded_columns(self, contig, column_start, column_end):
+        """
+        Read a range of the columns of a contig as they are saved.
+        :param contig: Name of the contig
+        :param column_start: First column of the range
+        :param column_end: End of the range, exclusive
+        :return: Inserts, bases and rles of the columns
         """
-        Update metadata
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _append_columns(self, contig, inserts, bases, rles):
+        """
+        Append columns to the column arrays of a contig, creating the contig if it is new.
+        :param contig: Name of the contig
+        :param inserts: (columns,) uint8 array
+        :param bases: (columns,) uint8 array
+        :param rles: (columns,) uint8 array
+        :return: Offset of the first appended column
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _append_segments(self, contig, segment_rows):
         """
-        self._meta = self.meta
-        self._meta.update(meta)
+        Append rows to the segment table of a contig.
+        :param contig: Name of the contig
+        :param segment_rows: Structured array of _segment_dtype_
+        :return:
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _append_images(self, contig, image_rows):
+        """
+        Append rows to the image table of a contig.
+        :param contig: Name of the contig
+        :param image_rows: Structured array of _image_dtype_
+        :return:
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _append_masked(self, contig, masked_rows):
+        """
+        Append rows to the masked table of a contig, creating the contig if it is new.
+        :param contig: Name of the contig
+        :param masked_rows: Structured array of _masked_dtype_
+        :return:
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def _remove_incomplete_predictions(self):
+        """
+        Remove the columns after the last row of the image table of each contig and the segments that start after
+        them, they were written by a run that stopped before it wrote the rows of the images.
+        :return: Largest number of columns removed from a contig
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def get_chunk_names(contig, contig_start, contig_end, chunk_id):
+        """
+        Returns the names we use to save the prediction of an image.
+        :param contig: Name of contig where the image belongs to.
+        :param contig_start: Contig start position of the image.
+        :param contig_end: Contig end position of the image.
+        :param chunk_id: Chunk id from marginpolish to know which chunk the image is from.
+        :return: Chunk name prefix, chunk name suffix and the unique name of the prediction
+        """
+        chunk_name_prefix = str(contig) + "-" + str(int(contig_start)) + "-" + str(int(contig_end))
+        chunk_name_suffix = str(int(chunk_id))
+
+        return chunk_name_prefix, chunk_name_suffix, str(contig) + chunk_name_prefix + chunk_name_suffix
+
+    @staticmethod
+    def encode_positions(positions):
+        """
+        Encode the positions of columns as the insert index of each column and a segment table.
+        :param positions: (columns, 3) array of genomic position, insert index and split index
+        :return: (columns,) uint8 inserts and a structured array of _segment_dtype_ with the offsets of the segments
+                 relative to the first column
+        """
+        positions = np.asarray(positions, dtype=np.int64).reshape(-1, 3)
+        genomic_positions, insert_indices, split_indices = positions[:, 0], positions[:, 1], positions[:, 2]
+        total_columns = len(positions)
+
+        # a column follows the column before it if it is the next insert of the same position or the first column of
+        # the next position
+        follows = np.zeros(total_columns, dtype=bool)
+        follows[1:] = np.logical_and.reduce((split_indices[1:] == split_indices[:-1],
+                                             insert_indices[1:] <= DataStore._max_insert_index_,
+                                             genomic_positions[1:] == genomic_positions[:-1] +
+                                             (insert_indices[1:] == 0)))
+        # split the segments that are too long
+        segment_ids = np.cumsum(np.logical_not(follows)) - 1
+        first_columns = np.flatnonzero(np.logical_not(follows))
+        follows[(np.arange(total_columns) - first_columns[segment_ids]) % DataStore._max_segment_columns_ == 0] = False
+        first_columns = np.flatnonzero(np.logical_not(follows))
+
+        segment_rows = np.zeros(len(first_columns), dtype=DataStore._segment_dtype_)
+        segment_rows['offset'] = first_columns
+        segment_rows['position'] = genomic_positions[first_columns]
+        segment_rows['index'] = insert_indices[first_columns]
+        segment_rows['split'] = split_indices[first_columns]
+        # the first column of a segment takes its insert index from the segment table
+        inserts = np.minimum(insert_indices, DataStore._max_insert_index_).astype(np.uint8)
+        return inserts, segment_rows
+
+    @staticmethod
+    def decode_positions(inserts, segment_rows, column_start):
+        """
+        Decode the positions of a range of columns that starts at the first column of a segment.
+        :param inserts: (columns,) uint8 inserts of the columns
+        :param segment_rows: Structured array of _segment_dtype_ of the segments of the columns
+        :param column_start: Offset of the first column, the offset of the first segment
+        :return: (columns, 3) uint32 array of genomic position, insert index and split index
+        """
+        total_columns = len(inserts)
+        first_columns = segment_rows['offset'] - column_start
+        segment_lengths = np.diff(np.append(first_columns, total_columns))
+
+        insert_indices = inserts.astype(np.int64)
+        insert_indices[first_columns] = segment_rows['index']
+        # the genomic position moves one forward at each column with insert index 0 after the first of the segment
+        position_steps = (insert_indices == 0).astype(np.int64)
+        position_steps[first_columns] = 0
+        position_steps = np.cumsum(position_steps)
+
+        positions = np.zeros((total_columns, 3), dtype=np.uint32)
+        positions[:, 0] = np.repeat(segment_rows['position'] - position_steps[first_columns], segment_lengths) + \
+            position_steps
+        positions[:, 1] = insert_indices
+        positions[:, 2] = np.repeat(segment_rows['split'], segment_lengths)
+        return positions
+
+    def load_stored_predictions(self):
+        """
+        Read the image and masked tables of the store into the sets of stored images and masked chunks. This is used
+        to continue a run that was stopped. The columns of an image are written before its row in the image table,
+        so if the run crashed while a prediction was being written, the columns after the last row are removed and
+        the image will be predicted again.
+        :return: Number of stored images
+        """
+        removed_columns = self._remove_incomplete_predictions()
+        if removed_columns > 0:
+            sys.stderr.write(TextColor.YELLOW + "WARN: REMOVED " + str(removed_columns) +
+                             " COLUMNS OF INCOMPLETE PREDICTIONS FROM: " + self.filename + "\n" + TextColor.END)
+
+        total_images = 0
+        for contig in self.get_contigs():
+            image_table = self._read_image_table(contig)
+            self._stored_images[contig].update(zip(image_table['contig_start'].tolist(),
+                                                   image_table['contig_end'].tolist(),
+                                                   image_table['chunk_id'].tolist()))
+            masked_table = self._read_masked_table(contig)
+            self._masked_chunks[contig].update(zip(masked_table['contig_start'].tolist(),
+                                                   masked_table['contig_end'].tolist()))
+            total_images += len(image_table)
+
+        return total_images
+
+    def is_stored(self, contigs, contig_starts, contig_ends, chunk_ids):
+        """
+        Check which images have a prediction in the store.
+        :param contigs: Contig name of each image
+        :param contig_starts: Contig start positions of the images
+        :param contig_ends: Contig end positions of the images
+        :param chunk_ids: MarginPolish chunk ids of the images
+        :return: Boolean array, true for the images that are stored
+        """
+        return np.array([(contig_start, contig_end, chunk_id) in self._stored_images.get(str(contig), ())
+                         for contig, contig_start, contig_end, chunk_id in
+                         zip(contigs, np.asarray(contig_starts).tolist(), np.asarray(contig_ends).tolist(),
+                             np.asarray(chunk_ids).tolist())], dtype=bool)
+
+    def is_chunk_stored(self, contigs, contig_starts, contig_ends):
+        """
+        Check which images belong to a MarginPolish chunk that has at least one image with a prediction in the store.
+        :param contigs: Contig name of each image
+        :param contig_starts: Contig start positions of the images
+        :param contig_ends: Contig end positions of the images
+        :return: Boolean array, true for the images of chunks that have stored images
+        """
+        stored_chunks = {contig: set((contig_start, contig_end) for contig_start, contig_end, chunk_id in images)
+                         for contig, images in self._stored_images.items()}
+        return np.array([(contig_start, contig_end) in stored_chunks.get(str(contig), ())
+                         for contig, contig_start, contig_end in
+                         zip(contigs, np.asarray(contig_starts).tolist(), np.asarray(contig_ends).tolist())],
+                        dtype=bool)
+
+    def is_chunk_masked(self, contigs, contig_starts, contig_ends):
+        """
+        Check which images belong to a MarginPolish chunk that is saved as masked in the store.
+        :param contigs: Contig name of each image
+        :param contig_starts: Contig start positions of the images
+        :param contig_ends: Contig end positions of the images
+        :return: Boolean array, true for the images of masked chunks
+        """
+        return np.array([(contig_start, contig_end) in self._masked_chunks.get(str(contig), ())
+                         for contig, contig_start, contig_end in
+                         zip(contigs, np.asarray(contig_starts).tolist(), np.asarray(contig_ends).tolist())],
+                        dtype=bool)
+
+    def write_masked_chunk(self, contig, contig_start, contig_end):
+        """
+        Save a MarginPolish chunk that is inside a masked region. We don't predict the images of these chunks, the
+        chunk is saved with its contig start and end so stitch can fill it with the draft sequence.
+        :param contig: Name of contig where the chunk belongs to.
+        :param contig_start: Contig start position of the chunk.
+        :param contig_end: Contig end position of the chunk.
+        :return:
+        """
+        masked_chunk = (int(contig_start), int(contig_end))
+        if masked_chunk not in self._masked_chunks[str(contig)]:
+            self._masked_chunks[str(contig)].add(masked_chunk)
+            self._append_masked(str(contig), np.array([masked_chunk], dtype=self._masked_dtype_))
 
     def write_prediction(self, contig, contig_start, contig_end, chunk_id, position,
                          predicted_bases, predicted_rles, filename):
         """
         This is the method we use to write the data to the HDF file. This method is called by each image we
-        generate.
+        generate. It writes the image as a batch of one, use write_batch to write many images at once.
         :param contig: Name of contig where the image belongs to.
         :param contig_start: Contig start position of the image.
         :param contig_end: Contig end position of the image.
@@ -95,39 +427,287 @@ class DataStore(object):
         :param filename: Name of the file the image belongs to (used for debugging mostly)
         :return:
         """
-        # get a chunk name prefix and suffix
-        chunk_name_prefix = str(contig) + "-" + str(contig_start.item()) + "-" + str(contig_end.item())
-        chunk_name_suffix = str(chunk_id.item())
-
-        name = contig + chunk_name_prefix + chunk_name_suffix
-
-        if 'predictions' not in self.meta:
-            self.meta['predictions'] = set()
-        if 'predictions_contig' not in self.meta:
-            self.meta['predictions_contig'] = set()
-
-        # the way we set up is predictions -> contig -> chunk_name_prefix -> chunk_name_suffix -> image
-        # this way it's easier for stitch.py to grab all the images that belongs to a contig, split them by
-        # chunk name prefix and then stitch the adjacent sequences together.
-
-        # we set-up the contig -> chunk_name_prefix here. This sets up the contig start and end position for
-        # marginpolish chunks
-        if chunk_name_prefix not in self.meta['predictions_contig']:
-            self.meta['predictions_contig'].add(chunk_name_prefix)
-            self.file_handler['{}/{}/{}/{}'.format(self._prediction_path_, contig, chunk_name_prefix, 'contig_start')] \
-                = contig_start.item()
-            self.file_handler['{}/{}/{}/{}'.format(self._prediction_path_, contig, chunk_name_prefix, 'contig_end')] \
-                = contig_end.item()
-
-        # then we save the image predictions at the right place.
-        if name not in self.meta['predictions']:
-            self.meta['predictions'].add(name)
-            self.file_handler['{}/{}/{}/{}/{}'.format(self._prediction_path_, contig, chunk_name_prefix,
-                                                      chunk_name_suffix, 'position')] = np.array(position,
-                                                                                                 dtype=np.uint32)
-            self.file_handler['{}/{}/{}/{}/{}'.format(self._prediction_path_, contig, chunk_name_prefix,
-                                                      chunk_name_suffix, 'bases')] = np.array(predicted_bases,
-                                                                                              dtype=np.uint8)
-            self.file_handler['{}/{}/{}/{}/{}'.format(self._prediction_path_, contig, chunk_name_prefix,
-                                                      chunk_name_suffix, 'rles')] = np.array(predicted_rles,
-                                                                                             dtype=np.uint8)
+        self.write_batch([contig], [contig_start], [contig_end], [chunk_id], np.asarray(position)[np.newaxis],
+                         np.asarray(predicted_bases)[np.newaxis], np.asarray(predicted_rles)[np.newaxis])
+
+    def write_batch(self, contigs, contig_starts, contig_ends, chunk_ids, positions, predicted_bases,
+                    predicted_rles):
+        """
+        Write the predictions of a minibatch of images. The columns of all the images of a contig are appended to
+        the column arrays with one write each and the rows of the images to the image table with one more.
+        :param contigs: Contig name of each image
+        :param contig_starts: Array of the contig start positions of the images
+        :param contig_ends: Array of the contig end positions of the images
+        :param chunk_ids: Array of the MarginPolish chunk ids of the images
+        :param positions: (images, columns, 3) array of the genomic positions of the columns, padded columns have
+                          negative positions
+        :param predicted_bases: (images, columns) array of the predicted base of each column, can have more
+                                images than the other arrays, the extra ones are ignored
+        :param predicted_rles: (images, columns) array of the predicted run-length of each column
+        :return:
+        """
+        total_images = len(contigs)
+        contigs = np.array([str(contig) for contig in contigs], dtype=object)
+        contig_starts = np.asarray(contig_starts, dtype=np.int64)
+        contig_ends = np.asarray(contig_ends, dtype=np.int64)
+        chunk_ids = np.asarray(chunk_ids, dtype=np.int64)
+        positions = np.asarray(positions)[:total_images]
+        predicted_bases = np.asarray(predicted_bases)[:total_images]
+        predicted_rles = np.asarray(predicted_rles)[:total_images]
+
+        # skip the images that are already in the store, and the repeats of an image in the batch
+        is_new = np.zeros(total_images, dtype=bool)
+        for i, image_key in enumerate(zip(contig_starts.tolist(), contig_ends.tolist(), chunk_ids.tolist())):
+            stored_images = self._stored_images[contigs[i]]
+            if image_key not in stored_images:
+                stored_images.add(image_key)
+                is_new[i] = True
+
+        # the padded columns have negative positions, stitch skips them so we don't save them
+        is_real_column = np.logical_and(positions[:, :, 0] >= 0, positions[:, :, 1] >= 0)
+
+        for contig in sorted(set(contigs[is_new])):
+            images = np.flatnonzero(np.logical_and(is_new, contigs == contig))
+            image_real_columns = is_real_column[images]
+            lengths = np.count_nonzero(image_real_columns, axis=1)
+
+            # the columns and their segments are written before the rows of the images, a row always points to
+            # complete columns
+            inserts, segment_rows = self.encode_positions(positions[images][image_real_columns])
+            offset = self._append_columns(contig, inserts,
+                                          predicted_bases[images][image_real_columns].astype(np.uint8),
+                                          predicted_rles[images][image_real_columns].astype(np.uint8))
+            segment_rows['offset'] += offset
+            self._append_segments(contig, segment_rows)
+
+            image_rows = np.zeros(len(images), dtype=self._image_dtype_)
+            image_rows['contig_start'] = contig_starts[images]
+            image_rows['contig_end'] = contig_ends[images]
+            image_rows['chunk_id'] = chunk_ids[images]
+            image_rows['offset'] = offset + np.cumsum(lengths) - lengths
+            image_rows['length'] = lengths
+            self._append_images(contig, image_rows)
+
+    @staticmethod
+    def sort_images(image_table):
+        """
+        Sort an image table by region and chunk id, the order we stitch the images in.
+        :param image_table: Structured array of _image_dtype_
+        :return: The sorted image table
+        """
+        return image_table[np.lexsort((image_table['chunk_id'], image_table['contig_end'],
+                                       image_table['contig_start']))]
+
+    @staticmethod
+    def build_region_table(sorted_image_table):
+        """
+        Build the region table from an image table sorted with sort_images.
+        :param sorted_image_table: Structured array of _image_dtype_ sorted by region and chunk id
+        :return: Structured array of _region_dtype_
+        """
+        contig_starts = sorted_image_table['contig_start']
+        contig_ends = sorted_image_table['contig_end']
+        # the first image of each region
+        first_images = np.flatnonzero(np.concatenate(([True], np.logical_or(contig_starts[1:] != contig_starts[:-1],
+                                                                            contig_ends[1:] != contig_ends[:-1]))))
+        first_images = first_images[first_images < len(sorted_image_table)]
+
+        region_table = np.zeros(len(first_images), dtype=DataStore._region_dtype_)
+        region_table['contig_start'] = contig_starts[first_images]
+        region_table['contig_end'] = contig_ends[first_images]
+        region_table['total_images'] = np.diff(np.append(first_images, len(sorted_image_table)))
+        if len(first_images) > 0:
+            region_table['length'] = np.add.reduceat(sorted_image_table['length'], first_images)
+        region_table['offset'] = np.cumsum(region_table['length']) - region_table['length']
+        return region_table
+
+    def write_region_tables(self):
+        """
+        Write the region table of every contig, this is done when a store that we write to is closed.
+        :return:
+        """
+        for contig in self.get_contigs():
+            self._write_region_table(contig, self.build_region_table(self.sort_images(self._read_image_table(contig))))
+
+    def get_image_table(self, contig):
+        """
+        Returns the image table of a contig. The table is read once and kept.
+        :param contig: Name of the contig
+        :return: Structured array with the contig_start, contig_end, chunk_id, offset and length of each image
+        """
+        if contig not in self._image_tables:
+            self._image_tables[contig] = self._read_image_table(contig)
+        return self._image_tables[contig]
+
+    def get_region_table(self, contig):
+        """
+        Returns the region table of a contig. The table written when the store was closed is used if it still
+        matches the image table, otherwise the table is built from the image table. The table is read once and kept.
+        :param contig: Name of the contig
+        :return: Structured array of _region_dtype_ sorted by contig_start and contig_end
+        """
+        if contig not in self._region_tables:
+            region_table = self._read_region_table(contig)
+            if region_table is None or int(np.sum(region_table['total_images'])) != len(self.get_image_table(contig)):
+                region_table = self.build_region_table(self.sort_images(self.get_image_table(contig)))
+            self._region_tables[contig] = region_table
+        return self._region_tables[contig]
+
+    def get_segment_table(self, contig):
+        """
+        Returns the segment table of a contig. The table is read once and kept.
+        :param contig: Name of the contig
+        :return: Structured array of _segment_dtype_
+        """
+        if contig not in self._segment_tables:
+            self._segment_tables[contig] = self._read_segment_table(contig)
+        return self._segment_tables[contig]
+
+    def _read_columns(self, contig, column_start, column_end):
+        """
+        Read a range of the columns of a contig and decode their positions. The columns are read from the start of
+        the segment the range starts in.
+        :param contig: Name of the contig
+        :param column_start: First column of the range
+        :param column_end: End of the range, exclusive
+        :return: Positions (uint32), bases and rles of the columns
+        """
+        if column_end <= column_start:
+            return np.zeros((0, 3), dtype=np.uint32), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8)
+
+        segment_table = self.get_segment_table(contig)
+        first_segment = np.searchsorted(segment_table['offset'], column_start, side='right') - 1
+        end_segment = np.searchsorted(segment_table['offset'], column_end, side='left')
+        segment_rows = segment_table[first_segment:end_segment]
+        read_start = int(segment_rows['offset'][0])
+
+        inserts, bases, rles = self._read_encoded_columns(contig, read_start, column_end)
+        positions = self.decode_positions(np.asarray(inserts), segment_rows, read_start)
+        skipped_columns = column_start - read_start
+        return positions[skipped_columns:], np.asarray(bases)[skipped_columns:], np.asarray(rles)[skipped_columns:]
+
+    def get_chunk_keys(self, contig):
+        """
+        Returns the MarginPolish chunks of a contig that have predictions.
+        :param contig: Name of the contig
+        :return: Sorted list of (chunk name prefix, contig_start, contig_end) tuples
+        """
+        region_table = self.get_region_table(contig)
+        return sorted((self.get_chunk_names(contig, contig_start, contig_end, 0)[0], contig_start, contig_end)
+                      for contig_start, contig_end in zip(region_table['contig_start'].tolist(),
+                                                          region_table['contig_end'].tolist()))
+
+    def get_masked_chunks(self, contig):
+        """
+        Returns the MarginPolish chunks of a contig that were masked.
+        :param contig: Name of the contig
+        :return: List of (contig_start, contig_end) tuples
+        """
+        masked_table = self._read_masked_table(contig)
+        return list(zip(masked_table['contig_start'].tolist(), masked_table['contig_end'].tolist()))
+
+    def get_chunk_predictions(self, contig, contig_start, contig_end):
+        """
+        Read the predictions of all the images of a MarginPolish chunk. The columns of images that were written one
+        after another are read in one go.
+        :param contig: Name of the contig
+        :param contig_start: Contig start position of the chunk
+        :param contig_end: Contig end position of the chunk
+        :return: Positions (int64), bases and rles of the columns of the chunk, image by image in chunk id order
+        """
+        image_table = self.get_image_table(contig)
+        rows = image_table[np.logical_and(image_table['contig_start'] == contig_start,
+                                          image_table['contig_end'] == contig_end)]
+        rows = rows[np.argsort(rows['chunk_id'], kind='stable')]
+        if len(rows) == 0:
+            return np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.uint8), np.zeros(0, dtype=np.uint8)
+
+        # merge the images that are next to each other in the column arrays into runs
+        starts = rows['offset']
+        ends = rows['offset'] + rows['length']
+        run_starts = np.concatenate(([0], np.flatnonzero(starts[1:] != ends[:-1]) + 1)).astype(np.int64)
+        run_ends = np.append(run_starts[1:], len(rows))
+
+        positions, bases, rles = [], [], []
+        for run_start, run_end in zip(run_starts, run_ends):
+            run_positions, run_bases, run_rles = self._read_columns(contig, starts[run_start], ends[run_end - 1])
+            positions.append(run_positions)
+            bases.append(run_bases)
+            rles.append(run_rles)
+
+        return np.concatenate(positions).astype(np.int64), np.concatenate(bases), np.concatenate(rles)
+
+    def read_contig(self, contig, regions=None):
+        """
+        Read the predictions of the regions of a contig for stitching. The columns of images that are next to each
+        other in the column arrays are read in one go, and the columns are returned region by region. The columns of a
+        region are
+        sorted by position (genomic position, insert index, split index) and a position that is predicted by more
+        than one image of the region is kept once, from the image with the lowest chunk id.
+        :param contig: Name of the contig
+        :param regions: List of (contig_start, contig_end) of the regions to read, None to read all the regions
+        :return: The region table of the regions read, with the offset and length of the columns of each region in
+                 the returned arrays, and the positions (int64), bases and rles of the columns
+        """
+        image_table = self.sort_images(self.get_image_table(contig))
+        region_table = self.get_region_table(contig)
+        # the region of each image in the sorted image table
+        image_regions = np.repeat(np.arange(len(region_table)), region_table['total_images'])
+
+        if regions is not None:
+            regions = set((int(contig_start), int(contig_end)) for contig_start, contig_end in regions)
+            is_selected = np.array([region in regions for region in zip(region_table['contig_start'].tolist(),
+                                                                        region_table['contig_end'].tolist())],
+                                   dtype=bool)
+            is_selected_image = is_selected[image_regions]
+            image_table = image_table[is_selected_image]
+            image_regions = (np.cumsum(is_selected) - 1)[image_regions[is_selected_image]]
+            region_table = region_table[is_selected]
+
+        region_table = region_table.copy()
+        if len(image_table) == 0:
+            region_table['offset'] = 0
+            region_table['length'] = 0
+            return region_table, np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.uint8), \
+                np.zeros(0, dtype=np.uint8)
+
+        # merge the images that are next to each other in the column arrays into runs, each run is read once
+        read_order = np.argsort(image_table['offset'], kind='stable')
+        starts = image_table['offset'][read_order].astype(np.int64)
+        ends = starts + image_table['length'][read_order]
+        run_starts = np.concatenate(([0], np.flatnonzero(starts[1:] != ends[:-1]) + 1)).astype(np.int64)
+        run_ends = np.append(run_starts[1:], len(starts))
+
+        # the start of the columns of each image in the columns that were read
+        read_starts = np.zeros(len(image_table), dtype=np.int64)
+        positions, bases, rles = [], [], []
+        total_read = 0
+        for run_start, run_end in zip(run_starts, run_ends):
+            run_positions, run_bases, run_rles = self._read_columns(contig, starts[run_start], ends[run_end - 1])
+            read_starts[read_order[run_start:run_end]] = total_read + starts[run_start:run_end] - starts[run_start]
+            total_read += len(run_bases)
+            positions.append(run_positions)
+            bases.append(run_bases)
+            rles.append(run_rles)
+
+        # gather the columns of the images in the order of the sorted image table
+        lengths = image_table['length']
+        total_columns = int(np.sum(lengths))
+        columns = np.repeat(read_starts - (np.cumsum(lengths) - lengths), lengths) + np.arange(total_columns)
+        column_regions = np.repeat(image_regions, lengths)
+        positions = np.concatenate(positions)[columns].astype(np.int64)
+        bases = np.concatenate(bases)[columns]
+        rles = np.concatenate(rles)[columns]
+
+        # sort the columns of each region by position, the sort is stable so the first image of a position is kept
+        order = np.lexsort((positions[:, 2], positions[:, 1], positions[:, 0], column_regions))
+        positions, bases, rles, column_regions = positions[order], bases[order], rles[order], column_regions[order]
+        is_first = np.ones(total_columns, dtype=bool)
+        is_first[1:] = np.logical_or(np.any(positions[1:] != positions[:-1], axis=1),
+                                     column_regions[1:] != column_regions[:-1])
+        positions, bases, rles, column_regions = \
+            positions[is_first], bases[is_first], rles[is_first], column_regions[is_first]
+
+        region_table['length'] = np.bincount(column_regions, minlength=len(region_table))
+        region_table['offset'] = np.cumsum(region_table['length']) - region_table['length']
+        return region_table, positions, bases, rles
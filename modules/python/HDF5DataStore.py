@@ -0,0 +1,352 @@
+import os
+import h5py
+import numpy as np
+from collections import defaultdict
+from modules.python.DataStore import DataStore
+
+
+class HDF5DataStore(DataStore):
+    """
+    Saves the predictions in an hdf5 file. The predictions of all the images of a contig are saved together in a
+    few datasets:
+        predictions/<contig>/inserts    (columns,) uint8 insert index of each column
+        predictions/<contig>/segments   the segment table of the contig, with inserts it encodes the positions
+        predictions/<contig>/bases      (columns,) uint8 predicted base of each column
+        predictions/<contig>/rles       (columns,) uint8 predicted run-length of each column
+        predictions/<contig>/images     the image table of the contig
+        predictions/<contig>/masked     the masked table of the contig
+        predictions/<contig>/regions    the region table of the contig, written when the file is closed
+    The datasets are chunked and resizable and the predictions are appended to them, so the number of objects in the
+    file grows with the number of contigs, not with the number of images. Files of layout version 1 have a
+    predictions/<contig>/position (columns, 3) uint32 dataset instead of inserts and segments, they can be read but
+    predictions can not be added to them.
+
+    The prediction files of several runs (shards) can be joined by a master file, see write_master_file. The column
+    datasets of the master are HDF5 virtual datasets that map to the columns of the shards, so the master reads like
+    a single prediction file without copying the predictions.
+    """
+    # path to all the predictions in the HDF file.
+    _prediction_path_ = 'predictions'
+    # layout of the predictions, files without it were written by an older version. Version 2 encodes the positions
+    # with inserts and segments.
+    _layout_ = 'columnar'
+    _layout_version_ = 2
+    # every columnar file saves its layout version, version 1 was the first one
+    _oldest_layout_version_ = 1
+    _column_keys_ = ('inserts', 'bases', 'rles')
+    # number of rows in one hdf5 chunk of the column datasets and of the tables
+    _column_chunk_rows_ = 8192
+    _table_chunk_rows_ = 256
+
+    def __init__(self, filename, mode='r'):
+        """
+        Object initialization function
+        :param filename: Name of the function where to save the data
+        :param mode: 'w' for write, 'r' for read and 'a' to add predictions to an existing file.
+        """
+        super(HDF5DataStore, self).__init__(filename, mode)
+
+        # set the file handler
+        self.file_handler = h5py.File(self.filename, self.mode)
+
+        if self.mode != 'w':
+            self._check_layout()
+            if self.mode != 'r' and 'shards' in self.file_handler.attrs:
+                raise ValueError("CAN NOT ADD PREDICTIONS TO A MASTER FILE, IT ONLY JOINS ITS SHARDS: "
+                                 + self.filename)
+        if self.mode != 'r' and self._prediction_path_ not in self.file_handler:
+            self.file_handler.attrs['layout'] = self._layout_
+            self.file_handler.attrs['layout_version'] = self._layout_version_
+
+        # when we add to an existing file, find out which predictions are already in it
+        if self.mode == 'a':
+            self.load_stored_predictions()
+
+    def close(self):
+        """
+        Write the region tables if we wrote to the file and close the file.
+        :return:
+        """
+        if self.mode != 'r':
+            self.write_region_tables()
+        self.file_handler.close()
+
+    def flush(self):
+        """
+        Write everything that is buffered to the file, so a crash after this point does not lose the predictions
+        written so far.
+        :return:
+        """
+        self.file_handler.flush()
+
+    def _check_layout(self):
+        """
+        Check that the predictions in the file are saved in the layout we read.
+        :return:
+        """
+        if self._prediction_path_ not in self.file_handler:
+            return
+        # a columnar file without a layout version was not written by helen, it is as unsupported as a newer version
+        layout_version = self.file_handler.attrs.get('layout_version', 0)
+        if self.file_handler.attrs.get('layout') != self._layout_ or \
+                not self._oldest_layout_version_ <= layout_version <= self._layout_version_:
+            raise ValueError("UNSUPPORTED PREDICTION FILE LAYOUT, THE FILE WAS WRITTEN BY ANOTHER VERSION OF HELEN. "
+                             "PLEASE RUN call_consensus.py AGAIN: " + self.filename)
+        # we only append predictions in the current layout
+        if self.mode != 'r' and layout_version != self._layout_version_:
+            raise ValueError("CAN NOT ADD PREDICTIONS TO A FILE WRITTEN BY ANOTHER VERSION OF HELEN, PLEASE RUN "
+                             "call_consensus.py WITHOUT --resume: " + self.filename)
+
+    def _get_contig_group(self, contig):
+        """
+        Returns the group of a contig, creating the empty datasets of the contig if it is new.
+        :param contig: Name of the contig
+        :return: HDF5 group of the contig
+        """
+        contig_path = '{}/{}'.format(self._prediction_path_, contig)
+        if contig_path in self.file_handler:
+            return self.file_handler[contig_path]
+
+        contig_group = self.file_handler.create_group(contig_path)
+        for key in self._column_keys_:
+            contig_group.create_dataset(key, shape=(0,), maxshape=(None,), dtype=np.uint8,
+                                        chunks=(self._column_chunk_rows_,))
+        contig_group.create_dataset('segments', shape=(0,), maxshape=(None,), dtype=self._segment_dtype_,
+                                    chunks=(self._table_chunk_rows_,))
+        contig_group.create_dataset('images', shape=(0,), maxshape=(None,), dtype=self._image_dtype_,
+                                    chunks=(self._table_chunk_rows_,))
+        contig_group.create_dataset('masked', shape=(0,), maxshape=(None,), dtype=self._masked_dtype_,
+                                    chunks=(self._table_chunk_rows_,))
+        return contig_group
+
+    @staticmethod
+    def _append(dataset, values):
+        """
+        Append values to the end of a resizable dataset.
+        :param dataset: A dataset that is resizable along the first axis
+        :param values: Array of values to append
+        :return: Offset of the first appended value in the dataset
+        """
+        offset = dataset.shape[0]
+        dataset.resize(offset + len(values), axis=0)
+        dataset[offset:offset + len(values)] = values
+        return offset
+
+    def _append_columns(self, contig, inserts, bases, rles):
+        """
+        Append columns to the column datasets of a contig.
+        :param contig: Name of the contig
+        :param inserts: (columns,) uint8 array
+        :param bases: (columns,) uint8 array
+        :param rles: (columns,) uint8 array
+        :return: Offset of the first appended column
+        """
+        contig_group = self._get_contig_group(contig)
+        offset = self._append(contig_group['inserts'], inserts)
+        self._append(contig_group['bases'], bases)
+        self._append(contig_group['rles'], rles)
+        return offset
+
+    def _append_segments(self, contig, segment_rows):
+        """
+        Append rows to the segment table of a contig.
+        :param contig: Name of the contig
+        :param segment_rows: Structured array of _segment_dtype_
+        :return:
+        """
+        self._append(self._get_contig_group(contig)['segments'], segment_rows)
+
+    def _append_images(self, contig, image_rows):
+        """
+        Append rows to the image table of a contig.
+        :param contig: Name of the contig
+        :param image_rows: Structured array of _image_dtype_
+        :return:
+        """
+        self._append(self._get_contig_group(contig)['images'], image_rows)
+
+    def _append_masked(self, contig, masked_rows):
+        """
+        Append rows to the masked table of a contig.
+        :param contig: Name of the contig
+        :param masked_rows: Structured array of _masked_dtype_
+        :return:
+        """
+        self._append(self._get_contig_group(contig)['masked'], masked_rows)
+
+    def _remove_incomplete_predictions(self):
+        """
+        Shrink the column datasets of each contig to the end of the last image in its image table and remove the
+        segments that start after it.
+        :return: Largest number of columns removed from a contig
+        """
+        removed_columns = 0
+        for contig in self.get_contigs():
+            contig_group = self.file_handler[self._prediction_path_][contig]
+            image_table = contig_group['images'][()]
+            total_columns = int(np.max(image_table['offset'] + image_table['length'])) if len(image_table) else 0
+            for key in self._column_keys_:
+                if contig_group[key].shape[0] > total_columns:
+                    removed_columns = max(removed_columns, contig_group[key].shape[0] - total_columns)
+                    contig_group[key].resize(total_columns, axis=0)
+            total_segments = int(np.searchsorted(contig_group['segments'][()]['offset'], total_columns))
+            if contig_group['segments'].shape[0] > total_segments:
+                contig_group['segments'].resize(total_segments, axis=0)
+        return removed_columns
+
+    def get_contigs(self):
+        """
+        Returns the names of the contigs that have predictions or masked chunks in the file.
+        :return: Sorted list of contig names
+        """
+        if self._prediction_path_ not in self.file_handler:
+            return []
+        return sorted(self.file_handler[self._prediction_path_].keys())
+
+    def _read_image_table(self, contig):
+        """
+        Read the image table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _image_dtype_
+        """
+        return self.file_handler[self._prediction_path_][contig]['images'][()]
+
+    def _read_masked_table(self, contig):
+        """
+        Read the masked table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _masked_dtype_
+        """
+        return self.file_handler[self._prediction_path_][contig]['masked'][()]
+
+    def _read_region_table(self, contig):
+        """
+        Read the region table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _region_dtype_, None if the contig has no region table
+        """
+        contig_group = self.file_handler[self._prediction_path_][contig]
+        return contig_group['regions'][()] if 'regions' in contig_group else None
+
+    def _write_region_table(self, contig, region_table):
+        """
+        Write the region table of a contig, replacing the one in the file.
+        :param contig: Name of the contig
+        :param region_table: Structured array of _region_dtype_
+        :return:
+        """
+        contig_group = self._get_contig_group(contig)
+        if 'regions' in contig_group:
+            del contig_group['regions']
+        contig_group['regions'] = region_table
+
+    def _read_segment_table(self, contig):
+        """
+        Read the segment table of a contig.
+        :param contig: Name of the contig
+        :return: Structured array of _segment_dtype_
+        """
+        return self.file_handler[self._prediction_path_][contig]['segments'][()]
+
+    def _read_encoded_columns(self, contig, column_start, column_end):
+        """
+        Read a range of the columns of a contig as they are saved.
+        :param contig: Name of the contig
+        :param column_start: First column of the range
+        :param column_end: End of the range, exclusive
+        :return: Inserts, bases and rles of the columns
+        """
+        contig_group = self.file_handler[self._prediction_path_][contig]
+        column_slice = np.s_[column_start:column_end]
+        return tuple(contig_group[key][column_slice] for key in self._column_keys_)
+
+    def _read_columns(self, contig, column_start, column_end):
+        """
+        Read a range of the columns of a contig, the positions of files of layout version 1 are read as they are.
+        :param contig: Name of the contig
+        :param column_start: First column of the range
+        :param column_end: End of the range, exclusive
+        :return: Positions (uint32), bases and rles of the columns
+        """
+        contig_group = self.file_handler[self._prediction_path_][contig]
+        if 'position' in contig_group:
+            column_slice = np.s_[column_start:column_end]
+            return contig_group['position'][column_slice], contig_group['bases'][column_slice], \
+                contig_group['rles'][column_slice]
+        return super(HDF5DataStore, self)._read_columns(contig, column_start, column_end)
+
+    @staticmethod
+    def write_master_file(master_filename, shard_filenames):
+        """
+        Join prediction files (shards), i.e. of call_consensus.py runs on different contigs or regions, with a master
+        file. For each contig, the inserts, bases and rles of the master are virtual datasets that concatenate the
+        columns of the shards. The image, segment and masked tables are small, they are copied to the master and the
+        offsets of the images and segments are moved to the positions of their columns in the virtual datasets. An
+        image that is in more than one shard is taken from the first shard. The shards are referenced by their path
+        relative to the master file, so the master has to stay in the same place relative to the shards.
+        :param master_filename: Path to the master file
+        :param shard_filenames: Paths to the prediction files to join
+        :return:
+        """
+        master_directory = os.path.dirname(os.path.abspath(master_filename))
+        # contig -> list of (shard path relative to the master, image table, segment table, masked table, number of
+        # columns)
+        contig_shards = defaultdict(list)
+        for shard_filename in shard_filenames:
+            with HDF5DataStore(shard_filename, 'r') as shard_file:
+                if 'shards' in shard_file.file_handler.attrs:
+                    raise ValueError("A MASTER FILE CAN NOT BE A SHARD OF ANOTHER MASTER FILE: " + shard_filename)
+                if shard_file.get_contigs() and \
+                        shard_file.file_handler.attrs.get('layout_version') != HDF5DataStore._layout_version_:
+                    raise ValueError("CAN NOT JOIN A FILE WRITTEN BY ANOTHER VERSION OF HELEN: " + shard_filename)
+                shard_path = os.path.relpath(os.path.abspath(shard_filename), master_directory)
+                for contig in shard_file.get_contigs():
+                    contig_group = shard_file.file_handler[HDF5DataStore._prediction_path_][contig]
+                    contig_shards[contig].append((shard_path, shard_file.get_image_table(contig),
+                                                  shard_file.get_segment_table(contig), contig_group['masked'][()],
+                                                  contig_group['bases'].shape[0]))
+
+        with h5py.File(master_filename, 'w') as master_file:
+            master_file.attrs['layout'] = HDF5DataStore._layout_
+            master_file.attrs['layout_version'] = HDF5DataStore._layout_version_
+            master_file.attrs['shards'] = [os.path.relpath(os.path.abspath(shard_filename), master_directory)
+                                           for shard_filename in shard_filenames]
+            master_file.create_group(HDF5DataStore._prediction_path_)
+
+            for contig, shards in contig_shards.items():
+                contig_group = master_file.create_group('{}/{}'.format(HDF5DataStore._prediction_path_, contig))
+                total_columns = sum(shard_columns for _, _, _, _, shard_columns in shards)
+
+                # the columns of the shards one after another
+                column_layouts = {key: h5py.VirtualLayout(shape=(total_columns,), dtype=np.uint8)
+                                  for key in HDF5DataStore._column_keys_}
+                image_tables = []
+                segment_tables = []
+                column_offset = 0
+                for shard_path, image_table, segment_table, masked_table, shard_columns in shards:
+                    if shard_columns > 0:
+                        for key, column_layout in column_layouts.items():
+                            source_path = '{}/{}/{}'.format(HDF5DataStore._prediction_path_, contig, key)
+                            source = h5py.VirtualSource(shard_path, source_path, shape=(shard_columns,),
+                                                        dtype=column_layout.dtype)
+                            column_layout[column_offset:column_offset + shard_columns] = source
+                    image_table = image_table.copy()
+                    image_table['offset'] += column_offset
+                    image_tables.append(image_table)
+                    segment_table = segment_table.copy()
+                    segment_table['offset'] += column_offset
+                    segment_tables.append(segment_table)
+                    column_offset += shard_columns
+                for key, column_layout in column_layouts.items():
+                    contig_group.create_virtual_dataset(key, column_layout)
+
+                # keep the first copy of the images that are in more than one shard
+                image_table = np.concatenate(image_tables)
+                _, first_images = np.unique(image_table[['contig_start', 'contig_end', 'chunk_id']],
+                                            return_index=True)
+                image_table = image_table[np.sort(first_images)]
+                contig_group['images'] = image_table
+                contig_group['regions'] = HDF5DataStore.build_region_table(HDF5DataStore.sort_images(image_table))
+                contig_group['segments'] = np.concatenate(segment_tables)
+                contig_group['masked'] = np.unique(np.concatenate([masked_table
+                                                                   for _, _, _, masked_table, _ in shards]))
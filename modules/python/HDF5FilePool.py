@@ -0,0 +1,90 @@
+import os
+import h5py
+from collections import OrderedDict
+
+
+class HDF5FilePool(object):
+    """
+    A pool of read-only hdf5 file handles that the dataloaders use to read images. Opening an hdf5 file is more
+    expensive than reading an image from it, so we keep the most recently used files open and close the least recently
+    used one when the pool is full.
+
+    Each DataLoader worker gets its own copy of the pool. h5py handles can not be shared between processes, so if
+    we find that we are in a different process than the one that opened the files, we drop the inherited handles
+    without touching them and open the files again.
+    """
+    def __init__(self, max_open_files=32):
+        """
+        Object initialization function
+        :param max_open_files: Maximum number of files to keep open at the same time
+        """
+        self.max_open_files = max_open_files
+        self._pid = os.getpid()
+        # file path -> (file handler, images group) in least recently used order
+        self._file_handlers = OrderedDict()
+
+    def __getstate__(self):
+        """
+        File handlers can not be pickled, so when the pool is sent to a worker process we only send the settings.
+        :return:
+        """
+        return {'max_open_files': self.max_open_files}
+
+    def __setstate__(self, state):
+        """
+        Create an empty pool in the worker process.
+        :param state: Settings of the pool
+        :return:
+        """
+        self.__init__(state['max_open_files'])
+
+    def _check_process(self):
+        """
+        If the pool was forked to a new process, forget the handles of the parent process.
+        :return:
+        """
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file_handlers = OrderedDict()
+
+    def get_images_group(self, hdf5_filepath):
+        """
+        Returns the images group of a file, opening the file if it is not already open.
+        :param hdf5_filepath: Path to the hdf5 file
+        :return: The images group of the file
+        """
+        self._check_process()
+
+        if hdf5_filepath in self._file_handlers:
+            self._file_handlers.move_to_end(hdf5_filepath)
+            return self._file_handlers[hdf5_filepath][1]
+
+        # close the least recently used file if we have too many files open
+        if len(self._file_handlers) >= self.max_open_files:
+            _, (file_handler, _) = self._file_handlers.popitem(last=False)
+            file_handler.close()
+
+        file_handler = h5py.File(hdf5_filepath, 'r')
+        images_group = file_handler['images']
+        self._file_handlers[hdf5_filepath] = (file_handler, images_group)
+
+        return images_group
+
+    def get_image_group(self, hdf5_filepath, image_name):
+        """
+        Returns the group of an image.
+        :param hdf5_filepath: Path to the hdf5 file
+        :param image_name: Name of the image
+        :return: The hdf5 group of the image
+        """
+        return self.get_images_group(hdf5_filepath)[image_name]
+
+    def close(self):
+        """
+        Close all the open files of this process.
+        :return:
+        """
+        self._check_process()
+        for file_handler, _ in self._file_handlers.values():
+            file_handler.close()
+        self._file_handlers = OrderedDict()
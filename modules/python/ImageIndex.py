@@ -0,0 +1,330 @@
+import os
+import sys
+import zipfile
+import tempfile
+import h5py
+import numpy as np
+from modules.python.TextColor import TextColor
+from modules.python.FileManager import FileManager
+
+
+class ImageIndex(object):
+    """
+    A compact index of all the images MarginPolish generated in a directory. For every image we keep the
+    file it belongs to, the name of the image and the contig, start, end, chunk id and length of the image so the
+    dataloaders never have to open the files to find out what is in them.
+
+    The index is saved in the image directory the first time it is built. When it is loaded again, we compare the
+    modification time and size of each file with the saved values and only re-scan the files that changed. All the
+    columns are kept as read-only numpy arrays so the DataLoader workers can share them with the main process.
+    """
+    # name of the file where the index is saved
+    _index_filename_ = 'helen_image_index.npz'
+    # change the version if the layout of the saved index changes
+    _version_ = 1
+    # per-image columns of the index
+    _columns_ = ('file_id', 'image_name', 'contig_id', 'contig_start', 'contig_end', 'chunk_id', 'length')
+
+    def __init__(self, image_directory, file_names, file_mtimes, file_sizes, contig_names, columns):
+        """
+        Object initialization function. Use ImageIndex.load to get an index of a directory.
+        :param image_directory: Path to the directory where the images are
+        :param file_names: Array of file names (relative to the image directory)
+        :param file_mtimes: Array of modification times (in ns) of the files when they were indexed
+        :param file_sizes: Array of sizes of the files when they were indexed
+        :param contig_names: Array of contig names, contig_id of each image points to this array
+        :param columns: A dictionary containing an array for each of the _columns_
+        """
+        self.image_directory = image_directory
+        self.file_names = file_names
+        self.file_mtimes = file_mtimes
+        self.file_sizes = file_sizes
+        self.contig_names = contig_names
+
+        self.file_id = columns['file_id']
+        self.image_name = columns['image_name']
+        self.contig_id = columns['contig_id']
+        self.contig_start = columns['contig_start']
+        self.contig_end = columns['contig_end']
+        self.chunk_id = columns['chunk_id']
+        self.length = columns['length']
+
+        # the index is shared between the dataloader workers, so we make sure no one modifies it
+        for array in self._arrays():
+            array.flags.writeable = False
+
+        # full paths to the files so we don't have to join them for every image
+        self.file_paths = [os.path.join(image_directory, file_name) for file_name in self.file_names]
+
+    def __len__(self):
+        """
+        Returns the number of images in the index
+        :return:
+        """
+        return len(self.file_id)
+
+    def _arrays(self):
+        """
+        Returns all the arrays that this index holds.
+        :return:
+        """
+        return [self.file_names, self.file_mtimes, self.file_sizes, self.contig_names] + \
+               [getattr(self, column) for column in self._columns_]
+
+    def get_file_path(self, index):
+        """
+        Returns the path of the file an image belongs to.
+        :param index: Index of the image
+        :return: Path to the hdf5 file
+        """
+        return self.file_paths[self.file_id[index]]
+
+    def get_contig(self, index):
+        """
+        Returns the contig name of an image.
+        :param index: Index of the image
+        :return: Contig name
+        """
+        return str(self.contig_names[self.contig_id[index]])
+
+    @staticmethod
+    def parse_region(region):
+        """
+        Parse a region string in contig:start-end format. The start and end are 1-based and inclusive like samtools
+        regions, a region with only a contig name covers the whole contig.
+        :param region: Region string
+        :return: (contig, start, end) tuple with a 0-based start and an exclusive end, end is None for whole contigs
+        """
+        contig, separator, interval = region.rpartition(':')
+        if not separator:
+            return region, 0, None
+        try:
+            start, end = interval.replace(',', '').split('-')
+            start, end = int(start), int(end)
+        except ValueError:
+            raise ValueError("INVALID REGION: " + region + ", EXPECTED contig:start-end")
+        if not contig or start < 1 or end < start:
+            raise ValueError("INVALID REGION: " + region + ", EXPECTED contig:start-end")
+        return contig, start - 1, end
+
+    def select_images(self, contigs=None, regions=None):
+        """
+        Find the images of the given contigs and the images that overlap the given regions. The selection only uses
+        the index, no files are opened.
+        :param contigs: List of contig names
+        :param regions: List of (contig, start, end) tuples as returned by parse_region
+        :return: Sorted indices of the selected images
+        """
+        contig_ids = {str(contig): contig_id for contig_id, contig in enumerate(self.contig_names)}
+        selected = np.zeros(len(self), dtype=bool)
+
+        requested_contigs = list(contigs or []) + [contig for contig, _, _ in regions or []]
+        for contig in requested_contigs:
+            if contig not in contig_ids:
+                sys.stderr.write(TextColor.YELLOW + "WARN: NO IMAGES FOUND FOR CONTIG: " + contig + "\n"
+                                 + TextColor.END)
+
+        for contig in contigs or []:
+            if contig in contig_ids:
+                selected |= self.contig_id == contig_ids[contig]
+
+        for contig, start, end in regions or []:
+            if contig not in contig_ids:
+                continue
+            in_region = np.logical_and(self.contig_id == contig_ids[contig], self.contig_end > start)
+            if end is not None:
+                in_region &= self.contig_start < end
+            selected |= in_region
+
+        return np.flatnonzero(selected)
+
+    @staticmethod
+    def _read_scalar(image_group, key, default):
+        """
+        Reads the first value of a dataset of an image, MarginPolish saves contig information as arrays of size 1.
+        :param image_group: HDF5 group of the image
+        :param key: Name of the dataset
+        :param default: Value to return if the image doesn't have the dataset
+        :return:
+        """
+        if key not in image_group:
+            return default
+        value = image_group[key][()][0]
+        if isinstance(value, bytes):
+            value = value.decode()
+        return value
+
+    @staticmethod
+    def _scan_file(hdf5_file_path):
+        """
+        Reads the information of all the images saved in a file.
+        :param hdf5_file_path: Path to a MarginPolish generated hdf5 file
+        :return: A list of (image_name, contig, contig_start, contig_end, chunk_id, length) tuples
+        """
+        images = []
+        with h5py.File(hdf5_file_path, 'r') as hdf5_file:
+            # check if marginpolish somehow generated an empty file
+            if 'images' not in hdf5_file:
+                sys.stderr.write(TextColor.YELLOW + "WARN: NO IMAGES FOUND IN FILE: "
+                                 + hdf5_file_path + "\n" + TextColor.END)
+                return images
+
+            for image_name in hdf5_file['images'].keys():
+                image_group = hdf5_file['images'][image_name]
+                images.append((image_name,
+                               str(ImageIndex._read_scalar(image_group, 'contig', '')),
+                               int(ImageIndex._read_scalar(image_group, 'contig_start', -1)),
+                               int(ImageIndex._read_scalar(image_group, 'contig_end', -1)),
+                               int(ImageIndex._read_scalar(image_group, 'feature_chunk_idx', -1)),
+                               image_group['image'].shape[0]))
+        return images
+
+    @staticmethod
+    def _load_saved_index(index_path):
+        """
+        Load a previously saved index. Returns None if there is no usable index in the path.
+        :param index_path: Path to the saved index
+        :return: A dictionary of arrays or None
+        """
+        if not os.path.isfile(index_path):
+            return None
+        try:
+            with np.load(index_path, allow_pickle=False) as saved_index:
+                if int(saved_index['version']) != ImageIndex._version_:
+                    return None
+                return {key: saved_index[key] for key in saved_index.files}
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            sys.stderr.write(TextColor.YELLOW + "WARN: COULD NOT READ IMAGE INDEX, REBUILDING: "
+                             + index_path + "\n" + TextColor.END)
+            return None
+
+    def save(self, index_path):
+        """
+        Save the index to a file. The file is first written to a temporary path and then moved so a failed run
+        never leaves a broken index behind. Every save gets its own temporary file, so runs that share an image
+        directory don't write to the same file.
+        :param index_path: Path where the index will be saved
+        :return:
+        """
+        temp_file, temp_path = tempfile.mkstemp(prefix=os.path.basename(index_path) + '.', suffix='.tmp',
+                                                dir=os.path.dirname(os.path.abspath(index_path)))
+        try:
+            with os.fdopen(temp_file, 'wb') as index_file:
+                np.savez(index_file,
+                         version=np.array(self._version_),
+                         file_names=self.file_names,
+                         file_mtimes=self.file_mtimes,
+                         file_sizes=self.file_sizes,
+                         contig_names=self.contig_names,
+                         **{column: getattr(self, column) for column in self._columns_})
+            # mkstemp makes the file private, the index is shared with everyone who reads the images
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, index_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def load(image_directory, index_path=None):
+        """
+        Load the index of an image directory. If a saved index exists we reuse it for all the files that did not
+        change since it was saved and only scan the new or modified files. The updated index is saved back.
+        :param image_directory: Path to a directory where all the images are saved.
+        :param index_path: Path to the saved index, default is a file inside the image directory.
+        :return: An ImageIndex object
+        """
+        if index_path is None:
+            index_path = os.path.join(image_directory, ImageIndex._index_filename_)
+
+        # get the current state of all the h5 files in the directory
+        hdf_files = sorted(FileManager.get_file_paths_from_directory(image_directory))
+        file_names = [os.path.basename(hdf_file) for hdf_file in hdf_files]
+        file_stats = [os.stat(hdf_file) for hdf_file in hdf_files]
+        file_mtimes = np.array([stat.st_mtime_ns for stat in file_stats], dtype=np.int64)
+        file_sizes = np.array([stat.st_size for stat in file_stats], dtype=np.int64)
+
+        saved_index = ImageIndex._load_saved_index(index_path)
+
+        # find the files we can reuse from the saved index, old_file_ids[i] is the file id of the i-th file in the
+        # saved index or -1 if the file needs to be scanned again.
+        old_file_ids = np.full(len(file_names), -1, dtype=np.int64)
+        if saved_index is not None:
+            saved_files = {str(name): (i, mtime, size) for i, (name, mtime, size) in
+                           enumerate(zip(saved_index['file_names'], saved_index['file_mtimes'],
+                                         saved_index['file_sizes']))}
+            for i, file_name in enumerate(file_names):
+                if file_name in saved_files:
+                    saved_file_id, saved_mtime, saved_size = saved_files[file_name]
+                    if saved_mtime == file_mtimes[i] and saved_size == file_sizes[i]:
+                        old_file_ids[i] = saved_file_id
+
+        files_to_scan = np.flatnonzero(old_file_ids < 0)
+        if saved_index is not None and len(files_to_scan) == 0 and len(saved_index['file_names']) == len(file_names):
+            # nothing changed since the index was saved
+            index = ImageIndex(image_directory, saved_index['file_names'], saved_index['file_mtimes'],
+                               saved_index['file_sizes'], saved_index['contig_names'], saved_index)
+            return index
+
+        sys.stderr.write(TextColor.GREEN + "INFO: INDEXING " + str(len(files_to_scan)) + " OF "
+                         + str(len(file_names)) + " IMAGE FILES.\n" + TextColor.END)
+
+        columns = {column: [] for column in ImageIndex._columns_}
+        contig_names = []
+        contig_ids = {}
+
+        # first take all the images of the unchanged files from the saved index
+        if saved_index is not None and len(files_to_scan) < len(file_names):
+            new_file_ids = np.full(len(saved_index['file_names']), -1, dtype=np.int64)
+            reused_files = np.flatnonzero(old_file_ids >= 0)
+            new_file_ids[old_file_ids[reused_files]] = reused_files
+
+            keep = new_file_ids[saved_index['file_id']] >= 0
+            for contig in saved_index['contig_names']:
+                contig_ids[str(contig)] = len(contig_names)
+                contig_names.append(str(contig))
+
+            for column in ImageIndex._columns_:
+                columns[column].append(saved_index[column][keep])
+            columns['file_id'][-1] = new_file_ids[saved_index['file_id'][keep]]
+
+        # then scan the files that are new or have changed
+        for file_id in files_to_scan:
+            images = ImageIndex._scan_file(hdf_files[file_id])
+            if not images:
+                continue
+            image_names, contigs, contig_starts, contig_ends, chunk_ids, lengths = zip(*images)
+            for contig in contigs:
+                if contig not in contig_ids:
+                    contig_ids[contig] = len(contig_names)
+                    contig_names.append(contig)
+
+            columns['file_id'].append(np.full(len(images), file_id, dtype=np.int32))
+            columns['image_name'].append(np.array(image_names))
+            columns['contig_id'].append(np.array([contig_ids[contig] for contig in contigs], dtype=np.int32))
+            columns['contig_start'].append(np.array(contig_starts, dtype=np.int64))
+            columns['contig_end'].append(np.array(contig_ends, dtype=np.int64))
+            columns['chunk_id'].append(np.array(chunk_ids, dtype=np.int32))
+            columns['length'].append(np.array(lengths, dtype=np.int32))
+
+        empty_column_types = {'file_id': np.int32, 'image_name': np.str_, 'contig_id': np.int32,
+                              'contig_start': np.int64, 'contig_end': np.int64, 'chunk_id': np.int32,
+                              'length': np.int32}
+        for column in ImageIndex._columns_:
+            if columns[column]:
+                columns[column] = np.concatenate(columns[column]).astype(empty_column_types[column], copy=False)
+            else:
+                columns[column] = np.array([], dtype=empty_column_types[column])
+
+        # keep the images of each file together and sorted by name, this is the order we read them in
+        order = np.lexsort((columns['image_name'], columns['file_id']))
+        columns = {column: values[order] for column, values in columns.items()}
+
+        index = ImageIndex(image_directory, np.array(file_names, dtype=np.str_), file_mtimes, file_sizes,
+                           np.array(contig_names, dtype=np.str_), columns)
+        try:
+            index.save(index_path)
+        except OSError:
+            sys.stderr.write(TextColor.YELLOW + "WARN: COULD NOT SAVE IMAGE INDEX TO: "
+                             + index_path + "\n" + TextColor.END)
+
+        return index
@@ -0,0 +1,95 @@
+import sys
+import numpy as np
+from modules.python.TextColor import TextColor
+
+
+class MaskedRegions(object):
+    """
+    Regions of the genome we don't want to polish, loaded from a BED file like
+    masked_regions/GRCh38_masked_regions.bed. The intervals of each contig are sorted and overlapping intervals are
+    merged, so we can find the interval that may contain a span with a binary search.
+    """
+    def __init__(self, bed_file_path):
+        """
+        Object initialization function, loads the intervals from a BED file.
+        :param bed_file_path: Path to a BED file, only the first three columns are used
+        """
+        self.bed_file_path = bed_file_path
+        # contig -> (sorted interval starts, interval ends) of the merged intervals
+        self.intervals = {}
+
+        contig_intervals = {}
+        with open(bed_file_path, 'r') as bed_file:
+            for line_number, line in enumerate(bed_file):
+                if not line.strip() or line.startswith(('#', 'track', 'browser')):
+                    continue
+                fields = line.split()
+                try:
+                    contig, start, end = fields[0], int(fields[1]), int(fields[2])
+                except (IndexError, ValueError):
+                    raise ValueError("INVALID BED LINE " + str(line_number + 1) + " IN FILE: " + bed_file_path)
+                if end > start:
+                    contig_intervals.setdefault(contig, []).append((start, end))
+
+        for contig, intervals in contig_intervals.items():
+            self.intervals[contig] = self.merge_intervals(intervals)
+
+        sys.stderr.write(TextColor.GREEN + "INFO: LOADED " + str(sum(len(starts) for starts, _ in
+                                                                     self.intervals.values()))
+                         + " MASKED INTERVALS ON " + str(len(self.intervals)) + " CONTIGS FROM: " + bed_file_path
+                         + "\n" + TextColor.END)
+
+    @staticmethod
+    def merge_intervals(intervals):
+        """
+        Sort intervals and merge the ones that overlap or touch each other.
+        :param intervals: List of (start, end) tuples, end is exclusive
+        :return: Arrays of the starts and ends of the merged intervals
+        """
+        merged_starts = []
+        merged_ends = []
+        for start, end in sorted(intervals):
+            if merged_ends and start <= merged_ends[-1]:
+                merged_ends[-1] = max(merged_ends[-1], end)
+            else:
+                merged_starts.append(start)
+                merged_ends.append(end)
+        return np.array(merged_starts, dtype=np.int64), np.array(merged_ends, dtype=np.int64)
+
+    def is_masked(self, contig, starts, ends):
+        """
+        Check which spans of a contig are fully inside a masked interval.
+        :param contig: Contig name
+        :param starts: Array of span starts
+        :param ends: Array of span ends, exclusive
+        :return: Boolean array, true for the spans that are masked
+        """
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        if contig not in self.intervals:
+            return np.zeros(len(starts), dtype=bool)
+
+        interval_starts, interval_ends = self.intervals[contig]
+        # the last interval that starts at or before each span is the only one that can contain it
+        interval_ids = np.searchsorted(interval_starts, starts, side='right') - 1
+        masked = interval_ids >= 0
+        masked[masked] = interval_ends[interval_ids[masked]] >= ends[masked]
+        return masked
+
+    def get_masked_images(self, image_index, image_indices):
+        """
+        Find the images whose chunk is fully inside a masked interval. The spans come from the contig start and end
+        of the MarginPolish chunks in the image index, so no files are opened.
+        :param image_index: The ImageIndex of the dataset
+        :param image_indices: Indices of the images to check
+        :return: Boolean array, true for the images that are masked
+        """
+        image_indices = np.asarray(image_indices, dtype=np.int64)
+        masked = np.zeros(len(image_indices), dtype=bool)
+        contig_ids = image_index.contig_id[image_indices]
+        for contig_id in np.unique(contig_ids):
+            in_contig = contig_ids == contig_id
+            masked[in_contig] = self.is_masked(str(image_index.contig_names[contig_id]),
+                                               image_index.contig_start[image_indices[in_contig]],
+                                               image_index.contig_end[image_indices[in_contig]])
+        return masked
@@ -28,3 +28,37 @@ class TrainOptions(object):
     HIDDEN_SIZE = 128
     CLASS_WEIGHTS = [0.3, 0.5, 0.5, 0.5, 0.5, 0.8, 0.9, 1.0, 1.0, 1.0, 0.9]
 
+
+class InferenceOptions(object):
+    # (window size, window jump) used by each inference mode. sliding is the mode the models are trained with,
+    # every column is predicted twice and the predictions are summed. single_pass runs each column once with
+    # non-overlapping windows and full runs the whole image in one window.
+    INFERENCE_MODES = {
+        'sliding': (TrainOptions.TRAIN_WINDOW, TrainOptions.WINDOW_JUMP),
+        'single_pass': (TrainOptions.TRAIN_WINDOW, TrainOptions.TRAIN_WINDOW),
+        'full': (ImageSizeOptions.SEQ_LENGTH, ImageSizeOptions.SEQ_LENGTH),
+    }
+    DEFAULT_INFERENCE_MODE = 'sliding'
+    # precision of the model weights during inference. bf16 runs the model in bfloat16 and int8 uses dynamic
+    # quantization of the GRU and linear layers, int8 is CPU only.
+    PRECISIONS = ('fp32', 'bf16', 'int8')
+    DEFAULT_PRECISION = 'fp32'
+    # number of minibatch predictions that can wait for the prediction writer before the inference loop blocks
+    WRITER_QUEUE_SIZE = 8
+    # seconds between flushes of the prediction file. The binary store keeps everything written before a flush
+    # when the run is killed, an hdf5 file may not open again after a kill.
+    FLUSH_INTERVAL = 60
+    # how the dataloader workers pass the minibatches. torch uses the DataLoader workers, which pass tensors through
+    # shared memory (/dev/shm), mmap workers pass them through a memory mapped file next to the output.
+    LOADERS = ('torch', 'mmap')
+    DEFAULT_LOADER = 'torch'
+    # backend of the prediction file and its extension. hdf5 is a single file, binary is a directory of flat
+    # column files that stitch memory maps.
+    OUTPUT_FORMATS = {'hdf5': '.hdf', 'binary': '.bin'}
+    DEFAULT_OUTPUT_FORMAT = 'hdf5'
+    # file extensions of the exported models and the backend that runs them, everything else is a pytorch
+    # checkpoint. onnx models run with onnxruntime and numpy, without pytorch.
+    MODEL_BACKENDS = {'.pt': 'torchscript', '.onnx': 'onnx'}
+    # minibatches the torch profiler skips and warms up on before it records
+    PROFILE_WAIT_BATCHES = 1
+    PROFILE_WARMUP_BATCHES = 1
@@ -0,0 +1,148 @@
+import sys
+import time
+import queue
+import threading
+from modules.python.TextColor import TextColor
+
+
+class PredictionWriter(object):
+    """
+    Writes the predictions of minibatches to a DataStore in a background thread so the model can run on the next
+    minibatch while the predictions of the previous one are saved. The minibatches wait in a bounded queue, if the
+    writer falls behind the inference loop blocks until there is room in the queue.
+
+    The writer keeps track of how full the queue is and how long the inference loop waited for the writer. A queue
+    that is always full means prediction is bound by the writes to the prediction file, an empty queue means the
+    writer is waiting for the model.
+
+    The prediction file is flushed at regular intervals and when the writer is closed. If the run is killed, a
+    resumed run reuses the predictions a binary store had before the last flush. An hdf5 file is not written in a
+    crash-consistent way, if it was killed while writing it may not open again and has to be predicted again.
+    """
+    def __init__(self, prediction_data_file, write_function, max_queue_size, flush_interval=None):
+        """
+        Object initialization function
+        :param prediction_data_file: A DataStore object opened for writing
+        :param write_function: Function that writes a minibatch, called as write_function(prediction_data_file, batch)
+        :param max_queue_size: Maximum number of minibatches waiting to be written
+        :param flush_interval: Seconds between flushes of the prediction file, None to only flush when closing
+        """
+        self.prediction_data_file = prediction_data_file
+        self.write_function = write_function
+        self.max_queue_size = max_queue_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._error = None
+
+        # queue statistics
+        self.total_batches = 0
+        self.total_queue_depth = 0
+        self.max_queue_depth = 0
+        self.full_queue_count = 0
+        self.wait_time = 0.0
+        self.write_time = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='PredictionWriter', daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        """
+        This method is invoked when we open an object under "with" statement.
+        :return:
+        """
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """
+        Wait for all the minibatches to be written when we leave the "with" statement. If we are leaving because of
+        an error we only stop the writer.
+        :return:
+        """
+        self.close(report=exc_type is None)
+
+    def _run(self):
+        """
+        The writer thread, writes minibatches from the queue until it gets None.
+        :return:
+        """
+        last_flush_time = time.time()
+        while True:
+            batch_predictions = self._queue.get()
+            if batch_predictions is None:
+                break
+            # after an error we keep draining the queue so the inference loop never blocks on a full queue
+            if self._error is not None:
+                continue
+            try:
+                start_time = time.time()
+                self.write_function(self.prediction_data_file, batch_predictions)
+                if self.flush_interval is not None and time.time() - last_flush_time >= self.flush_interval:
+                    self.prediction_data_file.flush()
+                    last_flush_time = time.time()
+                self.write_time += time.time() - start_time
+            except Exception as error:
+                self._error = error
+
+        if self._error is None:
+            try:
+                self.prediction_data_file.flush()
+            except Exception as error:
+                self._error = error
+
+    def _check_error(self):
+        """
+        Raise the error of the writer thread in the calling thread.
+        :return:
+        """
+        if self._error is not None:
+            raise RuntimeError("PREDICTION WRITER FAILED: " + repr(self._error)) from self._error
+
+    def write(self, batch_predictions):
+        """
+        Add the predictions of a minibatch to the queue. Blocks if the queue is full.
+        :param batch_predictions: Predictions of a minibatch
+        :return:
+        """
+        self._check_error()
+
+        queue_depth = self._queue.qsize()
+        self.total_batches += 1
+        self.total_queue_depth += queue_depth
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        if queue_depth >= self.max_queue_size:
+            self.full_queue_count += 1
+
+        start_time = time.time()
+        self._queue.put(batch_predictions)
+        self.wait_time += time.time() - start_time
+
+    def close(self, report=True):
+        """
+        Wait until all the minibatches in the queue are written and stop the writer thread.
+        :param report: If true, print the queue statistics
+        :return:
+        """
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+        if report:
+            self._check_error()
+            self.report()
+
+    def report(self):
+        """
+        Print how full the queue was during prediction and how long the inference loop waited for the writer.
+        :return:
+        """
+        mean_queue_depth = self.total_queue_depth / max(1, self.total_batches)
+        sys.stderr.write(TextColor.GREEN + "INFO: PREDICTION WRITER QUEUE DEPTH: MEAN " +
+                         "{:.2f}".format(mean_queue_depth) + ", MAX " + str(self.max_queue_depth) + " OF " +
+                         str(self.max_queue_size) + ", FULL ON " + str(self.full_queue_count) + " OF " +
+                         str(self.total_batches) + " BATCHES.\n" + TextColor.END)
+        sys.stderr.write(TextColor.GREEN + "INFO: PREDICTION WRITER TIME: " + "{:.2f}".format(self.write_time) +
+                         " SEC WRITING, INFERENCE WAITED " + "{:.2f}".format(self.wait_time) + " SEC FOR THE WRITER.\n"
+                         + TextColor.END)
+        if self.total_batches > 0 and self.full_queue_count * 2 > self.total_batches:
+            sys.stderr.write(TextColor.YELLOW + "WARN: THE PREDICTION WRITER QUEUE WAS FULL MOST OF THE TIME, "
+                                                "PREDICTION IS BOUND BY WRITING THE PREDICTION FILE.\n"
+                             + TextColor.END)
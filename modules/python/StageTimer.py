@@ -0,0 +1,72 @@
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class StageTimer(object):
+    """
+    Collects the wall time spent in each stage of a run (i.e. loading data, inference, writing predictions). The
+    stages can be timed with a "with" statement or added directly, the timer can be shared between threads and the
+    times of other processes can be merged in.
+    """
+    def __init__(self):
+        """
+        Object initialization function
+        """
+        self._lock = threading.Lock()
+        # stage name -> [total seconds, number of times the stage was timed] in the order the stages first ran
+        self._stages = OrderedDict()
+        self._start_time = time.time()
+
+    @contextmanager
+    def stage(self, stage_name):
+        """
+        Time the code inside a "with" statement as a stage.
+        :param stage_name: Name of the stage
+        :return:
+        """
+        start_time = time.time()
+        try:
+            yield
+        finally:
+            self.add(stage_name, time.time() - start_time)
+
+    def add(self, stage_name, seconds, count=1):
+        """
+        Add time to a stage.
+        :param stage_name: Name of the stage
+        :param seconds: Seconds spent in the stage
+        :param count: Number of times the stage ran in this time
+        :return:
+        """
+        with self._lock:
+            if stage_name not in self._stages:
+                self._stages[stage_name] = [0.0, 0]
+            self._stages[stage_name][0] += seconds
+            self._stages[stage_name][1] += count
+
+    def merge(self, stage_times):
+        """
+        Add the stage times of another timer, i.e. the timer of an inference process.
+        :param stage_times: A dictionary as returned by get_stage_times
+        :return:
+        """
+        for stage_name, stage_time in stage_times.items():
+            self.add(stage_name, stage_time['seconds'], stage_time['count'])
+
+    def get_stage_times(self):
+        """
+        Returns the time spent in each stage.
+        :return: A dictionary of stage name -> {'seconds': total seconds, 'count': number of times timed}
+        """
+        with self._lock:
+            return OrderedDict((stage_name, {'seconds': seconds, 'count': count})
+                               for stage_name, (seconds, count) in self._stages.items())
+
+    def get_elapsed_time(self):
+        """
+        Returns the seconds since the timer was created.
+        :return:
+        """
+        return time.time() - self._start_time
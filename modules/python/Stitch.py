@@ -1,12 +1,11 @@
-import h5py
 import sys
 import concurrent.futures
 import numpy as np
-from collections import defaultdict
-import operator
 from modules.python.TextColor import TextColor
 from modules.python.Options import StitchOptions
 from modules.python.FileManager import FileManager
+from modules.python.MaskedRegions import MaskedRegions
+from modules.python.DataStore import DataStore
 from build import HELEN
 import re
 
@@ -93,18 +92,57 @@ class Stitch:
         # if we can't find any anchors return negative values
         return -1, -1
 
-    def alignment_stitch(self, sequence_chunks):
+    @staticmethod
+    def masked_stitch(running_sequence, running_end, masked_tail, this_start, this_end, this_sequence, this_masked):
+        """
+        Stitch a sequence to the running sequence when one of them is a masked span. The sequence of a masked span is
+        the draft sequence (or Ns), so it has the same coordinates as the contig and we can join at the contig
+        positions without an alignment.
+        :param running_sequence: The sequence stitched so far
+        :param running_end: Contig end position of the running sequence
+        :param masked_tail: Length of the masked sequence at the end of the running sequence
+        :param this_start: Contig start position of the current sequence
+        :param this_end: Contig end position of the current sequence
+        :param this_sequence: The current sequence
+        :param this_masked: True if the current sequence is a masked span
+        :return: The running sequence, its end and the length of the masked sequence at its end
+        """
+        if this_start >= running_end:
+            # no overlap, compensate the gap with Ns like we do for other chunks
+            sys.stderr.write(TextColor.YELLOW + "WARNING: NO OVERLAP IN CHUNKS: " + str(this_start) + " "
+                             + str(running_end) + "\n" + TextColor.END)
+            return running_sequence + 10 * 'N' + this_sequence, this_end, len(this_sequence) if this_masked else 0
+
+        overlap_bases = running_end - this_start
+        if this_masked:
+            # keep the running sequence and add the masked sequence after the end of it
+            if this_end <= running_end:
+                return running_sequence, running_end, masked_tail
+            masked_extension = this_sequence[overlap_bases:]
+            return running_sequence + masked_extension, this_end, masked_tail + len(masked_extension)
+
+        # the running sequence ends with a masked span, replace the overlapping masked bases with this sequence
+        trimmed_bases = min(overlap_bases, masked_tail)
+        return running_sequence[:len(running_sequence) - trimmed_bases] + this_sequence, this_end, 0
+
+    def alignment_stitch(self, sequence_chunks, masked_spans=None):
         """
         This is a stitch worker. This method gets a chunk of contiguous sequence that it stitches.
         The method is very simple, it performs an ssw alignment, finds an anchor position and concatenates
         two adjacent sequences that overlap.
         :param sequence_chunks: A list of sequence chunks in (contig, start, end, sequence) format.
+        :param masked_spans: Set of (start, end) of the sequence chunks that are masked spans filled with the draft
+                             sequence, these are joined at contig positions instead of an alignment.
         :return:
         """
+        if masked_spans is None:
+            masked_spans = set()
         # we make sure that the chunks are sorted by the positions
         sequence_chunks = sorted(sequence_chunks, key=lambda element: (element[1], element[2]))
         # pick the first sequence to be the running sequence
         contig, running_start, running_end, running_sequence = sequence_chunks[0]
+        # length of the masked sequence at the end of the running sequence
+        masked_tail = len(running_sequence) if (running_start, running_end) in masked_spans else 0
 
         # initialize an ssw aligner
         aligner = HELEN.Aligner(StitchOptions.MATCH_PENALTY, StitchOptions.MISMATCH_PENALTY,
@@ -116,6 +154,13 @@ class Stitch:
         for i in range(1, len(sequence_chunks)):
             # get the current suquence
             _, this_start, this_end, this_sequence = sequence_chunks[i]
+            # masked spans are in contig coordinates, we join them without an alignment
+            this_masked = (this_start, this_end) in masked_spans
+            if this_masked or masked_tail > 0:
+                running_sequence, running_end, masked_tail = \
+                    self.masked_stitch(running_sequence, running_end, masked_tail, this_start, this_end,
+                                       this_sequence, this_masked)
+                continue
             # make sure the current sequence overlaps with the previously processed sequence
             if this_start < running_end:
                 # overlap
@@ -198,54 +243,23 @@ class Stitch:
         :param small_chunk_keys: Chunk keys in list as (contig_name, start_position, end_position)
         :return:
         """
-        # for chunk_key in small_chunk_keys:
         name_sequence_tuples = list()
 
-        # go through all the chunk keys
-        for contig_name, chunk_name, contig_start, contig_end in small_chunk_keys:
-            smaller_chunks = []
-            with h5py.File(file_name, 'r') as hdf5_file:
-                if 'predictions' in hdf5_file:
-                    smaller_chunks = set(hdf5_file['predictions'][contig][chunk_name].keys()) - \
-                                     {'contig_start', 'contig_end'}
-
-            smaller_chunks = sorted(smaller_chunks)
-            all_positions = set()
-            # now create two dictionaries where we will save all the predictions
-            base_prediction_dict = defaultdict()
-            rle_prediction_dict = defaultdict()
-            for chunk in smaller_chunks:
-                # grab the predictions and the positions
-                with h5py.File(file_name, 'r') as hdf5_file:
-                    bases = hdf5_file['predictions'][contig][chunk_name][chunk]['bases'][()]
-                    rles = hdf5_file['predictions'][contig][chunk_name][chunk]['rles'][()]
-                    positions = hdf5_file['predictions'][contig][chunk_name][chunk]['position'][()]
-
-                positions = np.array(positions, dtype=np.int64)
-                base_predictions = np.array(bases, dtype=np.int)
-                rle_predictions = np.array(rles, dtype=np.int)
-
-                # now iterate over each position and add the predictions to the dictionary
-                for position, base_pred, rle_pred in zip(positions, base_predictions, rle_predictions):
-                    indx = position[1]
-                    pos = position[0]
-                    split_indx = position[2]
-                    if indx < 0 or pos < 0:
-                        continue
-                    if (pos, indx, split_indx) not in base_prediction_dict:
-                        base_prediction_dict[(pos, indx, split_indx)] = base_pred
-                        rle_prediction_dict[(pos, indx, split_indx)] = rle_pred
-                        all_positions.add((pos, indx, split_indx))
-
-            # now simply create a position list and query the  dictionary to generate the predicted sequence
-            pos_list = sorted(list(all_positions), key=lambda element: (element[0], element[1], element[2]))
-            dict_fetch = operator.itemgetter(*pos_list)
-            predicted_base_labels = list(dict_fetch(base_prediction_dict))
-            predicted_rle_labels = list(dict_fetch(rle_prediction_dict))
-            sequence = ''.join([StitchOptions.label_decoder[base] * int(rle)
-                                for base, rle in zip(predicted_base_labels, predicted_rle_labels)])
+        # read the predictions of all the chunks at once, the columns of each chunk are sorted by position and each
+        # position is predicted once
+        with DataStore.open(file_name, 'r') as prediction_file:
+            region_table, positions, bases, rles = \
+                prediction_file.read_contig(contig, [(contig_start, contig_end)
+                                                     for contig_name, chunk_name, contig_start, contig_end
+                                                     in small_chunk_keys])
+
+        for region in region_table:
+            region_slice = slice(region['offset'], region['offset'] + region['length'])
+            # the predicted sequence of the chunk
+            sequence = ''.join([StitchOptions.label_decoder[base] * rle
+                                for base, rle in zip(bases[region_slice].tolist(), rles[region_slice].tolist())])
             # now add the generated sequence for further stitching
-            name_sequence_tuples.append((contig, contig_start, contig_end, sequence))
+            name_sequence_tuples.append((contig, int(region['contig_start']), int(region['contig_end']), sequence))
 
         # now we have all the regional sequences generated we can add them using ssw.
         name_sequence_tuples = sorted(name_sequence_tuples, key=lambda element: (element[1], element[2]))
@@ -255,13 +269,16 @@ class Stitch:
 
         return contig, running_start, running_end, running_sequence
 
-    def create_consensus_sequence(self, hdf5_file_path, contig, sequence_chunk_keys, threads):
+    def create_consensus_sequence(self, hdf5_file_path, contig, sequence_chunk_keys, threads,
+                                  masked_chunk_keys=None, draft_sequence=None):
         """
         This is the consensus sequence create method that creates a sequence for a given contig.
         :param hdf5_file_path: Path to the hdf5 file
         :param contig: Contig name
         :param sequence_chunk_keys: All the chunk keys in the contig
         :param threads: Number of available threads
+        :param masked_chunk_keys: (start, end) of the chunks that were not predicted because they are masked
+        :param draft_sequence: Draft sequence of the contig used to fill the masked chunks, Ns are used if None
         :return: A consensus sequence for a contig
         """
         # first we sort the sequence chunks
@@ -273,13 +290,26 @@ class Stitch:
         # we sort based on positions
         sequence_chunk_key_list = sorted(sequence_chunk_key_list, key=lambda element: (element[2], element[3]))
 
+        # the masked chunks overlap each other, merge them into spans that we fill with the draft sequence
+        masked_starts, masked_ends = MaskedRegions.merge_intervals([(int(st), int(end))
+                                                                    for st, end in masked_chunk_keys or []])
+        masked_spans = list(zip(masked_starts.tolist(), masked_ends.tolist()))
+
+        # the chunks between two masked spans are stitched separately from the chunks after the next masked span
+        segment_ids = np.searchsorted(masked_starts, [element[2] for element in sequence_chunk_key_list],
+                                      side='right')
+        segment_boundaries = np.concatenate(([0], np.flatnonzero(np.diff(segment_ids)) + 1,
+                                             [len(sequence_chunk_key_list)]))
+
         sequence_chunks = list()
         # we submit the chunks in process pool
         with concurrent.futures.ProcessPoolExecutor(max_workers=threads) as executor:
             # this chunks the keys into sucessive chunks
-            file_chunks = FileManager.chunks(sequence_chunk_key_list,
-                                             max(StitchOptions.MIN_SEQUENCE_REQUIRED_FOR_MULTITHREADING,
-                                                 int(len(sequence_chunk_key_list) / threads) + 1))
+            chunk_size = max(StitchOptions.MIN_SEQUENCE_REQUIRED_FOR_MULTITHREADING,
+                             int(len(sequence_chunk_key_list) / threads) + 1)
+            file_chunks = list()
+            for segment_start, segment_end in zip(segment_boundaries[:-1], segment_boundaries[1:]):
+                file_chunks.extend(FileManager.chunks(sequence_chunk_key_list[segment_start:segment_end], chunk_size))
 
             # we do the stitching per chunk of keys
             futures = [executor.submit(self.small_chunk_stitch, hdf5_file_path, contig, file_chunk)
@@ -294,9 +324,17 @@ class Stitch:
                     sys.stderr.write("ERROR: " + str(fut.exception()) + "\n")
                 fut._result = None  # python issue 27144
 
+        # fill the masked spans with the draft sequence or Ns
+        for masked_start, masked_end in masked_spans:
+            if draft_sequence is not None:
+                masked_sequence = draft_sequence[masked_start:masked_end]
+            else:
+                masked_sequence = (masked_end - masked_start) * 'N'
+            sequence_chunks.append((contig, masked_start, masked_end, masked_sequence))
+
         sequence_chunks = sorted(sequence_chunks, key=lambda element: (element[1], element[2]))
 
         # and do a final stitching on all the sequences we generated
-        contig, contig_start, contig_end, sequence = self.alignment_stitch(sequence_chunks)
+        contig, contig_start, contig_end, sequence = self.alignment_stitch(sequence_chunks, set(masked_spans))
 
         return sequence
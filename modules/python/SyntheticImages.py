@@ -0,0 +1,140 @@
+import os
+import h5py
+import numpy as np
+from modules.python.Options import ImageSizeOptions
+
+
+class SyntheticImages(object):
+    """
+    Generates hdf5 files with random images in the same layout as the images MarginPolish generates:
+        images/<image_name>/image              (length, IMAGE_HEIGHT) uint8 pileup summary
+        images/<image_name>/position           (length, 3) int64 genomic position, insert index and split index
+        images/<image_name>/contig             [contig name]
+        images/<image_name>/contig_start       [start of the MarginPolish chunk]
+        images/<image_name>/contig_end         [end of the MarginPolish chunk]
+        images/<image_name>/feature_chunk_idx  [index of the image in the chunk]
+    and optionally label_base and label_run_length for training. The values are random, so the files are only
+    useful to measure the speed of the pipeline, not the accuracy.
+
+    The images are laid out like MarginPolish does it: each contig is split into chunks of chunk_size bases that
+    overlap by chunk_overlap bases and each chunk is split into images of SEQ_LENGTH columns. The last image of a
+    chunk is usually shorter than SEQ_LENGTH.
+    """
+    def __init__(self, total_contigs=2, contig_length=100000, chunk_size=1000, chunk_overlap=200,
+                 insert_fraction=0.2, seed=0):
+        """
+        Object initialization function
+        :param total_contigs: Number of contigs
+        :param contig_length: Length of each contig in bases
+        :param chunk_size: Size of the MarginPolish chunks in bases
+        :param chunk_overlap: Number of bases adjacent chunks overlap
+        :param insert_fraction: Fraction of the columns that are inserts (run-length compressed positions with an
+                                insert index above 0), this sets how many columns a chunk has
+        :param seed: Seed of the random number generator
+        """
+        if chunk_overlap >= chunk_size:
+            raise ValueError("INVALID CHUNK OVERLAP: " + str(chunk_overlap) + " IS NOT SMALLER THAN CHUNK SIZE "
+                             + str(chunk_size))
+        self.total_contigs = total_contigs
+        self.contig_length = contig_length
+        self.chunk_size = chunk_size
+        self.chunk_overlap = chunk_overlap
+        self.insert_fraction = insert_fraction
+        self.random = np.random.RandomState(seed)
+
+    def get_chunks(self):
+        """
+        Returns all the MarginPolish chunks of the contigs.
+        :return: A list of (contig, contig_start, contig_end) tuples
+        """
+        chunks = []
+        for contig_id in range(self.total_contigs):
+            contig = "contig_" + str(contig_id + 1)
+            for contig_start in range(0, self.contig_length, self.chunk_size - self.chunk_overlap):
+                contig_end = min(contig_start + self.chunk_size, self.contig_length)
+                chunks.append((contig, contig_start, contig_end))
+                if contig_end == self.contig_length:
+                    break
+        return chunks
+
+    def get_chunk_positions(self, contig_start, contig_end):
+        """
+        Generate the positions of all the columns of a chunk. Each base position has a column with insert index 0
+        followed by a random number of insert columns.
+        :param contig_start: Start of the chunk
+        :param contig_end: End of the chunk
+        :return: (columns, 3) int64 array of positions
+        """
+        bases = np.arange(contig_start, contig_end, dtype=np.int64)
+        inserts = self.random.geometric(1.0 - self.insert_fraction, size=len(bases)) - 1
+        total_columns = len(bases) + int(np.sum(inserts))
+
+        positions = np.zeros((total_columns, 3), dtype=np.int64)
+        positions[:, 0] = np.repeat(bases, inserts + 1)
+        # the insert index counts up from 0 for each base
+        column_starts = np.repeat(np.cumsum(inserts + 1) - (inserts + 1), inserts + 1)
+        positions[:, 1] = np.arange(total_columns) - column_starts
+        return positions
+
+    def write_file(self, hdf5_file_path, chunks, with_labels=False):
+        """
+        Write the images of the given chunks to an hdf5 file.
+        :param hdf5_file_path: Path to the output file
+        :param chunks: List of (contig, contig_start, contig_end) tuples
+        :param with_labels: If true, random base and run-length labels are saved with each image
+        :return: Number of images and total number of columns written
+        """
+        total_images = 0
+        total_columns = 0
+        with h5py.File(hdf5_file_path, 'w') as hdf5_file:
+            for contig, contig_start, contig_end in chunks:
+                positions = self.get_chunk_positions(contig_start, contig_end)
+                for chunk_id, image_start in enumerate(range(0, len(positions), ImageSizeOptions.SEQ_LENGTH)):
+                    image_positions = positions[image_start:image_start + ImageSizeOptions.SEQ_LENGTH]
+                    image_length = len(image_positions)
+                    image_name = str(contig) + "_" + str(contig_start) + "_" + str(contig_end) + "_" + str(chunk_id)
+
+                    image_group = hdf5_file.create_group('images/' + image_name)
+                    image_group['image'] = self.random.randint(0, 256, size=(image_length,
+                                                                              ImageSizeOptions.IMAGE_HEIGHT),
+                                                               dtype=np.uint8)
+                    image_group['position'] = image_positions
+                    image_group['contig'] = np.array([contig.encode()])
+                    image_group['contig_start'] = np.array([contig_start], dtype=np.int64)
+                    image_group['contig_end'] = np.array([contig_end], dtype=np.int64)
+                    image_group['feature_chunk_idx'] = np.array([chunk_id], dtype=np.int64)
+                    if with_labels:
+                        image_group['label_base'] = \
+                            self.random.randint(0, ImageSizeOptions.TOTAL_BASE_LABELS, size=image_length,
+                                                dtype=np.uint8)
+                        image_group['label_run_length'] = \
+                            self.random.randint(0, ImageSizeOptions.TOTAL_RLE_LABELS, size=image_length,
+                                                dtype=np.uint8)
+                    total_images += 1
+                    total_columns += image_length
+
+        return total_images, total_columns
+
+    def generate(self, output_dir, total_files, with_labels=False):
+        """
+        Generate all the chunks of the contigs and split them between the given number of files.
+        :param output_dir: Path to the output directory
+        :param total_files: Number of hdf5 files to write
+        :param with_labels: If true, random base and run-length labels are saved with each image
+        :return: Number of images and total number of columns written
+        """
+        chunks = self.get_chunks()
+        chunks_per_file = (len(chunks) + total_files - 1) // total_files
+
+        total_images = 0
+        total_columns = 0
+        for file_id in range(total_files):
+            file_chunks = chunks[file_id * chunks_per_file:(file_id + 1) * chunks_per_file]
+            if not file_chunks:
+                break
+            hdf5_file_path = os.path.join(output_dir, "synthetic_images_" + str(file_id) + ".h5")
+            file_images, file_columns = self.write_file(hdf5_file_path, file_chunks, with_labels)
+            total_images += file_images
+            total_columns += file_columns
+
+        return total_images, total_columns
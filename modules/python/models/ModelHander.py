@@ -1,12 +1,20 @@
 import torch
+import torch.nn as nn
 import os
-from modules.python.models.TransducerModel import TransducerGRU
+import inspect
+import zipfile
+from modules.python.models.TransducerModel import TransducerGRU, ReducedPrecisionTransducer, ImageTransducer
+from modules.python.Options import ImageSizeOptions, TrainOptions, InferenceOptions
 
 
 class ModelHandler:
     """
     The ModelHandler class handles different model saving/loading operations that we do.
     """
+    # format tag of the slim inference checkpoints written by save_inference_checkpoint
+    _inference_format_ = 'helen_inference'
+    _inference_format_version_ = 1
+
     @staticmethod
     def save_checkpoint(state, filename):
         """
@@ -35,7 +43,26 @@ class ModelHandler:
         return transducer_model
 
     @staticmethod
-    def load_simple_model(model_path, input_channels, image_features, seq_len, num_base_classes, num_rle_classes):
+    def set_model_precision(transducer_model, precision):
+        """
+        Convert a loaded model to the precision we want to run the inference in.
+        :param transducer_model: A loaded model
+        :param precision: fp32, bf16 or int8
+        :return: The converted model
+        """
+        if precision == 'fp32':
+            return transducer_model
+        elif precision == 'bf16':
+            return ReducedPrecisionTransducer(transducer_model, torch.bfloat16)
+        elif precision == 'int8':
+            # dynamic quantization stores the weights in int8 and quantizes the activations on the fly
+            return torch.quantization.quantize_dynamic(transducer_model, {nn.GRU, nn.Linear}, dtype=torch.qint8)
+        else:
+            raise ValueError("INVALID MODEL PRECISION: " + str(precision))
+
+    @staticmethod
+    def load_simple_model(model_path, input_channels, image_features, seq_len, num_base_classes, num_rle_classes,
+                          precision='fp32'):
         """
         This method loads a model from a given model path.
         :param model_path: Path to a model
@@ -44,15 +71,21 @@ class ModelHandler:
         :param seq_len: Length of the sequence in one image
         :param num_base_classes: Number of base classes
         :param num_rle_classes: Number of RLE classes
+        :param precision: Precision of the loaded model for inference, fp32 (default), bf16 or int8
         :return: A loaded model with some other auxiliary information
         """
         # first load the model to cpu, it's usually a dicttionary
-        checkpoint = torch.load(model_path, map_location='cpu')
+        checkpoint = ModelHandler.load_checkpoint(model_path)
         # extract auxiliary information from the model dictionary
         hidden_size = checkpoint['hidden_size']
         gru_layers = checkpoint['gru_layers']
         epochs = checkpoint['epochs']
 
+        # slim inference checkpoints have the architecture and the weights with clean names
+        if checkpoint.get('format') == ModelHandler._inference_format_:
+            ModelHandler.check_model_architecture(checkpoint, model_path, input_channels, image_features,
+                                                  num_base_classes, num_rle_classes)
+
         # create a new model
         transducer_model = ModelHandler.get_new_gru_model(input_channels=input_channels,
                                                           image_features=image_features,
@@ -63,24 +96,105 @@ class ModelHandler:
         # load the model state/weights
         model_state_dict = checkpoint['model_state_dict']
 
-        # now create a state dict that we can load to the new model
-        from collections import OrderedDict
-        new_model_state_dict = OrderedDict()
+        if checkpoint.get('format') == ModelHandler._inference_format_:
+            # the names are already clean, float16 weights are cast to float32 when they are copied to the model
+            new_model_state_dict = model_state_dict
+        else:
+            # now create a state dict that we can load to the new model
+            from collections import OrderedDict
+            new_model_state_dict = OrderedDict()
 
-        for k, v in model_state_dict.items():
-            name = k
-            # this happens due to training on the GPU. It's a pytorch issue, we can't fix it.
-            if k[0:7] == 'module.':
-                name = k[7:]  # remove `module.`
-            new_model_state_dict[name] = v
+            for k, v in model_state_dict.items():
+                name = k
+                # this happens due to training on the GPU. It's a pytorch issue, we can't fix it.
+                if k[0:7] == 'module.':
+                    name = k[7:]  # remove `module.`
+                new_model_state_dict[name] = v
 
         # transfer the weights to the new model
         transducer_model.load_state_dict(new_model_state_dict)
         transducer_model.cpu()
 
+        # convert the model to the precision we run the inference in
+        transducer_model = ModelHandler.set_model_precision(transducer_model, precision)
+
         # return the loaded model
         return transducer_model, hidden_size, gru_layers, epochs
 
+    @staticmethod
+    def load_checkpoint(model_path):
+        """
+        Load a checkpoint to cpu. Checkpoints saved in the zip format of torch.save are memory mapped, so only the
+        tensors we use are read from the file, i.e. not the optimizer state of a training checkpoint.
+        :param model_path: Path to a checkpoint
+        :return: The checkpoint dictionary
+        """
+        load_arguments = {}
+        # memory mapping needs a zip checkpoint and a pytorch version that supports it
+        if 'mmap' in inspect.signature(torch.load).parameters and zipfile.is_zipfile(model_path):
+            load_arguments['mmap'] = True
+
+        return torch.load(model_path, map_location='cpu', **load_arguments)
+
+    @staticmethod
+    def check_model_architecture(checkpoint, model_path, input_channels, image_features, num_base_classes,
+                                 num_rle_classes):
+        """
+        Check that a slim inference checkpoint was exported for the images and labels we use.
+        :param checkpoint: A slim inference checkpoint
+        :param model_path: Path to the checkpoint, used in the error message
+        :param input_channels: Number of channels in the input image
+        :param image_features: Number of features in one column of the pileup
+        :param num_base_classes: Number of base classes
+        :param num_rle_classes: Number of RLE classes
+        :return:
+        """
+        if checkpoint['format_version'] > ModelHandler._inference_format_version_:
+            raise ValueError("UNSUPPORTED MODEL FORMAT VERSION " + str(checkpoint['format_version']) + ": "
+                             + model_path)
+
+        expected_architecture = {'input_channels': input_channels,
+                                 'image_features': image_features,
+                                 'num_base_classes': num_base_classes,
+                                 'num_rle_classes': num_rle_classes}
+        for key, value in expected_architecture.items():
+            if checkpoint['architecture'][key] != value:
+                raise ValueError("MODEL ARCHITECTURE MISMATCH: " + key + " IS " + str(checkpoint['architecture'][key])
+                                 + " IN " + model_path + ", EXPECTED " + str(value))
+
+    @staticmethod
+    def save_inference_checkpoint(transducer_model, hidden_size, gru_layers, epochs, file_name, half=False):
+        """
+        Save a slim checkpoint for inference. It has only the weights of the model, with the names the model uses,
+        and the architecture of the model. The optimizer state of the training checkpoint is dropped.
+        :param transducer_model: A loaded model
+        :param hidden_size: Hidden layer size of the model
+        :param gru_layers: Number of layers in the model
+        :param epochs: Number of epochs model has been trained on
+        :param file_name: Name of the output file
+        :param half: If true, the weights are stored in float16, they are cast back to float32 when loaded
+        :return:
+        """
+        model_state_dict = transducer_model.state_dict()
+        if half:
+            model_state_dict = {name: value.half() if value.is_floating_point() else value
+                                for name, value in model_state_dict.items()}
+
+        ModelHandler.save_checkpoint({
+            'format': ModelHandler._inference_format_,
+            'format_version': ModelHandler._inference_format_version_,
+            'architecture': {'input_channels': ImageSizeOptions.IMAGE_CHANNELS,
+                             'image_features': ImageSizeOptions.IMAGE_HEIGHT,
+                             'num_base_classes': ImageSizeOptions.TOTAL_BASE_LABELS,
+                             'num_rle_classes': ImageSizeOptions.TOTAL_RLE_LABELS,
+                             'bidirectional': True},
+            'weights_dtype': 'float16' if half else 'float32',
+            'model_state_dict': model_state_dict,
+            'hidden_size': hidden_size,
+            'gru_layers': gru_layers,
+            'epochs': epochs,
+        }, file_name)
+
     @staticmethod
     def load_simple_optimizer(transducer_optimizer, checkpoint_path, gpu_mode):
         """
@@ -132,4 +246,83 @@ class ModelHandler:
             'epochs': epoch,
         }, file_name)
 
+    @staticmethod
+    def load_inference_model(model_path, backend='torch', precision='fp32'):
+        """
+        Load a model that runs with pytorch for inference. A pytorch checkpoint (.pkl) is run with pytorch and an
+        exported TorchScript module (.pt) with the TorchScript interpreter, the TorchScript module runs on CPU in
+        float32. Exported ONNX graphs run without pytorch, see ONNXModel.
+        :param model_path: Path to a model
+        :param backend: torch or torchscript, the backend of the model file
+        :param precision: Precision of the loaded model for inference, only used by pytorch checkpoints
+        :return: A model in evaluation mode that takes (images, hidden) and returns (base, rle, hidden)
+        """
+        if backend != 'torch' and precision != 'fp32':
+            raise ValueError("INVALID MODEL PRECISION FOR " + backend + " MODEL: " + str(precision))
+
+        if backend == 'torchscript':
+            transducer_model = torch.jit.load(model_path, map_location='cpu')
+        elif backend != 'torch':
+            raise ValueError("INVALID PYTORCH MODEL BACKEND: " + str(backend))
+        else:
+            transducer_model, hidden_size, gru_layers, prev_ite = \
+                ModelHandler.load_simple_model(model_path,
+                                               input_channels=ImageSizeOptions.IMAGE_CHANNELS,
+                                               image_features=ImageSizeOptions.IMAGE_HEIGHT,
+                                               seq_len=ImageSizeOptions.SEQ_LENGTH,
+                                               num_base_classes=ImageSizeOptions.TOTAL_BASE_LABELS,
+                                               num_rle_classes=ImageSizeOptions.TOTAL_RLE_LABELS,
+                                               precision=precision)
+
+        return transducer_model.eval()
+
+    @staticmethod
+    def export_torchscript(transducer_model, file_name):
+        """
+        Export a model to a TorchScript module. The module keeps the hidden input and output of the model, predict
+        runs it one window at a time like the pytorch model.
+        :param transducer_model: A loaded model
+        :param file_name: Name of the output file
+        :return:
+        """
+        scripted_model = torch.jit.script(transducer_model.eval())
+        torch.jit.save(scripted_model, file_name)
+
+    @staticmethod
+    def export_onnx(transducer_model, file_name, inference_mode=InferenceOptions.DEFAULT_INFERENCE_MODE):
+        """
+        Export a model to an ONNX graph that predicts whole images. The graph takes a minibatch of uint8 images and
+        returns the base and rle labels of each column. The windows of the inference mode are unrolled in the graph,
+        so the hidden state is carried between them and their outputs are summed inside the graph. The batch size
+        can change between runs. The inference mode is saved in the metadata of the graph.
+        :param transducer_model: A loaded model
+        :param file_name: Name of the output file
+        :param inference_mode: Window scheme of the graph, one of InferenceOptions.INFERENCE_MODES
+        :return:
+        """
+        # onnx is only needed to export, so we import it here
+        import onnx
+        from modules.python.models.ONNXModel import ONNXModel
+
+        window_size, window_jump = InferenceOptions.INFERENCE_MODES[inference_mode]
+        image_model = ImageTransducer(transducer_model.eval(), window_size, window_jump, ImageSizeOptions.SEQ_LENGTH)
+        images = torch.zeros(2, ImageSizeOptions.SEQ_LENGTH, ImageSizeOptions.IMAGE_HEIGHT, dtype=torch.uint8)
+
+        export_arguments = {}
+        # the newer exporters are used by default in recent pytorch versions, we use the TorchScript based one
+        if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+            export_arguments['dynamo'] = False
+
+        torch.onnx.export(image_model.eval(),
+                          (images,),
+                          file_name,
+                          input_names=['images'],
+                          output_names=['base_labels', 'rle_labels'],
+                          dynamic_axes={'images': {0: 'batch'},
+                                        'base_labels': {0: 'batch'},
+                                        'rle_labels': {0: 'batch'}},
+                          **export_arguments)
 
+        onnx_model = onnx.load(file_name)
+        onnx.helper.set_model_props(onnx_model, {ONNXModel._inference_mode_key_: inference_mode})
+        onnx.save(onnx_model, file_name)
@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class ONNXModel(object):
+    """
+    Runs a model exported to ONNX by export_model.py with onnxruntime. The exported graph runs all the windows of
+    the images, carries the hidden state between them and picks the label of each column, so a minibatch is
+    predicted with one call into onnxruntime. It takes and returns numpy arrays, so ONNX models run without pytorch.
+    """
+    # name of the metadata entry that holds the inference mode the graph was exported with
+    _inference_mode_key_ = 'helen_inference_mode'
+
+    def __init__(self, model_path, threads):
+        """
+        Load the exported model in an onnxruntime session.
+        :param model_path: Path to the exported ONNX model
+        :param threads: Number of threads onnxruntime can use
+        """
+        # onnxruntime is only needed for this backend, so we import it here
+        import onnxruntime
+
+        session_options = onnxruntime.SessionOptions()
+        session_options.intra_op_num_threads = threads
+        session_options.inter_op_num_threads = 1
+        self.session = onnxruntime.InferenceSession(model_path, session_options,
+                                                    providers=['CPUExecutionProvider'])
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if self._inference_mode_key_ not in metadata:
+            raise ValueError("THE ONNX MODEL RUNS ONE WINDOW AT A TIME, IT WAS EXPORTED BY AN OLDER VERSION OF HELEN. "
+                             "PLEASE EXPORT THE MODEL AGAIN WITH export_model.py: " + model_path)
+        self.inference_mode = metadata[self._inference_mode_key_]
+
+    def __call__(self, images):
+        """
+        Predict the labels of a minibatch of images.
+        :param images: A minibatch of uint8 images in (batch_size, SEQ_LENGTH, IMAGE_HEIGHT) shape
+        :return: Predicted base and rle labels of each column in uint8 numpy arrays
+        """
+        base_labels, rle_labels = self.session.run(None, {'images': np.ascontiguousarray(images, dtype=np.uint8)})
+
+        return base_labels, rle_labels
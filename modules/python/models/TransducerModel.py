@@ -91,3 +91,78 @@ class TransducerGRU(nn.Module):
             num_directions = 2
 
         return torch.zeros(batch_size, num_directions * num_layers, self.hidden_size)
+
+
+class ReducedPrecisionTransducer(nn.Module):
+    """
+    Runs a model in a reduced precision floating point type. The inputs are cast to the type of the model and the
+    outputs are cast back to float32, so the model can be used the same way as a float32 model.
+    """
+    def __init__(self, transducer_model, dtype):
+        """
+        The initialization of the model
+        :param transducer_model: A TransducerGRU model
+        :param dtype: The floating point type to run the model in, i.e. torch.bfloat16
+        """
+        super(ReducedPrecisionTransducer, self).__init__()
+        self.dtype = dtype
+        self.transducer_model = transducer_model.to(dtype)
+
+    def forward(self, x, hidden):
+        """
+        The forward method of the model.
+        :param x: Input image
+        :param hidden: Hidden input
+        :return:
+        """
+        base_out, rle_out, hidden_final = self.transducer_model(x.to(self.dtype), hidden.to(self.dtype))
+
+        return base_out.float(), rle_out.float(), hidden_final.float()
+
+
+class ImageTransducer(nn.Module):
+    """
+    Runs a model on whole images the way predict_images does: the images are processed in windows, the hidden state
+    is carried from one window to the next, the softmax outputs of the windows that cover a column are summed and
+    the label with the highest sum is picked for each column. The window loop is unrolled when the module is
+    exported, so an exported graph predicts a minibatch in one call. The window scheme is fixed when the module is
+    created.
+    """
+    def __init__(self, transducer_model, window_size, window_jump, seq_length):
+        """
+        The initialization of the model
+        :param transducer_model: A TransducerGRU model
+        :param window_size: Number of columns in a window
+        :param window_jump: Number of columns between the starts of two windows
+        :param seq_length: Number of columns in an image
+        """
+        super(ImageTransducer, self).__init__()
+        self.transducer_model = transducer_model
+        self.window_starts = [i for i in range(0, seq_length, window_jump) if i + window_size <= seq_length]
+        self.window_size = window_size
+        self.seq_length = seq_length
+
+    def forward(self, images):
+        """
+        The forward method of the model.
+        :param images: A minibatch of uint8 images in (batch_size, seq_length, image_features) shape
+        :return: Base and rle labels of each column in uint8
+        """
+        images = images.float()
+        hidden = images.new_zeros(images.size(0), 2 * self.transducer_model.num_layers,
+                                  self.transducer_model.hidden_size)
+
+        prediction_base = None
+        prediction_rle = None
+        for chunk_start in self.window_starts:
+            chunk_end = chunk_start + self.window_size
+            output_base, output_rle, hidden = self.transducer_model(images[:, chunk_start:chunk_end], hidden)
+
+            # the softmax of the window is padded to the image length, so the sums are made without in place writes
+            padding = (0, 0, chunk_start, self.seq_length - chunk_end)
+            window_base = nn.functional.pad(torch.softmax(output_base, dim=2), padding)
+            window_rle = nn.functional.pad(torch.softmax(output_rle, dim=2), padding)
+            prediction_base = window_base if prediction_base is None else prediction_base + window_base
+            prediction_rle = window_rle if prediction_rle is None else prediction_rle + window_rle
+
+        return torch.argmax(prediction_base, dim=2).to(torch.uint8), torch.argmax(prediction_rle, dim=2).to(torch.uint8)
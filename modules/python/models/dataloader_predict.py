@@ -1,68 +1,58 @@
+import os
+import time
+import queue
+import tempfile
+import threading
+import traceback
+import multiprocessing
 import numpy as np
-from torch.utils.data import Dataset
-import torchvision.transforms as transforms
-import h5py
-import sys
-from modules.python.TextColor import TextColor
 from modules.python.Options import ImageSizeOptions
-from modules.python.FileManager import FileManager
+from modules.python.ImageIndex import ImageIndex
+from modules.python.HDF5FilePool import HDF5FilePool
 
 
-class SequenceDataset(Dataset):
+class SequenceDataset(object):
     """
     This class implements the dataset class for the dataloader to use.
     This version is intended to use with predict.py.
-    It initializes all the given images and returns each image through __getitem__.
+    It initializes all the given images and returns each image through __getitem__ or a whole batch of images
+    through __getitems__. pytorch is only imported by the methods that return tensors, read_batch returns numpy
+    arrays so the images can be read without pytorch.
     """
 
     def __init__(self, image_directory):
         """
-        This method initializes the dataset by loading all the image information. It creates a sequential list
-        call all_images from which we can grab images iteratively through __getitem__.
+        This method initializes the dataset by loading all the image information. It loads an index of
+        all the images from which we can grab images iteratively through __getitem__.
         :param image_directory: Path to a directory where all the images are saved.
         """
-        # transformer to convert loaded objects to tensors
-        self.transform = transforms.Compose([transforms.ToTensor()])
+        # the index of all the images in the directory. It holds the file, name and the contig information of each
+        # image as numpy arrays, so we don't have to open the files to get these values.
+        self.image_index = ImageIndex.load(image_directory)
 
-        # a list of file-image pairs, where we have (file_name, image_name) as values so we can fetch images
-        # from the list of files.
-        file_image_pair = []
-
-        # get all the h5 files that we have in the directory
-        hdf_files = FileManager.get_file_paths_from_directory(image_directory)
-        for hdf5_file_path in hdf_files:
-            # for each of the files get all the images
-            with h5py.File(hdf5_file_path, 'r') as hdf5_file:
-                if 'images' in hdf5_file:
-                    image_names = list(hdf5_file['images'].keys())
-
-                    # save the file-image pair to the list
-                    for image_name in image_names:
-                        file_image_pair.append((hdf5_file_path, image_name))
-                else:
-                    sys.stderr.write(TextColor.YELLOW + "WARN: NO IMAGES FOUND IN FILE: "
-                                     + hdf5_file_path + "\n" + TextColor.END)
-
-        # save the list to all_images so we can access the list inside other methods
-        self.all_images = file_image_pair
+        # the files stay open between items, each dataloader worker keeps its own pool of open files
+        self.file_pool = HDF5FilePool()
 
     def __getitem__(self, index):
         """
         This method returns a single object. Dataloader uses this method to load images and then minibatches the loaded
         images
-        :param index: Index indicating which image from all_images to be loaded
+        :param index: Index indicating which image from the image index to be loaded
         :return: image and their auxiliary information
         """
-        hdf5_filepath, image_name = self.all_images[index]
+        hdf5_filepath = self.image_index.get_file_path(index)
+        image_name = self.image_index.image_name[index]
+
+        # the contig information of the image is already in the index
+        contig = self.image_index.get_contig(index)
+        contig_start = self.image_index.contig_start[index]
+        contig_end = self.image_index.contig_end[index]
+        chunk_id = self.image_index.chunk_id[index]
 
-        # load all the information we need to save in the prediction hdf5
-        with h5py.File(hdf5_filepath, 'r') as hdf5_file:
-            contig = np.array2string(hdf5_file['images'][image_name]['contig'][()][0].astype(np.str)).replace("'", '')
-            contig_start = hdf5_file['images'][image_name]['contig_start'][()][0].astype(np.int)
-            contig_end = hdf5_file['images'][image_name]['contig_end'][()][0].astype(np.int)
-            chunk_id = hdf5_file['images'][image_name]['feature_chunk_idx'][()][0].astype(np.int)
-            image = hdf5_file['images'][image_name]['image'][()].astype(np.uint8)
-            position = hdf5_file['images'][image_name]['position'][()].astype(np.int)
+        # load the image and the positions we need to save in the prediction hdf5
+        image_group = self.file_pool.get_image_group(hdf5_filepath, image_name)
+        image = image_group['image'][()].astype(np.uint8)
+        position = image_group['position'][()].astype(np.int64)
 
         # if the size of the image is smaller than the sequence length, then we need to pad to the image to make
         # it to image size.
@@ -74,7 +64,7 @@ class SequenceDataset(Dataset):
 
             empty_positions = np.array([[-1, -1, -1]] * total_empty_needed)
             position = np.append(position, empty_positions, 0)
-            position = position.astype(np.int)
+            position = position.astype(np.int64)
 
         # at this point the image size should be SEQ_LENGTH, if not then raise a ValueError.
         if image.shape[0] < ImageSizeOptions.SEQ_LENGTH or position.shape[0] < ImageSizeOptions.SEQ_LENGTH:
@@ -82,9 +72,462 @@ class SequenceDataset(Dataset):
 
         return contig, contig_start, contig_end, chunk_id, image, position, hdf5_filepath
 
+    def read_batch(self, indices):
+        """
+        This method reads a whole minibatch. The images are read directly into one preallocated buffer, so we
+        don't need to pad and stack the images one by one. The indices are expected to come from the
+        FileLocalityBatchSampler, so all the images of a file are read one after another from the same open file.
+        :param indices: Indices of the images from the image index to be loaded
+        :return: Batched images in a numpy array, their auxiliary information, the number of real (not padded)
+                 columns of each image and the time spent reading and collating the batch. The times are returned with
+                 the batch because the batch may be loaded in a dataloader worker process.
+        """
+        start_time = time.time()
+        indices = np.asarray(indices, dtype=np.int64)
+        batch_size = len(indices)
+
+        # the images are padded with zero columns and the positions with -1 up to SEQ_LENGTH
+        images = np.zeros((batch_size, ImageSizeOptions.SEQ_LENGTH, ImageSizeOptions.IMAGE_HEIGHT), dtype=np.uint8)
+        positions = np.full((batch_size, ImageSizeOptions.SEQ_LENGTH, 3), -1, dtype=np.int64)
+
+        file_ids = self.image_index.file_id[indices]
+        image_names = self.image_index.image_name[indices]
+        lengths = np.minimum(self.image_index.length[indices], ImageSizeOptions.SEQ_LENGTH)
+
+        # split the batch into runs of images that belong to the same file
+        read_start_time = time.time()
+        run_starts = np.concatenate(([0], np.flatnonzero(np.diff(file_ids)) + 1))
+        run_ends = np.append(run_starts[1:], batch_size)
+        for run_start, run_end in zip(run_starts, run_ends):
+            images_group = self.file_pool.get_images_group(self.image_index.file_paths[file_ids[run_start]])
+
+            for i in range(run_start, run_end):
+                image_group = images_group[image_names[i]]
+                image_length = lengths[i]
+                image_group['image'].read_direct(images, np.s_[:image_length], np.s_[i, :image_length])
+                image_group['position'].read_direct(positions, np.s_[:image_length], np.s_[i, :image_length])
+        read_time = time.time() - read_start_time
+
+        contigs = [str(contig) for contig in self.image_index.contig_names[self.image_index.contig_id[indices]]]
+        contig_starts = self.image_index.contig_start[indices]
+        contig_ends = self.image_index.contig_end[indices]
+        chunk_ids = self.image_index.chunk_id[indices]
+        filenames = [self.image_index.file_paths[file_id] for file_id in file_ids]
+
+        stage_times = {'hdf5_read': read_time, 'collate': time.time() - start_time - read_time}
+
+        return contigs, contig_starts, contig_ends, chunk_ids, images, positions, filenames, lengths, stage_times
+
+    def __getitems__(self, indices):
+        """
+        This method returns a whole minibatch for the dataloader, it is the batch of read_batch with the images in a
+        tensor.
+        :param indices: Indices of the images from the image index to be loaded
+        :return: The batch of read_batch with the images in a tensor
+        """
+        import torch
+
+        contigs, contig_starts, contig_ends, chunk_ids, images, positions, filenames, lengths, stage_times = \
+            self.read_batch(indices)
+
+        return contigs, contig_starts, contig_ends, chunk_ids, torch.from_numpy(images), positions, filenames, \
+            lengths, stage_times
+
+    @staticmethod
+    def collate(batch):
+        """
+        The batches returned by __getitems__ are already collated, so the dataloader can pass them as they are.
+        Dataloaders of torch older than 2.0 don't use __getitems__, they load the images one by one through
+        __getitem__ and pass a list of them. That list is stacked here into the same batch __getitems__ returns.
+        :param batch: A batch returned by __getitems__ or a list of images returned by __getitem__
+        :return: The batch in the format of __getitems__
+        """
+        if isinstance(batch, tuple):
+            return batch
+
+        import torch
+
+        start_time = time.time()
+        contigs, contig_starts, contig_ends, chunk_ids, images, positions, filenames = zip(*batch)
+
+        positions = np.stack(positions)
+        # the padded columns of an image have -1 positions
+        lengths = np.count_nonzero(positions[:, :, 0] >= 0, axis=1).astype(np.int32)
+        images = torch.from_numpy(np.stack(images))
+
+        # the images were read by __getitem__ before the list was passed here, so the read time is not known
+        stage_times = {'hdf5_read': 0.0, 'collate': time.time() - start_time}
+
+        return list(contigs), np.array(contig_starts), np.array(contig_ends), np.array(chunk_ids), images, \
+            positions, list(filenames), lengths, stage_times
+
     def __len__(self):
         """
         Returns the length of the dataset
         :return: Int value containing the length of the dataset
         """
-        return len(self.all_images)
+        return len(self.image_index)
+
+
+class FileLocalityBatchSampler(object):
+    """
+    This sampler creates minibatches for the SequenceDataset so that the images of a batch are grouped by the file
+    they belong to and sorted by their names. This way a batch is read from as few files as possible and the files
+    are read in order.
+
+    Optionally the images are first bucketed by their length, so the short images at the ends of contigs and chunks
+    end up in the same minibatches and the model can stop at the end of the longest image of a minibatch. Most
+    images are full length and fall in the same bucket, so they are still read in file order.
+    """
+    def __init__(self, image_index, batch_size, image_indices=None, length_bucket_size=None):
+        """
+        Object initialization function
+        :param image_index: The ImageIndex of the dataset
+        :param batch_size: Number of images in each minibatch
+        :param image_indices: Indices of the images to sample from the index, default is all the images
+        :param length_bucket_size: If given, images are grouped in buckets of this many columns by their length
+        """
+        self.batch_size = batch_size
+        if image_indices is None:
+            image_indices = np.arange(len(image_index))
+        image_indices = np.asarray(image_indices, dtype=np.int64)
+        sort_keys = (image_index.image_name[image_indices], image_index.file_id[image_indices])
+        if length_bucket_size is not None:
+            lengths = np.minimum(image_index.length[image_indices], ImageSizeOptions.SEQ_LENGTH)
+            sort_keys += ((lengths + length_bucket_size - 1) // length_bucket_size,)
+        self.order = image_indices[np.lexsort(sort_keys)]
+
+    def __iter__(self):
+        """
+        Yields the indices of each minibatch.
+        :return:
+        """
+        for i in range(0, len(self.order), self.batch_size):
+            yield self.order[i:i + self.batch_size].tolist()
+
+    def __len__(self):
+        """
+        Returns the number of minibatches
+        :return:
+        """
+        return (len(self.order) + self.batch_size - 1) // self.batch_size
+
+
+def mmap_loader_worker(dataset, buffer_path, buffer_slots, batch_size, task_queue, result_queue):
+    """
+    Worker process of the MmapBatchLoader. Reads the minibatches it is given and writes their images and positions
+    to a slot of the shared buffer file, the rest of the minibatch is sent back through the result queue.
+    :param dataset: A SequenceDataset
+    :param buffer_path: Path to the buffer file
+    :param buffer_slots: Number of minibatches the buffer holds
+    :param batch_size: Maximum number of images in a minibatch
+    :param task_queue: Queue of (batch id, slot, indices) tasks, None to stop
+    :param result_queue: Queue where (batch id, slot, minibatch without images and positions) are sent
+    :return:
+    """
+    import torch
+
+    # the worker only reads, the main process runs the model
+    torch.set_num_threads(1)
+    images_buffer, positions_buffer = MmapBatchLoader.open_buffer(buffer_path, buffer_slots, batch_size, 'r+')
+    while True:
+        task = task_queue.get()
+        if task is None:
+            break
+        batch_id, slot, indices = task
+        try:
+            contigs, contig_starts, contig_ends, chunk_ids, images, positions, filenames, lengths, stage_times = \
+                dataset.read_batch(indices)
+            images_buffer[slot, :len(indices)] = images
+            positions_buffer[slot, :len(indices)] = positions
+            result_queue.put((batch_id, slot, (contigs, contig_starts, contig_ends, chunk_ids, filenames, lengths,
+                                               stage_times)))
+        except Exception:
+            result_queue.put((batch_id, slot, traceback.format_exc()))
+            break
+
+
+class MmapBatchLoader(object):
+    """
+    Loads the minibatches of a SequenceDataset in worker processes, like the DataLoader does, but without shared
+    memory. The DataLoader workers pass tensors through /dev/shm, which is 64MB in a default Docker container, so
+    it can only be used with 0 workers there. These workers write the images and positions of each minibatch to a
+    slot of a memory mapped file in a directory we choose (i.e. the output directory), only the small auxiliary
+    values go through a pipe. The page cache keeps the file in memory, so this is about as fast as shared memory.
+
+    The file has 2 slots per worker and each slot holds a whole minibatch, about 100KB per image (90KB of image and
+    12KB of int32 positions). With -b 512 -w 8 that is 0.8GB of disk that also stays in the page cache while the
+    images are predicted.
+    """
+    def __init__(self, dataset, batch_sampler, num_workers, buffer_directory, prefetch_batches=2, pin_memory=False):
+        """
+        Object initialization function
+        :param dataset: A SequenceDataset
+        :param batch_sampler: A FileLocalityBatchSampler that creates the minibatches
+        :param num_workers: Number of worker processes, at least one is used
+        :param buffer_directory: Directory where the buffer file is created, it is deleted at the end
+        :param prefetch_batches: Number of minibatches each worker can load ahead of the model
+        :param pin_memory: If true, the images are copied out of the buffer to pinned memory, so they can be copied
+                           to the GPU asynchronously
+        """
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+        self.num_workers = max(1, num_workers)
+        self.buffer_directory = buffer_directory
+        self.buffer_slots = self.num_workers * prefetch_batches
+        self.pin_memory = pin_memory
+
+    def __len__(self):
+        """
+        Returns the number of minibatches
+        :return:
+        """
+        return len(self.batch_sampler)
+
+    @staticmethod
+    def open_buffer(buffer_path, buffer_slots, batch_size, mode):
+        """
+        Memory map the images and positions buffers of a buffer file. The positions are saved as int32, the genomic
+        positions of a contig fit in it.
+        :param buffer_path: Path to the buffer file
+        :param buffer_slots: Number of minibatches the buffer holds
+        :param batch_size: Maximum number of images in a minibatch
+        :param mode: Mode of the memory map, w+ to create the file
+        :return: The images and positions buffers
+        """
+        images_shape = (buffer_slots, batch_size, ImageSizeOptions.SEQ_LENGTH, ImageSizeOptions.IMAGE_HEIGHT)
+        positions_shape = (buffer_slots, batch_size, ImageSizeOptions.SEQ_LENGTH, 3)
+        images_buffer = np.memmap(buffer_path, dtype=np.uint8, mode=mode, shape=images_shape)
+        # the positions start right after the images, int32 needs an aligned offset
+        positions_offset = (int(np.prod(images_shape)) + 3) // 4 * 4
+        positions_buffer = np.memmap(buffer_path, dtype=np.int32, mode='r+', offset=positions_offset,
+                                     shape=positions_shape)
+        return images_buffer, positions_buffer
+
+    def __iter__(self):
+        """
+        Yields the minibatches in the order of the sampler.
+        :return:
+        """
+        import torch
+
+        batches = list(self.batch_sampler)
+        batch_size = self.batch_sampler.batch_size
+
+        buffer_file, buffer_path = tempfile.mkstemp(prefix='helen_loader_', suffix='.buf', dir=self.buffer_directory)
+        os.close(buffer_file)
+        # the workers are started like the DataLoader starts its workers, with fork on Linux, so they don't have to
+        # import torch again
+        context = multiprocessing.get_context()
+        task_queue = context.Queue()
+        result_queue = context.Queue()
+        workers = []
+        try:
+            images_buffer, positions_buffer = self.open_buffer(buffer_path, self.buffer_slots, batch_size, 'w+')
+            workers = [context.Process(target=mmap_loader_worker,
+                                       args=(self.dataset, buffer_path, self.buffer_slots, batch_size, task_queue,
+                                             result_queue),
+                                       daemon=True)
+                       for _ in range(self.num_workers)]
+            for worker in workers:
+                worker.start()
+
+            free_slots = list(range(self.buffer_slots))
+            next_task = 0
+            loaded_batches = {}
+            for batch_id in range(len(batches)):
+                # keep all the free slots busy, the batches are handed out in order so the next one is always loading
+                while free_slots and next_task < len(batches):
+                    task_queue.put((next_task, free_slots.pop(), batches[next_task]))
+                    next_task += 1
+
+                while batch_id not in loaded_batches:
+                    try:
+                        loaded_batch_id, slot, batch = result_queue.get(timeout=10)
+                    except queue.Empty:
+                        if not all(worker.is_alive() for worker in workers):
+                            raise RuntimeError("A DATA LOADER WORKER STOPPED UNEXPECTEDLY.")
+                        continue
+                    if isinstance(batch, str):
+                        raise RuntimeError("DATA LOADER WORKER FAILED:\n" + batch)
+                    loaded_batches[loaded_batch_id] = (slot, batch)
+
+                slot, (contigs, contig_starts, contig_ends, chunk_ids, filenames, lengths, stage_times) = \
+                    loaded_batches.pop(batch_id)
+                # copy the batch out of its slot, so the slot can be reused while the model runs on the batch
+                total_images = len(batches[batch_id])
+                images = torch.empty(images_buffer[slot, :total_images].shape, dtype=torch.uint8,
+                                     pin_memory=self.pin_memory)
+                images.numpy()[:] = images_buffer[slot, :total_images]
+                positions = positions_buffer[slot, :total_images].astype(np.int64)
+                free_slots.append(slot)
+
+                yield contigs, contig_starts, contig_ends, chunk_ids, images, positions, filenames, lengths, \
+                    stage_times
+        finally:
+            for _ in workers:
+                task_queue.put(None)
+            for worker in workers:
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+            os.remove(buffer_path)
+
+
+class BatchReader(object):
+    """
+    Reads the minibatches of a SequenceDataset in the order of the sampler in the calling process. The images are
+    returned in numpy arrays, so this is the loader used when the model runs without pytorch (i.e. ONNX models).
+    """
+    def __init__(self, dataset, batch_sampler):
+        """
+        Object initialization function
+        :param dataset: A SequenceDataset
+        :param batch_sampler: A FileLocalityBatchSampler that creates the minibatches
+        """
+        self.dataset = dataset
+        self.batch_sampler = batch_sampler
+
+    def __len__(self):
+        """
+        Returns the number of minibatches
+        :return:
+        """
+        return len(self.batch_sampler)
+
+    def __iter__(self):
+        """
+        Yields the minibatches in the order of the sampler.
+        :return:
+        """
+        for indices in self.batch_sampler:
+            yield self.dataset.read_batch(indices)
+
+
+class BatchPrefetcher(object):
+    """
+    Prefetches the minibatches of a dataloader so the next minibatch is ready when the model finishes the current
+    one. The images stay in uint8 until they are on the device the model runs on, so we only move a quarter of the
+    bytes of a float image.
+
+    On GPU the dataloader pins the batches in memory and the images of the next minibatch are copied to the GPU
+    on a separate CUDA stream while the model runs on the current one. On CPU a background thread keeps loading the
+    next minibatches from the dataloader.
+    """
+    def __init__(self, data_loader, gpu_mode, prefetch_batches=2):
+        """
+        Object initialization function
+        :param data_loader: A DataLoader, MmapBatchLoader or BatchReader that yields minibatches of the SequenceDataset
+        :param gpu_mode: If true, the tensors of each minibatch are copied to the GPU ahead of time
+        :param prefetch_batches: Number of minibatches the CPU thread loads ahead of the model
+        """
+        self.data_loader = data_loader
+        self.gpu_mode = gpu_mode
+        self.prefetch_batches = prefetch_batches
+
+    def __len__(self):
+        """
+        Returns the number of minibatches
+        :return:
+        """
+        return len(self.data_loader)
+
+    def __iter__(self):
+        """
+        Yields the minibatches of the dataloader.
+        :return:
+        """
+        if self.gpu_mode:
+            return self._iterate_cuda()
+        return self._iterate_thread()
+
+    @staticmethod
+    def _batch_to_device(batch, stream):
+        """
+        Start copying all the tensors of a minibatch to the GPU on a stream.
+        :param batch: A minibatch as returned by the dataloader
+        :param stream: The CUDA stream used for the copy
+        :return: The minibatch with its tensors on the GPU
+        """
+        import torch
+
+        with torch.cuda.stream(stream):
+            return tuple(value.cuda(non_blocking=True) if torch.is_tensor(value) else value for value in batch)
+
+    def _iterate_cuda(self):
+        """
+        Double buffered GPU prefetch: while the model uses one minibatch the next one is copied to the GPU.
+        :return:
+        """
+        import torch
+
+        copy_stream = torch.cuda.Stream()
+        next_batch = None
+        for batch in self.data_loader:
+            batch = self._batch_to_device(batch, copy_stream)
+            if next_batch is not None:
+                yield self._wait_for_batch(next_batch, copy_stream)
+            next_batch = batch
+        if next_batch is not None:
+            yield self._wait_for_batch(next_batch, copy_stream)
+
+    @staticmethod
+    def _wait_for_batch(batch, stream):
+        """
+        Make the current stream wait for the copy of a minibatch and tell the allocator that the tensors are used
+        by the current stream.
+        :param batch: A minibatch with its tensors on the GPU
+        :param stream: The CUDA stream used for the copy
+        :return: The minibatch
+        """
+        import torch
+
+        current_stream = torch.cuda.current_stream()
+        current_stream.wait_stream(stream)
+        for value in batch:
+            if torch.is_tensor(value):
+                value.record_stream(current_stream)
+        return batch
+
+    def _iterate_thread(self):
+        """
+        Load the minibatches in a background thread and yield them as they are ready.
+        :return:
+        """
+        batch_queue = queue.Queue(maxsize=self.prefetch_batches)
+        stop_event = threading.Event()
+        end_of_data = object()
+
+        # every put gives up when the consumer stops, so the thread never waits on a full queue nobody reads
+        def put_item(item):
+            while not stop_event.is_set():
+                try:
+                    batch_queue.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def load_batches():
+            try:
+                for batch in self.data_loader:
+                    if not put_item(batch):
+                        return
+                put_item(end_of_data)
+            except Exception as error:
+                put_item(error)
+
+        loader_thread = threading.Thread(target=load_batches, name='BatchPrefetcher', daemon=True)
+        loader_thread.start()
+        try:
+            while True:
+                batch = batch_queue.get()
+                if batch is end_of_data:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # if the consumer stops early, let the thread finish instead of waiting on a full queue
+            stop_event.set()
+            loader_thread.join()
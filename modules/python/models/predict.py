@@ -1,14 +1,22 @@
+import os
 import sys
-import torch
-import torch.nn as nn
-from torch.utils.data import DataLoader
-from modules.python.models.dataloader_predict import SequenceDataset
+import json
+import time
+import queue
+import shutil
+import traceback
+import contextlib
+from modules.python.models.dataloader_predict import SequenceDataset, FileLocalityBatchSampler, MmapBatchLoader, \
+    BatchReader, BatchPrefetcher
+from modules.python.models.ONNXModel import ONNXModel
 from modules.python.TextColor import TextColor
 from tqdm import tqdm
 import numpy as np
-from modules.python.models.ModelHander import ModelHandler
-from modules.python.Options import ImageSizeOptions, TrainOptions
+from modules.python.Options import ImageSizeOptions, TrainOptions, InferenceOptions
 from modules.python.DataStore import DataStore
+from modules.python.PredictionWriter import PredictionWriter
+from modules.python.MaskedRegions import MaskedRegions
+from modules.python.StageTimer import StageTimer
 """
 This script implements the predict method that is used by the call consensus method.
 
@@ -27,13 +35,602 @@ The algorithm is described here:
         - Iterates over the input images in minibatch
         - For each image uses a sliding window method to slide of the image sequence
         - Aggregate the predictions to get sequence prediction for the entire image sequence
-        - Save all the predictions to a file
+        - Save all the predictions to a file, a background thread writes the predictions of a minibatch while the
+          model runs on the next one
   3) OUTPUT:
     - A hdf5 file containing all the base predictions   
+
+pytorch is imported by the functions that run pytorch models, so models exported to ONNX are run without it.
 """
 
 
-def predict(test_file, output_filename, model_path, batch_size, num_workers, threads, gpu_mode):
+class PredictionAccumulator(object):
+    """
+    Holds the sum of the softmax outputs of all the windows of a minibatch. The buffers are allocated once on the
+    device the model runs on and reused for every minibatch, the output of each window is added in place to the
+    columns of the window.
+    """
+    def __init__(self, batch_size, gpu_mode):
+        """
+        Object initialization function
+        :param batch_size: Largest minibatch size the accumulator will be used with
+        :param gpu_mode: If true, the buffers are allocated on the GPU
+        """
+        import torch
+
+        self.prediction_base_buffer = torch.zeros((batch_size, ImageSizeOptions.SEQ_LENGTH,
+                                                   ImageSizeOptions.TOTAL_BASE_LABELS))
+        self.prediction_rle_buffer = torch.zeros((batch_size, ImageSizeOptions.SEQ_LENGTH,
+                                                  ImageSizeOptions.TOTAL_RLE_LABELS))
+        if gpu_mode:
+            self.prediction_base_buffer = self.prediction_base_buffer.cuda()
+            self.prediction_rle_buffer = self.prediction_rle_buffer.cuda()
+
+        self.prediction_base_tensor = None
+        self.prediction_rle_tensor = None
+
+    def reset(self, batch_size):
+        """
+        Start accumulating a new minibatch.
+        :param batch_size: Size of the minibatch
+        :return:
+        """
+        if batch_size > self.prediction_base_buffer.size(0):
+            raise ValueError("BATCH SIZE ERROR: " + str(batch_size) + " IS LARGER THAN THE ACCUMULATOR SIZE "
+                             + str(self.prediction_base_buffer.size(0)))
+        self.prediction_base_tensor = self.prediction_base_buffer[:batch_size]
+        self.prediction_rle_tensor = self.prediction_rle_buffer[:batch_size]
+        self.prediction_base_tensor.zero_()
+        self.prediction_rle_tensor.zero_()
+
+    def add(self, chunk_start, chunk_end, output_base, output_rle):
+        """
+        Add the softmax of a window's output to the columns of the window.
+        :param chunk_start: First column of the window
+        :param chunk_end: End of the window
+        :param output_base: Base output of the model for the window
+        :param output_rle: RLE output of the model for the window
+        :return:
+        """
+        self.prediction_base_tensor[:, chunk_start:chunk_end].add_(output_base.softmax(dim=2))
+        self.prediction_rle_tensor[:, chunk_start:chunk_end].add_(output_rle.softmax(dim=2))
+
+    def get_labels(self):
+        """
+        Pick the label with the highest sum for each column. The argmax is done on the device, so only the uint8
+        labels are copied back.
+        :return: Predicted base and rle labels in numpy arrays
+        """
+        base_labels = self.prediction_base_tensor.argmax(dim=2).byte()
+        rle_labels = self.prediction_rle_tensor.argmax(dim=2).byte()
+
+        return base_labels.cpu().numpy(), rle_labels.cpu().numpy()
+
+
+def predict_images(transducer_model, images, inference_mode, gpu_mode, accumulator=None, lengths=None,
+                   stage_timer=None):
+    """
+    Run the model on a minibatch of images. The images are processed in windows and the hidden state is carried
+    from one window to the next. In sliding mode the windows overlap and the softmax outputs of all the windows
+    that cover a column are summed before we pick the label of the column.
+
+    If the lengths of the images are given, we stop after the last window that starts before the end of the longest
+    image. The windows after that only cover padding, so the predictions of the real columns don't change and the
+    padded columns get the label 0.
+    :param transducer_model: A loaded model in evaluation mode
+    :param images: A minibatch of uint8 images in (batch_size, SEQ_LENGTH, IMAGE_HEIGHT) shape, on CPU or already
+                   on the GPU
+    :param inference_mode: One of the modes in InferenceOptions.INFERENCE_MODES
+    :param gpu_mode: If true, predictions will be done over GPU
+    :param accumulator: A PredictionAccumulator to reuse between minibatches, a new one is created if not given
+    :param lengths: Number of real columns of each image, if not given all the windows are run
+    :param stage_timer: If given, the time spent in the forward passes, the accumulation of the softmax outputs and
+                        picking the labels is added to the forward, accumulate and labels stages. On GPU the forward
+                        and accumulate times are the time to launch the kernels, the labels stage waits for them.
+    :return: Predicted base and rle labels of each column in numpy arrays
+    """
+    # the images are in uint8, move them to the GPU before converting them to float so we copy less data
+    if gpu_mode and not images.is_cuda:
+        images = images.cuda(non_blocking=True)
+    images = images.float()
+
+    # initialize the first hidden input as all zeros
+    hidden = images.new_zeros(images.size(0), 2 * TrainOptions.GRU_LAYERS, TrainOptions.HIDDEN_SIZE)
+
+    # this is a multi-task neural network where we predict a base and a run-length. The accumulator keeps the sum
+    # of the predictions of all the windows, later we pick the label with the highest sum for each column.
+    if accumulator is None:
+        accumulator = PredictionAccumulator(images.size(0), gpu_mode)
+    accumulator.reset(images.size(0))
+
+    # now the images usually contain 1000 bases, we iterate on a sliding window basis where we process
+    # the window size then jump to the next window
+    window_size, window_jump = InferenceOptions.INFERENCE_MODES[inference_mode]
+    # the columns after the longest image in the batch are all padding
+    max_length = ImageSizeOptions.SEQ_LENGTH if lengths is None else int(np.max(lengths))
+    forward_time = 0.0
+    accumulate_time = 0.0
+    for i in range(0, ImageSizeOptions.SEQ_LENGTH, window_jump):
+        # if current position + window size goes beyond the size of the window, that means we've reached the end
+        if i + window_size > ImageSizeOptions.SEQ_LENGTH:
+            break
+        # all the images of the batch end before this window
+        if i >= max_length:
+            break
+        chunk_start = i
+        chunk_end = i + window_size
+
+        # get the image chunk
+        image_chunk = images[:, chunk_start:chunk_end]
+
+        # run inference
+        start_time = time.time()
+        output_base, output_rle, hidden = transducer_model(image_chunk, hidden)
+        forward_time += time.time() - start_time
+
+        # add the softmax of the outputs to the columns of this window
+        start_time = time.time()
+        accumulator.add(chunk_start, chunk_end, output_base, output_rle)
+        accumulate_time += time.time() - start_time
+
+    # all done now pick a label for each of the SEQ_LENGTH columns
+    start_time = time.time()
+    base_labels, rle_labels = accumulator.get_labels()
+
+    if stage_timer is not None:
+        stage_timer.add('forward', forward_time)
+        stage_timer.add('accumulate', accumulate_time)
+        stage_timer.add('labels', time.time() - start_time)
+
+    return base_labels, rle_labels
+
+
+def profile_stage(stage_name, profiler):
+    """
+    Label a stage in the profiler trace. Without a profiler nothing is recorded, so the minibatches don't pay for
+    the profiler when it is not used.
+    :param stage_name: Name of the stage in the trace
+    :param profiler: A running torch.profiler.profile or None
+    :return: A context manager that records the stage
+    """
+    if profiler is None:
+        return contextlib.nullcontext()
+
+    import torch
+    return torch.profiler.record_function(stage_name)
+
+
+def predict_batches(transducer_model, test_data, batch_sampler, num_workers, batch_size, inference_mode, gpu_mode,
+                    stage_timer=None, profiler=None, loader=InferenceOptions.DEFAULT_LOADER, buffer_directory=None):
+    """
+    Run the model on all the minibatches of a dataset. This is a generator, it yields the predictions of one
+    minibatch at a time. The time spent waiting for the data and running the model is added to the data_load and
+    inference stages of the stage timer, the time the dataset spent reading and collating the minibatches to the
+    hdf5_read and collate stages.
+    :param transducer_model: A loaded model in evaluation mode
+    :param test_data: A SequenceDataset
+    :param batch_sampler: A FileLocalityBatchSampler that creates the minibatches
+    :param num_workers: Number of workers to be used by the dataloader
+    :param batch_size: Batch size used for minibatch prediction
+    :param inference_mode: Window scheme used to run the model, one of InferenceOptions.INFERENCE_MODES
+    :param gpu_mode: If true, predictions will be done over GPU
+    :param stage_timer: A StageTimer to add the stage times to
+    :param profiler: A running torch.profiler.profile, it is stepped after each minibatch
+    :param loader: How the workers pass the minibatches, one of InferenceOptions.LOADERS
+    :param buffer_directory: Directory of the buffer file of the mmap loader
+    :return: (contig, contig_start, contig_end, chunk_id, position, base_labels, rle_labels, filename) of a minibatch
+    """
+    import torch
+    from torch.utils.data import DataLoader
+
+    if stage_timer is None:
+        stage_timer = StageTimer()
+
+    # create a pytorch dataloader that loads the data in mini_batches. The sampler groups the images of a batch by
+    # their files and the dataset reads the whole batch at once. On GPU the batches are pinned so they can be
+    # copied asynchronously. The mmap loader passes the batches through a file instead of shared memory.
+    if loader == 'mmap':
+        data_loader = MmapBatchLoader(test_data, batch_sampler, num_workers, buffer_directory, pin_memory=gpu_mode)
+    else:
+        data_loader = DataLoader(test_data,
+                                 batch_sampler=batch_sampler,
+                                 collate_fn=SequenceDataset.collate,
+                                 num_workers=num_workers,
+                                 pin_memory=gpu_mode)
+    # the prefetcher loads the next minibatch, and on GPU copies it to the device, while the model runs
+    test_loader = BatchPrefetcher(data_loader, gpu_mode)
+
+    # the prediction buffers are allocated once and reused for all the minibatches
+    accumulator = PredictionAccumulator(batch_size, gpu_mode)
+
+    # iterate over the data in minibatches
+    batch_iterator = iter(test_loader)
+    with torch.no_grad():
+        while True:
+            # wait for the next minibatch
+            start_time = time.time()
+            try:
+                with profile_stage('data_load', profiler):
+                    contig, contig_start, contig_end, chunk_id, images, position, filename, lengths, \
+                        load_stage_times = next(batch_iterator)
+            except StopIteration:
+                break
+            stage_timer.add('data_load', time.time() - start_time)
+            for stage_name, stage_time in load_stage_times.items():
+                stage_timer.add(stage_name, stage_time)
+
+            # run the model on the images and get a label for each column of the images
+            with stage_timer.stage('inference'), profile_stage('inference', profiler):
+                predicted_base_labels, predicted_rle_labels = predict_images(transducer_model, images,
+                                                                             inference_mode, gpu_mode, accumulator,
+                                                                             lengths, stage_timer)
+            if profiler is not None:
+                profiler.step()
+
+            yield contig, contig_start, contig_end, chunk_id, position, predicted_base_labels, \
+                predicted_rle_labels, filename
+
+
+def predict_batches_onnx(onnx_model, test_data, batch_sampler, stage_timer=None):
+    """
+    Run a model exported to ONNX on all the minibatches of a dataset. This is the predict_batches of ONNX models,
+    it runs without pytorch. The exported graph runs all the windows of the images, so each minibatch is predicted
+    with one call to the model while a background thread reads the next minibatches.
+    :param onnx_model: An ONNXModel
+    :param test_data: A SequenceDataset
+    :param batch_sampler: A FileLocalityBatchSampler that creates the minibatches
+    :param stage_timer: A StageTimer to add the stage times to
+    :return: (contig, contig_start, contig_end, chunk_id, position, base_labels, rle_labels, filename) of a minibatch
+    """
+    if stage_timer is None:
+        stage_timer = StageTimer()
+
+    test_loader = BatchPrefetcher(BatchReader(test_data, batch_sampler), gpu_mode=False)
+
+    # iterate over the data in minibatches
+    batch_iterator = iter(test_loader)
+    while True:
+        # wait for the next minibatch
+        start_time = time.time()
+        try:
+            contig, contig_start, contig_end, chunk_id, images, position, filename, lengths, load_stage_times = \
+                next(batch_iterator)
+        except StopIteration:
+            break
+        stage_timer.add('data_load', time.time() - start_time)
+        for stage_name, stage_time in load_stage_times.items():
+            stage_timer.add(stage_name, stage_time)
+
+        # the graph picks a label for each column of the images
+        with stage_timer.stage('inference'):
+            predicted_base_labels, predicted_rle_labels = onnx_model(images)
+
+        yield contig, contig_start, contig_end, chunk_id, position, predicted_base_labels, predicted_rle_labels, \
+            filename
+
+
+def get_profiler(trace_filename, profile_batches, gpu_mode):
+    """
+    Create a torch profiler that records a few minibatches after a warm-up and saves a Chrome trace. The trace can be
+    opened in chrome://tracing or https://ui.perfetto.dev.
+    :param trace_filename: Path to the Chrome trace file
+    :param profile_batches: Number of minibatches to record
+    :param gpu_mode: If true, the CUDA kernels are recorded too
+    :return: A torch.profiler.profile object that has to be started
+    """
+    import torch
+
+    activities = [torch.profiler.ProfilerActivity.CPU]
+    if gpu_mode:
+        activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+    def save_trace(profiler):
+        profiler.export_chrome_trace(trace_filename)
+        sys.stderr.write(TextColor.GREEN + "INFO: PROFILER TRACE SAVED TO: " + trace_filename + "\n" + TextColor.END)
+
+    return torch.profiler.profile(activities=activities,
+                                  schedule=torch.profiler.schedule(wait=InferenceOptions.PROFILE_WAIT_BATCHES,
+                                                                   warmup=InferenceOptions.PROFILE_WARMUP_BATCHES,
+                                                                   active=profile_batches,
+                                                                   repeat=1),
+                                  on_trace_ready=save_trace)
+
+
+def write_stage_report(stage_timer, report_filename, total_images):
+    """
+    Print the time spent in each stage of prediction and save it as a JSON report.
+    :param stage_timer: The StageTimer of the prediction
+    :param report_filename: Path to the JSON report
+    :param total_images: Number of images predicted
+    :return:
+    """
+    total_time = stage_timer.get_elapsed_time()
+    stage_times = stage_timer.get_stage_times()
+    for stage_time in stage_times.values():
+        stage_time['percent'] = 100.0 * stage_time['seconds'] / max(1e-9, total_time)
+
+    sys.stderr.write(TextColor.BLUE + "{:<12} {:>10} {:>8} {:>10}\n".format("STAGE", "SECONDS", "PERCENT", "COUNT")
+                     + TextColor.END)
+    for stage_name, stage_time in stage_times.items():
+        sys.stderr.write("{:<12} {:>10.2f} {:>8.1f} {:>10}\n".format(stage_name, stage_time['seconds'],
+                                                                    stage_time['percent'], stage_time['count']))
+
+    report = {'total_seconds': total_time,
+              'total_images': total_images,
+              'images_per_second': total_images / max(1e-9, total_time),
+              'stages': stage_times}
+    with open(report_filename, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+    sys.stderr.write(TextColor.GREEN + "INFO: STAGE TIMES SAVED TO: " + report_filename + "\n" + TextColor.END)
+
+
+def write_predictions(prediction_data_file, batch_predictions):
+    """
+    Save the predictions of a minibatch to the prediction file.
+    :param prediction_data_file: A DataStore object opened for writing
+    :param batch_predictions: Predictions of a minibatch as yielded by predict_batches
+    :return:
+    """
+    contig, contig_start, contig_end, chunk_id, position, predicted_base_labels, predicted_rle_labels, filename = \
+        batch_predictions
+
+    # save the predictions of all the images with a few writes
+    prediction_data_file.write_batch(contig, contig_start, contig_end, chunk_id, position, predicted_base_labels,
+                                     predicted_rle_labels)
+
+
+def inference_worker(worker_id, transducer_model, model_path, test_data, image_indices, batch_size, num_workers,
+                     threads, inference_mode, precision, result_queue, profile_batches=0, trace_filename=None,
+                     loader=InferenceOptions.DEFAULT_LOADER, buffer_directory=None):
+    """
+    This is a CPU inference worker process. It runs the shared model on a disjoint slice of the images and sends
+    the predictions to the main process which writes them to the prediction file.
+    :param worker_id: Id of the worker
+    :param transducer_model: A loaded pytorch model with its weights in shared memory, None for exported models
+    :param model_path: Path to the model, exported models are loaded by each worker
+    :param test_data: A SequenceDataset
+    :param image_indices: Indices of the images from the image index this worker predicts
+    :param batch_size: Batch size used for minibatch prediction
+    :param num_workers: Number of workers to be used by the dataloader of this process
+    :param threads: Number of threads to use with pytorch in this process
+    :param inference_mode: Window scheme used to run the model, one of InferenceOptions.INFERENCE_MODES
+    :param precision: Precision of the model during inference, one of InferenceOptions.PRECISIONS
+    :param result_queue: Queue where the predictions of each minibatch are sent, the stage times of the worker are
+                         sent when all the minibatches are done
+    :param profile_batches: Number of minibatches to record with the torch profiler, 0 to not profile
+    :param trace_filename: Path to the Chrome trace of the profiler
+    :param loader: How the dataloader workers pass the minibatches, one of InferenceOptions.LOADERS
+    :param buffer_directory: Directory of the buffer file of the mmap loader
+    :return:
+    """
+    try:
+        import torch
+        from modules.python.models.ModelHander import ModelHandler
+
+        stage_timer = StageTimer()
+        torch.set_num_threads(threads)
+        with stage_timer.stage('model_load'):
+            if transducer_model is None:
+                transducer_model = ModelHandler.load_inference_model(model_path, get_model_backend(model_path))
+            else:
+                # the reduced precision models can't be shared between processes, so each worker converts the
+                # shared model
+                transducer_model = ModelHandler.set_model_precision(transducer_model, precision)
+                transducer_model.eval()
+        # short images are batched together so the model can stop at the end of the longest image of a batch
+        batch_sampler = FileLocalityBatchSampler(test_data.image_index, batch_size, image_indices,
+                                                 InferenceOptions.INFERENCE_MODES[inference_mode][1])
+        profiler = get_profiler(trace_filename, profile_batches, gpu_mode=False) if profile_batches > 0 else None
+        if profiler is not None:
+            profiler.start()
+        for batch_predictions in predict_batches(transducer_model, test_data, batch_sampler, num_workers,
+                                                 batch_size, inference_mode, gpu_mode=False,
+                                                 stage_timer=stage_timer, profiler=profiler, loader=loader,
+                                                 buffer_directory=buffer_directory):
+            with stage_timer.stage('result_send'):
+                result_queue.put((worker_id, batch_predictions))
+        if profiler is not None:
+            profiler.stop()
+        result_queue.put((worker_id, stage_timer.get_stage_times()))
+    except Exception:
+        result_queue.put((worker_id, traceback.format_exc()))
+
+
+def predict_multiprocess(transducer_model, model_path, test_data, image_indices, prediction_data_file, batch_size,
+                         num_workers, threads, inference_processes, inference_mode, precision, stage_timer,
+                         profile_batches=0, trace_filename=None, loader=InferenceOptions.DEFAULT_LOADER,
+                         buffer_directory=None):
+    """
+    Run CPU inference with multiple processes. The model weights are moved to shared memory and each process
+    predicts a disjoint slice of the images with a small number of threads. The slices are made of whole files
+    so the processes don't read the same files. All the predictions are written to one prediction file by this
+    process.
+    :param transducer_model: A loaded float32 pytorch model in evaluation mode, None for exported models
+    :param model_path: Path to the model, used to load exported models in each process
+    :param test_data: A SequenceDataset
+    :param image_indices: Sorted indices of the images from the image index to predict
+    :param prediction_data_file: A DataStore object opened for writing
+    :param batch_size: Batch size used for minibatch prediction
+    :param num_workers: Number of workers to be used by the dataloader of each process
+    :param threads: Number of threads to use with pytorch in each process
+    :param inference_processes: Number of inference processes
+    :param inference_mode: Window scheme used to run the model, one of InferenceOptions.INFERENCE_MODES
+    :param precision: Precision of the model during inference, one of InferenceOptions.PRECISIONS
+    :param stage_timer: A StageTimer, the stage times of all the processes are added to it
+    :param profile_batches: Number of minibatches the first process records with the torch profiler
+    :param trace_filename: Path to the Chrome trace of the profiler
+    :param loader: How the dataloader workers pass the minibatches, one of InferenceOptions.LOADERS
+    :param buffer_directory: Directory of the buffer file of the mmap loader
+    :return:
+    """
+    import torch
+
+    if transducer_model is not None:
+        transducer_model.share_memory()
+
+    # the index is sorted by files, so contiguous slices of the sorted indices are made of whole files
+    file_ids = test_data.image_index.file_id[image_indices]
+    total_images = len(image_indices)
+    file_boundaries = np.concatenate(([0], np.flatnonzero(np.diff(file_ids)) + 1, [total_images]))
+    slice_boundaries = [file_boundaries[np.searchsorted(file_boundaries, total_images * i / inference_processes)]
+                        for i in range(inference_processes)] + [total_images]
+    image_slices = [image_indices[slice_boundaries[i]:slice_boundaries[i + 1]] for i in range(inference_processes)]
+
+    total_batches = sum((len(image_slice) + batch_size - 1) // batch_size for image_slice in image_slices)
+
+    context = torch.multiprocessing.get_context('spawn')
+    result_queue = context.Queue(maxsize=2 * inference_processes)
+    processes = [context.Process(target=inference_worker,
+                                 args=(worker_id, transducer_model, model_path, test_data, image_slices[worker_id],
+                                       batch_size, num_workers, threads, inference_mode, precision, result_queue,
+                                       profile_batches if worker_id == 0 else 0, trace_filename, loader,
+                                       buffer_directory))
+                 for worker_id in range(inference_processes)]
+
+    running_workers = set(range(inference_processes))
+    try:
+        for process in processes:
+            process.start()
+
+        with tqdm(total=total_batches, ncols=50) as progress_bar, \
+                PredictionWriter(prediction_data_file, write_predictions, InferenceOptions.WRITER_QUEUE_SIZE,
+                                 InferenceOptions.FLUSH_INTERVAL) as prediction_writer:
+            while running_workers:
+                try:
+                    worker_id, batch_predictions = result_queue.get(timeout=10)
+                except queue.Empty:
+                    # make sure the workers we are waiting for are still alive
+                    for worker_id in running_workers:
+                        if not processes[worker_id].is_alive():
+                            raise RuntimeError("INFERENCE PROCESS " + str(worker_id) +
+                                               " EXITED UNEXPECTEDLY WITH CODE " + str(processes[worker_id].exitcode))
+                    continue
+
+                if isinstance(batch_predictions, dict):
+                    # the worker is done and sent its stage times
+                    stage_timer.merge(batch_predictions)
+                    running_workers.remove(worker_id)
+                elif isinstance(batch_predictions, str):
+                    raise RuntimeError("INFERENCE PROCESS " + str(worker_id) + " FAILED:\n" + batch_predictions)
+                else:
+                    prediction_writer.write(batch_predictions)
+                    progress_bar.update(1)
+
+        stage_timer.add('write', prediction_writer.write_time)
+        stage_timer.add('writer_wait', prediction_writer.wait_time)
+    finally:
+        # if we stopped before all the workers were done, the other workers would keep running, so stop them
+        for process in processes:
+            if process.pid is None:
+                continue
+            if running_workers and process.is_alive():
+                process.terminate()
+            process.join()
+
+
+def get_model_backend(model_path):
+    """
+    Find the backend that runs a model from the extension of the model file.
+    :param model_path: Path to a model
+    :return: torch, torchscript or onnx
+    """
+    extension = os.path.splitext(model_path)[1].lower()
+    return InferenceOptions.MODEL_BACKENDS.get(extension, 'torch')
+
+
+def load_onnx_model(model_path, threads, inference_mode):
+    """
+    Load a model exported to ONNX. The windows are unrolled in the exported graph, so the graph has to be exported
+    with the inference mode we predict with.
+    :param model_path: Path to the exported model
+    :param threads: Number of threads onnxruntime can use
+    :param inference_mode: Window scheme used to predict, one of InferenceOptions.INFERENCE_MODES
+    :return: An ONNXModel
+    """
+    onnx_model = ONNXModel(model_path, threads)
+    if onnx_model.inference_mode != inference_mode:
+        raise ValueError(TextColor.RED + "ERROR: THE ONNX MODEL WAS EXPORTED WITH INFERENCE MODE "
+                         + onnx_model.inference_mode.upper() + ", EXPORT IT AGAIN WITH --inference_mode "
+                         + inference_mode + " TO PREDICT IN THIS MODE.\n" + TextColor.END)
+
+    return onnx_model
+
+
+def open_prediction_file(output_filename, resume):
+    """
+    Open the prediction file. If we resume a run and the file exists, the predictions that are already in the file
+    are kept, otherwise a new file is created. A file that is damaged so it can't be opened is moved out of the way,
+    replacing an older moved file. A file written by another version of helen raises a ValueError and is kept.
+    :param output_filename: Path to the prediction file
+    :param resume: If true, add to the predictions of an existing file
+    :return: A DataStore object opened for writing
+    """
+    if not resume or not os.path.exists(output_filename):
+        return DataStore.open(output_filename, mode='w')
+
+    try:
+        return DataStore.open(output_filename, mode='a')
+    except (OSError, json.JSONDecodeError):
+        # hdf5 files and the files of binary stores raise OSError when they are damaged, the layout of a binary
+        # store raises a JSONDecodeError
+        corrupt_filename = output_filename + '.corrupt'
+        sys.stderr.write(TextColor.YELLOW + "WARN: COULD NOT OPEN PREDICTION FILE TO RESUME, MOVED IT TO: "
+                         + corrupt_filename + " AND STARTING OVER.\n" + TextColor.END)
+        if os.path.isdir(corrupt_filename):
+            shutil.rmtree(corrupt_filename)
+        elif os.path.exists(corrupt_filename):
+            os.remove(corrupt_filename)
+        os.replace(output_filename, corrupt_filename)
+        return DataStore.open(output_filename, mode='w')
+
+
+def get_unpredicted_images(image_index, prediction_data_file):
+    """
+    Find the images of an index that don't have a prediction in the prediction file yet. The images of chunks that
+    the file saves as masked are not predicted either, stitch fills these chunks with the draft sequence.
+    :param image_index: The ImageIndex of the dataset
+    :param prediction_data_file: A DataStore object opened to add predictions
+    :return: Sorted indices of the images that need to be predicted
+    """
+    contigs = image_index.contig_names[image_index.contig_id]
+    is_stored = prediction_data_file.is_stored(contigs, image_index.contig_start, image_index.contig_end,
+                                               image_index.chunk_id)
+    is_masked = prediction_data_file.is_chunk_masked(contigs, image_index.contig_start, image_index.contig_end)
+    return np.flatnonzero(np.logical_not(is_stored | is_masked))
+
+
+def get_started_chunk_images(image_index, image_indices, prediction_data_file):
+    """
+    Find the images of chunks that already have predictions in the prediction file.
+    :param image_index: The ImageIndex of the dataset
+    :param image_indices: Indices of the images to check
+    :param prediction_data_file: A DataStore object opened to add predictions
+    :return: Boolean array, true for the images of chunks that have stored images
+    """
+    return prediction_data_file.is_chunk_stored(image_index.contig_names[image_index.contig_id[image_indices]],
+                                                image_index.contig_start[image_indices],
+                                                image_index.contig_end[image_indices])
+
+
+def write_masked_chunks(prediction_data_file, image_index, image_indices):
+    """
+    Save the MarginPolish chunks of the masked images to the prediction file so stitch knows which spans to fill.
+    :param prediction_data_file: A DataStore object opened for writing
+    :param image_index: The ImageIndex of the dataset
+    :param image_indices: Indices of the masked images
+    :return:
+    """
+    masked_chunks = set(zip(image_index.contig_id[image_indices].tolist(),
+                            image_index.contig_start[image_indices].tolist(),
+                            image_index.contig_end[image_indices].tolist()))
+    for contig_id, contig_start, contig_end in sorted(masked_chunks):
+        prediction_data_file.write_masked_chunk(str(image_index.contig_names[contig_id]), contig_start, contig_end)
+
+
+def predict(test_file, output_filename, model_path, batch_size, num_workers, threads, gpu_mode,
+            inference_mode=InferenceOptions.DEFAULT_INFERENCE_MODE, inference_processes=1,
+            precision=InferenceOptions.DEFAULT_PRECISION, resume=False, contigs=None, regions=None, mask_bed=None,
+            stage_timer=None, profile_batches=0, loader=InferenceOptions.DEFAULT_LOADER):
     """
     The predict method loads images generated by MarginPolish and produces base predictions using a
     sequence transduction model based deep neural network. This method loads the model and iterates over
@@ -45,117 +642,164 @@ def predict(test_file, output_filename, model_path, batch_size, num_workers, thr
     :param model_path: Path to a trained model
     :param gpu_mode: If true, predictions will be done over GPU
     :param num_workers: Number of workers to be used by the dataloader
-    :param threads: Number of threads to use with pytorch
+    :param threads: Number of threads to use with pytorch, or onnxruntime for ONNX models
+    :param inference_mode: Window scheme used to run the model, one of InferenceOptions.INFERENCE_MODES. ONNX models
+                           have to be exported with the same mode.
+    :param inference_processes: Number of CPU inference processes, the threads are divided between the processes.
+                                ONNX models run in one process.
+    :param precision: Precision of the model during inference, one of InferenceOptions.PRECISIONS
+    :param resume: If true and the output file exists, only the images that are not in the file are predicted
+    :param contigs: If given, only the images of these contigs are predicted
+    :param regions: If given, only the images overlapping these (contig, start, end) regions are predicted
+    :param mask_bed: If given, the images of chunks that are fully inside the regions of this BED file are not
+                     predicted, the chunks are marked as masked in the prediction file
+    :param stage_timer: A StageTimer to collect the time spent in each stage of prediction. The stage times are
+                        printed and saved next to the output file at the end.
+    :param profile_batches: If above 0, this many minibatches are recorded with the torch profiler and saved as a
+                            Chrome trace next to the output file
+    :param loader: How the dataloader workers pass the minibatches, one of InferenceOptions.LOADERS. mmap passes
+                   them through a file next to the output file instead of shared memory.
     :return: Prediction dictionary
     """
-    # create the output hdf5 file where all the predictions will be saved
-    prediction_data_file = DataStore(output_filename, mode='w')
-    torch.set_num_threads(threads)
-    sys.stderr.write(TextColor.GREEN + 'INFO: TORCH THREADS SET TO: ' + str(torch.get_num_threads()) + ".\n"
-                     + TextColor.END)
+    if gpu_mode and precision == 'int8':
+        raise ValueError(TextColor.RED + "ERROR: INT8 INFERENCE IS ONLY AVAILABLE ON CPU.\n" + TextColor.END)
+
+    backend = get_model_backend(model_path)
+    if gpu_mode and backend != 'torch':
+        raise ValueError(TextColor.RED + "ERROR: " + backend.upper() + " MODELS ARE ONLY AVAILABLE ON CPU.\n"
+                         + TextColor.END)
+    if backend != 'torch' and precision != InferenceOptions.DEFAULT_PRECISION:
+        raise ValueError(TextColor.RED + "ERROR: " + backend.upper() + " MODELS ONLY RUN IN "
+                         + InferenceOptions.DEFAULT_PRECISION.upper() + ".\n" + TextColor.END)
+
+    if stage_timer is None:
+        stage_timer = StageTimer()
+    output_prefix = os.path.splitext(output_filename)[0]
+    trace_filename = output_prefix + "_profile_trace.json"
+    output_directory = os.path.dirname(os.path.abspath(output_filename))
+
+    # create the output hdf5 file where all the predictions will be saved, or open it to add the missing ones
+    prediction_data_file = open_prediction_file(output_filename, resume)
+
+    # on GPU we always run one process. ONNX models run in one process with onnxruntime, the images are read in a
+    # background thread of that process.
+    if gpu_mode or backend == 'onnx':
+        inference_processes = 1
+    # with multiple processes the float32 model is shared and each process converts it to the precision
+    model_precision = precision if inference_processes == 1 else InferenceOptions.DEFAULT_PRECISION
+    threads_per_process = max(1, threads // inference_processes)
+
+    if backend == 'onnx':
+        sys.stderr.write(TextColor.GREEN + 'INFO: ONNXRUNTIME THREADS SET TO: ' + str(threads_per_process) + ".\n"
+                         + TextColor.END)
+        if profile_batches > 0:
+            sys.stderr.write(TextColor.YELLOW + "WARN: THE TORCH PROFILER CAN'T RECORD ONNX MODELS, NO TRACE IS "
+                             "SAVED.\n" + TextColor.END)
+    else:
+        import torch
+        torch.set_num_threads(threads_per_process)
+        sys.stderr.write(TextColor.GREEN + 'INFO: TORCH THREADS SET TO: ' + str(torch.get_num_threads()) + ".\n"
+                         + TextColor.END)
 
     # notify that the process has started and loading data
     sys.stderr.write(TextColor.PURPLE + 'Loading data\n' + TextColor.END)
 
-    # create a pytorch dataset and dataloader that loads the data in mini_batches
-    test_data = SequenceDataset(test_file)
-    test_loader = DataLoader(test_data,
-                             batch_size=batch_size,
-                             shuffle=False,
-                             num_workers=num_workers)
-
-    # load the model using the model path
-    transducer_model, hidden_size, gru_layers, prev_ite = \
-        ModelHandler.load_simple_model(model_path,
-                                       input_channels=ImageSizeOptions.IMAGE_CHANNELS,
-                                       image_features=ImageSizeOptions.IMAGE_HEIGHT,
-                                       seq_len=ImageSizeOptions.SEQ_LENGTH,
-                                       num_base_classes=ImageSizeOptions.TOTAL_BASE_LABELS,
-                                       num_rle_classes=ImageSizeOptions.TOTAL_RLE_LABELS)
-
-    # set the model to evaluation mode.
-    transducer_model.eval()
-
-    # if gpu mode is True, then load the model in the GPUs
-    if gpu_mode:
-        transducer_model = torch.nn.DataParallel(transducer_model).cuda()
+    # create a pytorch dataset that loads the data in mini_batches
+    with stage_timer.stage('index'):
+        test_data = SequenceDataset(test_file)
+
+    # only predict the images of the requested contigs and regions
+    image_indices = np.arange(len(test_data))
+    if contigs or regions:
+        image_indices = test_data.image_index.select_images(contigs, regions)
+        sys.stderr.write(TextColor.GREEN + 'INFO: ' + str(len(image_indices)) + ' OF ' + str(len(test_data))
+                         + ' IMAGES ARE IN THE SELECTED CONTIGS AND REGIONS.\n' + TextColor.END)
+
+    # skip the images in masked regions, stitch fills these chunks with the draft sequence
+    if mask_bed is not None:
+        masked_regions = MaskedRegions(mask_bed)
+        is_masked = masked_regions.get_masked_images(test_data.image_index, image_indices)
+        # when we resume, the chunks a previous run started to predict are predicted to the end. Stitch would get
+        # both the predictions and the draft sequence of these chunks if we masked them now.
+        if prediction_data_file.mode == 'a':
+            is_masked &= np.logical_not(get_started_chunk_images(test_data.image_index, image_indices,
+                                                                 prediction_data_file))
+        write_masked_chunks(prediction_data_file, test_data.image_index, image_indices[is_masked])
+        image_indices = image_indices[np.logical_not(is_masked)]
+        sys.stderr.write(TextColor.GREEN + 'INFO: SKIPPING ' + str(int(np.sum(is_masked))) + ' IMAGES IN MASKED '
+                         'REGIONS.\n' + TextColor.END)
+
+    # skip the images that were predicted or masked by a previous run
+    if prediction_data_file.mode == 'a':
+        unpredicted_indices = get_unpredicted_images(test_data.image_index, prediction_data_file)
+        total_images = len(image_indices)
+        image_indices = np.intersect1d(image_indices, unpredicted_indices)
+        sys.stderr.write(TextColor.GREEN + 'INFO: RESUMING PREDICTION, ' + str(total_images - len(image_indices))
+                         + ' OF ' + str(total_images) + ' IMAGES ARE ALREADY PREDICTED OR MASKED.\n' + TextColor.END)
+    if len(image_indices) == 0:
+        prediction_data_file.close()
+        return
+
+    # load the model using the model path, the backend that runs the model depends on the type of the model file.
+    # The exported models can't be shared between processes, so with multiple processes each process loads its own.
+    with stage_timer.stage('model_load'):
+        if backend == 'onnx':
+            transducer_model = load_onnx_model(model_path, threads_per_process, inference_mode)
+        elif inference_processes > 1 and backend != 'torch':
+            transducer_model = None
+        else:
+            from modules.python.models.ModelHander import ModelHandler
+            transducer_model = ModelHandler.load_inference_model(model_path, backend, model_precision)
+
+        # if gpu mode is True, then load the model in the GPUs
+        if gpu_mode:
+            transducer_model = torch.nn.DataParallel(transducer_model).cuda()
 
     # notify that the model has loaded successfully
     sys.stderr.write(TextColor.CYAN + 'MODEL LOADED\n')
 
-    # iterate over the data in minibatches
-    with torch.no_grad():
-        # the dataloader loop, iterates in minibatches. tqdm is the progress logger.
-        for contig, contig_start, contig_end, chunk_id, images, position, filename in tqdm(test_loader, ncols=50):
-            # the images are usually in uint8, convert them to FloatTensor
-            images = images.type(torch.FloatTensor)
-            # initialize the first hidden input as all zeros
-            hidden = torch.zeros(images.size(0), 2 * TrainOptions.GRU_LAYERS, TrainOptions.HIDDEN_SIZE)
-
-            # if gpu_mode is True, transfer the image and hidden tensors to the GPU
-            if gpu_mode:
-                images = images.cuda()
-                hidden = hidden.cuda()
-
-            # this is a multi-task neural network where we predict a base and a run-length. We use two dictionaries
-            # to keep track of predictions.
-            # these two dictionaries save predictions for each of the chunks and later we aggregate all the predictions
-            # over the entire sequence to get a sequence prediction for the whole sequence.
-            prediction_base_tensor = torch.zeros((images.size(0), images.size(1), ImageSizeOptions.TOTAL_BASE_LABELS))
-            prediction_rle_tensor = torch.zeros((images.size(0), images.size(1), ImageSizeOptions.TOTAL_RLE_LABELS))
-
-            if gpu_mode:
-                prediction_base_tensor = prediction_base_tensor.cuda()
-                prediction_rle_tensor = prediction_rle_tensor.cuda()
-
-            # now the images usually contain 1000 bases, we iterate on a sliding window basis where we process
-            # the window size then jump to the next window
-            for i in range(0, ImageSizeOptions.SEQ_LENGTH, TrainOptions.WINDOW_JUMP):
-                # if current position + window size goes beyond the size of the window, that means we've reached the end
-                if i + TrainOptions.TRAIN_WINDOW > ImageSizeOptions.SEQ_LENGTH:
-                    break
-                chunk_start = i
-                chunk_end = i + TrainOptions.TRAIN_WINDOW
-
-                # get the image chunk
-                image_chunk = images[:, chunk_start:chunk_end]
-
-                # run inference
-                output_base, output_rle, hidden = transducer_model(image_chunk, hidden)
-
-                # now calculate how much padding is on the top and bottom of this chunk so we can do a simple
-                # add operation
-                top_zeros = chunk_start
-                bottom_zeros = ImageSizeOptions.SEQ_LENGTH - chunk_end
-
-                # we run a softmax a padding to make the output tensor compatible for adding
-                inference_layers = nn.Sequential(
-                    nn.Softmax(dim=2),
-                    nn.ZeroPad2d((0, 0, top_zeros, bottom_zeros))
-                )
-                if gpu_mode:
-                    inference_layers = inference_layers.cuda()
-
-                # run the softmax and padding layers
-                base_prediction = inference_layers(output_base)
-                rle_prediction = inference_layers(output_rle)
-
-                # now simply add the tensor to the global counter
-                prediction_base_tensor = torch.add(prediction_base_tensor, base_prediction)
-                prediction_rle_tensor = torch.add(prediction_rle_tensor, rle_prediction)
-
-            # all done now create a SEQ_LENGTH long prediction list
-            prediction_base_tensor = prediction_base_tensor.cpu()
-            prediction_rle_tensor = prediction_rle_tensor.cpu()
-
-            base_values, base_labels = torch.max(prediction_base_tensor, 2)
-            rle_values, rle_labels = torch.max(prediction_rle_tensor, 2)
-
-            predicted_base_labels = base_labels.cpu().numpy()
-            predicted_rle_labels = rle_labels.cpu().numpy()
-
-            # go to each of the images and save the predictions to the file
-            for i in range(images.size(0)):
-                prediction_data_file.write_prediction(contig[i], contig_start[i], contig_end[i], chunk_id[i],
-                                                      position[i], predicted_base_labels[i], predicted_rle_labels[i],
-                                                      filename[i])
\ No newline at end of file
+    if inference_processes > 1:
+        sys.stderr.write(TextColor.GREEN + 'INFO: RUNNING ' + str(inference_processes) + ' INFERENCE PROCESSES.\n'
+                         + TextColor.END)
+        predict_multiprocess(transducer_model, model_path, test_data, image_indices, prediction_data_file, batch_size,
+                             num_workers, threads_per_process, inference_processes, inference_mode, precision,
+                             stage_timer, profile_batches, trace_filename, loader, output_directory)
+    elif backend == 'onnx':
+        # the exported graph always runs all the windows, so the images are not grouped by their lengths
+        batch_sampler = FileLocalityBatchSampler(test_data.image_index, batch_size, image_indices)
+        with PredictionWriter(prediction_data_file, write_predictions, InferenceOptions.WRITER_QUEUE_SIZE,
+                              InferenceOptions.FLUSH_INTERVAL) as prediction_writer:
+            for batch_predictions in tqdm(predict_batches_onnx(transducer_model, test_data, batch_sampler,
+                                                               stage_timer),
+                                          total=len(batch_sampler), ncols=50):
+                prediction_writer.write(batch_predictions)
+
+        stage_timer.add('write', prediction_writer.write_time)
+        stage_timer.add('writer_wait', prediction_writer.wait_time)
+    else:
+        # short images are batched together so the model can stop at the end of the longest image of a batch
+        batch_sampler = FileLocalityBatchSampler(test_data.image_index, batch_size, image_indices,
+                                                 InferenceOptions.INFERENCE_MODES[inference_mode][1])
+        # the predictions are written in a background thread while the model runs on the next minibatch
+        # optionally record a few minibatches with the torch profiler
+        profiler = get_profiler(trace_filename, profile_batches, gpu_mode) if profile_batches > 0 else None
+        if profiler is not None:
+            profiler.start()
+        with PredictionWriter(prediction_data_file, write_predictions, InferenceOptions.WRITER_QUEUE_SIZE,
+                              InferenceOptions.FLUSH_INTERVAL) as prediction_writer:
+            # tqdm is the progress logger.
+            for batch_predictions in tqdm(predict_batches(transducer_model, test_data, batch_sampler, num_workers,
+                                                          batch_size, inference_mode, gpu_mode, stage_timer,
+                                                          profiler, loader, output_directory),
+                                          total=len(batch_sampler), ncols=50):
+                prediction_writer.write(batch_predictions)
+        if profiler is not None:
+            profiler.stop()
+
+        stage_timer.add('write', prediction_writer.write_time)
+        stage_timer.add('writer_wait', prediction_writer.wait_time)
+
+    prediction_data_file.close()
+
+    # print and save the time spent in each stage
+    write_stage_report(stage_timer, output_prefix + "_stage_times.json", len(image_indices))
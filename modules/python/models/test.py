@@ -14,6 +14,67 @@ The test method evaluates a trained model on a given test dataset and report var
 """
 
 
+def get_accuracy(confusion_matrix):
+    """
+    Calculate the accuracy from a confusion matrix, the sum of all cells in the confusion matrix is the denominator.
+    :param confusion_matrix: A square confusion matrix
+    :return: Accuracy in percent
+    """
+    return 100.0 * np.trace(confusion_matrix) / max(1.0, confusion_matrix.sum())
+
+
+class TestMetrics(object):
+    """
+    Accumulates the base and RLE confusion matrices of a model's predictions and calculates the accuracies from them.
+    The test method uses it for the outputs of each window, other scripts can use it for the labels predicted for
+    each column of the images.
+    """
+    def __init__(self, num_base_classes, num_rle_classes):
+        """
+        Object initialization function
+        :param num_base_classes: Number of classes for base prediction
+        :param num_rle_classes: Number of classes for RLE prediction
+        """
+        self.num_base_classes = num_base_classes
+        self.num_rle_classes = num_rle_classes
+        self.base_confusion_matrix = meter.ConfusionMeter(num_base_classes)
+        self.rle_confusion_matrix = meter.ConfusionMeter(num_rle_classes)
+
+    @staticmethod
+    def _flatten(predictions, labels, num_classes):
+        """
+        Flatten the predictions and labels of a minibatch the way the confusion matrix takes them.
+        :param predictions: Scores with a last dimension of num_classes or predicted labels in the shape of labels
+        :param labels: True labels
+        :param num_classes: Number of classes
+        :return: The flattened predictions and labels
+        """
+        if predictions.dim() > labels.dim():
+            predictions = predictions.contiguous().view(-1, num_classes)
+        else:
+            predictions = predictions.contiguous().view(-1).long()
+        return predictions, labels.contiguous().view(-1).long()
+
+    def add(self, output_base, label_base, output_rle, label_rle):
+        """
+        Add the predictions of a minibatch to the confusion matrices.
+        :param output_base: Base scores of the model or predicted base labels
+        :param label_base: True base labels
+        :param output_rle: RLE scores of the model or predicted RLE labels
+        :param label_rle: True RLE labels
+        :return:
+        """
+        self.base_confusion_matrix.add(*self._flatten(output_base.data, label_base.data, self.num_base_classes))
+        self.rle_confusion_matrix.add(*self._flatten(output_rle.data, label_rle.data, self.num_rle_classes))
+
+    def get_accuracy(self):
+        """
+        Calculate the base and RLE accuracy of the predictions added so far.
+        :return: Base and RLE accuracy in percent
+        """
+        return get_accuracy(self.base_confusion_matrix.value()), get_accuracy(self.rle_confusion_matrix.value())
+
+
 def test(data_filepath,
          batch_size,
          gpu_mode,
@@ -62,8 +123,7 @@ def test(data_filepath,
 
     # initialize base and rle confusion matrix
     sys.stderr.write(TextColor.PURPLE + 'Test starting\n' + TextColor.END)
-    base_confusion_matrix = meter.ConfusionMeter(num_base_classes)
-    rle_confusion_matrix = meter.ConfusionMeter(num_rle_classes)
+    test_metrics = TestMetrics(num_base_classes, num_rle_classes)
 
     # initialize the accuracy matrices
     total_loss = 0
@@ -116,10 +176,7 @@ def test(data_filepath,
                     loss = loss_base + loss_rle
 
                     # populate the confusion matrix
-                    base_confusion_matrix.add(output_base.data.contiguous().view(-1, num_base_classes),
-                                              label_base_chunk.data.contiguous().view(-1))
-                    rle_confusion_matrix.add(output_rle.data.contiguous().view(-1, num_rle_classes),
-                                             label_rle_chunk.data.contiguous().view(-1))
+                    test_metrics.add(output_base, label_base_chunk, output_rle, label_rle_chunk)
 
                     total_loss += loss.item()
                     total_images += images.size(0)
@@ -127,24 +184,7 @@ def test(data_filepath,
 
                 pbar.update(1)
                 # we calculate the accuracy using the confusion matrix
-                base_cm_value = base_confusion_matrix.value()
-                rle_cm_value = rle_confusion_matrix.value()
-                # the sum of all cells in the confusion matrix is the denominator
-                base_denom = base_cm_value.sum()
-                rle_denom = rle_cm_value.sum()
-
-                # calculate the correct predictions in each case
-                base_corrects = 0
-                for label in range(0, ImageSizeOptions.TOTAL_BASE_LABELS):
-                    base_corrects = base_corrects + base_cm_value[label][label]
-
-                rle_corrects = 0
-                for label in range(0, ImageSizeOptions.TOTAL_RLE_LABELS):
-                    rle_corrects = rle_corrects + rle_cm_value[label][label]
-
-                # calculate the accuracy
-                base_accuracy = 100.0 * (base_corrects / max(1.0, base_denom))
-                rle_accuracy = 100.0 * (rle_corrects / max(1.0, rle_denom))
+                base_accuracy, rle_accuracy = test_metrics.get_accuracy()
 
                 # set the tqdm bar's accuracy and loss value
                 pbar.set_description("Base acc: " + str(round(base_accuracy, 4)) +
@@ -155,13 +195,14 @@ def test(data_filepath,
     np.set_printoptions(threshold=np.inf)
     # print some statistics
     sys.stderr.write(TextColor.YELLOW+'\nTest Loss: ' + str(avg_loss) + "\n"+TextColor.END)
-    sys.stderr.write(TextColor.BLUE + "Base Confusion Matrix: \n" + str(base_confusion_matrix.value()) + "\n" + TextColor.END)
+    sys.stderr.write(TextColor.BLUE + "Base Confusion Matrix: \n" + str(test_metrics.base_confusion_matrix.value())
+                     + "\n" + TextColor.END)
     sys.stderr.write(TextColor.RED + "RLE Confusion Matrix: \n" + TextColor.END)
-    for row in rle_confusion_matrix.value():
+    for row in test_metrics.rle_confusion_matrix.value():
         row = row.tolist()
         for elem in row:
             sys.stderr.write("{:9d} ".format(elem))
         sys.stderr.write("\n")
 
-    return {'loss': avg_loss, 'accuracy': accuracy, 'base_confusion_matrix': base_confusion_matrix.conf,
-            'rle_confusion_matrix': rle_confusion_matrix.conf}
+    return {'loss': avg_loss, 'accuracy': accuracy, 'base_confusion_matrix': test_metrics.base_confusion_matrix.conf,
+            'rle_confusion_matrix': test_metrics.rle_confusion_matrix.conf}
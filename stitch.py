@@ -1,9 +1,11 @@
-import h5py
 import argparse
 import sys
 import os
 from modules.python.Stitch import Stitch
+from modules.python.DataStore import DataStore
+from modules.python.HDF5DataStore import HDF5DataStore
 from modules.python.TextColor import TextColor
+from modules.python.FileManager import FileManager
 """
 The stitch module generates a consensus sequence from all the predictions we generated from call_consensus.py.
 
@@ -24,24 +26,56 @@ The method is as follows:
 """
 
 
-def process_marginpolish_h5py(hdf_file_path, output_path, output_prefix, threads):
+def get_draft_sequences(draft_fasta_path, contigs):
+    """
+    Read the sequences of the given contigs from the draft assembly.
+    :param draft_fasta_path: Path to the draft assembly FASTA file
+    :param contigs: Set of contig names to read
+    :return: A dictionary of contig name to sequence
+    """
+    draft_sequences = {}
+    contig, sequence_lines = None, []
+    with open(draft_fasta_path, 'r') as fasta_file:
+        for line in fasta_file:
+            if line.startswith('>'):
+                if contig in contigs:
+                    draft_sequences[contig] = ''.join(sequence_lines).upper()
+                contig, sequence_lines = line[1:].split()[0], []
+            elif contig in contigs:
+                sequence_lines.append(line.strip())
+    if contig in contigs:
+        draft_sequences[contig] = ''.join(sequence_lines).upper()
+
+    for contig in contigs - set(draft_sequences.keys()):
+        sys.stderr.write(TextColor.YELLOW + "WARN: CONTIG NOT FOUND IN DRAFT, MASKED REGIONS WILL BE FILLED WITH N: "
+                         + contig + "\n" + TextColor.END)
+    return draft_sequences
+
+
+def process_marginpolish_h5py(hdf_file_path, output_path, output_prefix, threads, draft_fasta_path=None):
     """
     This method gathers all contigs and calls the stitch module for each contig.
     :param hdf_file_path: Path to the prediction file.
     :param output_path: Path to the output_consensus_sequence
     :param output_prefix: Output file's prefix
     :param threads: Number of threads to use
+    :param draft_fasta_path: Path to the draft assembly, used to fill the masked chunks. Ns are used if None.
     :return:
     """
 
-    # we gather all the contigs
-    contigs = []
-    with h5py.File(hdf_file_path, 'r') as hdf5_file:
-        if 'predictions' in hdf5_file:
-            contigs = list(hdf5_file['predictions'].keys())
-        else:
-            raise ValueError(TextColor.RED + "ERROR: INVALID HDF5 FILE, FILE DOES NOT CONTAIN predictions KEY.\n"
+    # we gather all the contigs with their chunk keys and masked chunks, the masked chunks were not predicted and
+    # are filled with the draft sequence
+    with DataStore.open(hdf_file_path, 'r') as prediction_file:
+        contigs = prediction_file.get_contigs()
+        if not contigs:
+            raise ValueError(TextColor.RED + "ERROR: INVALID PREDICTION FILE, FILE DOES NOT CONTAIN ANY PREDICTIONS.\n"
                              + TextColor.END)
+        chunk_keys = {contig: prediction_file.get_chunk_keys(contig) for contig in contigs}
+        masked_chunk_keys = {contig: prediction_file.get_masked_chunks(contig) for contig in contigs}
+        masked_contigs = set(contig for contig in contigs if masked_chunk_keys[contig])
+    draft_sequences = {}
+    if masked_contigs and draft_fasta_path is not None:
+        draft_sequences = get_draft_sequences(draft_fasta_path, masked_contigs)
 
     # open an output fasta file
     # we should really use a fasta handler for this, I don't like this.
@@ -55,20 +89,11 @@ def process_marginpolish_h5py(hdf_file_path, output_path, output_prefix, threads
         sys.stderr.write(TextColor.GREEN + "INFO: " + str(log_prefix) + " PROCESSING CONTIG: " + contig + "\n"
                          + TextColor.END)
 
-        # get all the chunk keys
-        with h5py.File(hdf_file_path, 'r') as hdf5_file:
-            chunk_keys = sorted(hdf5_file['predictions'][contig].keys())
-
-        chunk_name_tuple = list()
-        with h5py.File(hdf_file_path, 'r') as hdf5_file:
-            for chunk_key in chunk_keys:
-                chunk_contig_start = hdf5_file['predictions'][contig][chunk_key]['contig_start'][()]
-                chunk_contig_end = hdf5_file['predictions'][contig][chunk_key]['contig_end'][()]
-                chunk_name_tuple.append((chunk_key, chunk_contig_start, chunk_contig_end))
-
         # call stitch to generate a sequence for this contig
         stich_object = Stitch()
-        consensus_sequence = stich_object.create_consensus_sequence(hdf_file_path, contig, chunk_name_tuple, threads)
+        consensus_sequence = stich_object.create_consensus_sequence(hdf_file_path, contig, chunk_keys[contig], threads,
+                                                                    masked_chunk_keys[contig],
+                                                                    draft_sequences.get(contig))
         sys.stderr.write(TextColor.BLUE + "INFO: " + str(log_prefix) + " FINISHED PROCESSING " + contig
                          + ", POLISHED SEQUENCE LENGTH: " + str(len(consensus_sequence)) + ".\n" + TextColor.END)
 
@@ -92,8 +117,12 @@ if __name__ == '__main__':
         "-i",
         "--input_hdf",
         type=str,
+        nargs='+',
         required=True,
-        help="[REQUIRED] Path to a HDF5 file that was generated using call consensus."
+        help="[REQUIRED] Path to a prediction file (.hdf or .bin) that was generated using call consensus. If\n"
+             "call_consensus.py was run in parts, i.e. with --contigs or --region on different nodes, give all the\n"
+             "files. HDF5 files are joined without copying by a master file <output_prefix>_predictions.hdf in the\n"
+             "output directory, which can also be given later as the input."
     )
     parser.add_argument(
         "-o",
@@ -117,6 +146,29 @@ if __name__ == '__main__':
         default="HELEN_consensus",
         help="Prefix for the output file. Default is: HELEN_consensus"
     )
+    parser.add_argument(
+        "-d",
+        "--draft_fasta",
+        type=str,
+        required=False,
+        default=None,
+        help="Path to the draft assembly. If call_consensus.py was run with --mask_bed, the masked regions are filled\n"
+             "with the draft sequence. Without the draft the masked regions are filled with Ns."
+    )
 
     FLAGS, unparsed = parser.parse_known_args()
-    process_marginpolish_h5py(FLAGS.input_hdf, FLAGS.output_dir, FLAGS.output_prefix, FLAGS.threads)
+    FLAGS.output_dir = FileManager.handle_output_directory(FLAGS.output_dir)
+
+    input_hdf = FLAGS.input_hdf[0]
+    if len(FLAGS.input_hdf) > 1:
+        for input_file in FLAGS.input_hdf:
+            if DataStore.get_backend(input_file) != 'hdf5':
+                raise ValueError(TextColor.RED + "ERROR: ONLY HDF5 PREDICTION FILES CAN BE JOINED: " + input_file
+                                 + "\n" + TextColor.END)
+        input_hdf = os.path.join(FLAGS.output_dir, FLAGS.output_prefix + '_predictions.hdf')
+        HDF5DataStore.write_master_file(input_hdf, FLAGS.input_hdf)
+        sys.stderr.write(TextColor.GREEN + "INFO: JOINED " + str(len(FLAGS.input_hdf)) + " PREDICTION FILES IN: "
+                         + input_hdf + "\n" + TextColor.END)
+
+    process_marginpolish_h5py(input_hdf, FLAGS.output_dir, FLAGS.output_prefix, FLAGS.threads,
+                              FLAGS.draft_fasta)